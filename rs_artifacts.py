@@ -0,0 +1,86 @@
+# %%
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, Any, Sequence, Optional
+import numpy as np
+from scipy.sparse import csr_matrix
+from rs_data import DATA_PATH, data_hash
+
+MODEL_FORMAT_VERSION = 3  # Incremented whenever the layout of saved model artifacts changes
+MODELS_PATH: Path = DATA_PATH.joinpath("models")  # Default path for saved model artifacts
+
+
+# %%
+def model_version() -> str:
+    # Identifies models fitted to the current preprocessed data with the current artifact format
+    return f"v{MODEL_FORMAT_VERSION}-{data_hash()}"
+
+
+def model_path(root: Path = MODELS_PATH) -> Path:
+    # Versioned artifact directory for models fitted to the current preprocessed data
+    return root.joinpath(model_version())
+
+
+def save_meta(path: Path, model_type: str, **values: Any):
+    path.mkdir(parents=True, exist_ok=True)
+    path.joinpath("meta.json").write_text(json.dumps({"format": MODEL_FORMAT_VERSION, "type": model_type, **values}))
+
+
+def load_meta(path: Path, model_type: str) -> Dict[str, Any]:
+    meta = json.loads(path.joinpath("meta.json").read_text())
+    if meta["format"] != MODEL_FORMAT_VERSION or meta["type"] != model_type:
+        raise ValueError(f"'{path}' contains a {meta['type']} (format {meta['format']}), "
+                         f"expected a {model_type} (format {MODEL_FORMAT_VERSION})")
+    return meta
+
+
+def save_array(path: Path, name: str, array: np.ndarray):
+    np.save(path.joinpath(f"{name}.npy"), array, allow_pickle=False)
+
+
+def load_array(path: Path, name: str, mmap_mode: Optional[str] = None) -> np.ndarray:
+    # With mmap_mode="r" the array is a read-only view of the file, so processes loading it share its pages
+    return np.load(path.joinpath(f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def save_ids(path: Path, name: str, ids: Sequence[str]):
+    # IDs are stored as fixed-width unicode so they can be loaded without pickle
+    save_array(path, name, np.asarray(ids, dtype=str))
+
+
+def load_ids(path: Path, name: str) -> np.ndarray:
+    return load_array(path, name).astype(object)
+
+
+def save_csr(path: Path, name: str, matrix: csr_matrix):
+    # Sparse matrices are stored as their component arrays
+    save_array(path, f"{name}_data", matrix.data)
+    save_array(path, f"{name}_indices", matrix.indices)
+    save_array(path, f"{name}_indptr", matrix.indptr)
+    save_array(path, f"{name}_shape", np.asarray(matrix.shape, dtype=np.int64))
+
+
+def load_csr(path: Path, name: str, mmap_mode: Optional[str] = None) -> csr_matrix:
+    # The component arrays are used without copying, so a memory-mapped matrix stays a view of the files
+    return csr_matrix(
+        (load_array(path, f"{name}_data", mmap_mode), load_array(path, f"{name}_indices", mmap_mode),
+         load_array(path, f"{name}_indptr", mmap_mode)),
+        shape=tuple(load_array(path, f"{name}_shape")),
+        copy=False
+    )
+
+
+def replace_directory(temporary_path: Path, path: Path):
+    # Move a fully written artifact directory into place
+    if path.exists():
+        shutil.rmtree(path)
+    temporary_path.rename(path)
+
+
+def temporary_directory(path: Path) -> Path:
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    if temporary_path.exists():
+        shutil.rmtree(temporary_path)
+    temporary_path.mkdir(parents=True)
+    return temporary_path
@@ -1,29 +1,132 @@
-from typing import Optional, Dict
+from typing import Optional, Sequence
 
+import numpy as np
 import pandas as pd
 
 
+class ReviewIndex:
+    """
+    Lookup of review row positions by (user ID, restaurant ID). Users and restaurants are coded as dense integers
+    (ordered by ID) and each review is stored as a sorted int64 key (user code << 32 | restaurant code), so a lookup
+    is a hash of each ID plus a binary search, and each review costs 16 bytes rather than a dictionary entry.
+    """
+    def __init__(self, reviews: pd.DataFrame):
+        self.user_index: pd.Index = pd.Index(np.sort(reviews["user_id"].unique()))
+        self.restaurant_index: pd.Index = pd.Index(np.sort(reviews["business_id"].unique()))
+        self.keys: np.ndarray
+        self.positions: np.ndarray
+        self.__set_keys(self.__review_keys(reviews), np.arange(reviews.shape[0]))
+
+    @staticmethod
+    def __keys(user_codes: np.ndarray, restaurant_codes: np.ndarray) -> np.ndarray:
+        return (user_codes.astype(np.int64) << 32) | restaurant_codes.astype(np.int64)
+
+    def __review_keys(self, reviews: pd.DataFrame) -> np.ndarray:
+        return self.__keys(self.user_index.get_indexer(reviews["user_id"]),
+                           self.restaurant_index.get_indexer(reviews["business_id"]))
+
+    def __set_keys(self, keys: np.ndarray, positions: np.ndarray):
+        # Sort the keys, keeping the review row position of each (and only the last review of a repeated pair)
+        order = np.argsort(keys, kind="stable")
+        keys, positions = keys[order], positions[order]
+        last = np.append(keys[1:] != keys[:-1], True) if keys.size else np.empty(0, dtype=bool)
+        self.keys, self.positions = keys[last], positions[last]
+
+    def extended(self, reviews: pd.DataFrame, offset: int) -> "ReviewIndex":
+        """
+        Create an index with reviews added, whose rows start at position offset (e.g. appended to the review table).
+        New users and restaurants are coded in ID order, so the existing keys are re-coded rather than rebuilt.
+        """
+        index: ReviewIndex = ReviewIndex.__new__(ReviewIndex)
+        index.user_index = self.user_index.union(pd.Index(reviews["user_id"].unique()))
+        index.restaurant_index = self.restaurant_index.union(pd.Index(reviews["business_id"].unique()))
+
+        # Re-code the existing keys (whose codes move up as IDs are inserted before them)
+        user_codes = index.user_index.get_indexer(self.user_index)
+        restaurant_codes = index.restaurant_index.get_indexer(self.restaurant_index)
+        keys = self.__keys(user_codes[self.keys >> 32], restaurant_codes[self.keys & 0xFFFFFFFF])
+        index.__set_keys(np.concatenate((keys, index.__review_keys(reviews))),
+                         np.concatenate((self.positions, offset + np.arange(reviews.shape[0]))))
+        return index
+
+    def __len__(self) -> int:
+        return self.keys.size
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.positions.nbytes
+
+    def position(self, user_id: str, restaurant_id: str) -> int:
+        # Get the review row position of a single (user, restaurant) pair, or -1 if there is no review
+        try:
+            key = (self.user_index.get_loc(user_id) << 32) | self.restaurant_index.get_loc(restaurant_id)
+        except KeyError:
+            return -1
+        i = int(self.keys.searchsorted(key))
+        return int(self.positions[i]) if i < self.keys.size and self.keys[i] == key else -1
+
+    def positions_many(self, user_ids: Sequence[str], restaurant_ids: Sequence[str]) -> np.ndarray:
+        # Get the review row positions of many (user, restaurant) pairs, with -1 where there is no review
+        user_codes = self.user_index.get_indexer(user_ids)
+        restaurant_codes = self.restaurant_index.get_indexer(restaurant_ids)
+        positions = np.full(user_codes.size, -1, dtype=np.int64)
+        if self.keys.size == 0:
+            return positions
+
+        keys = self.__keys(user_codes, restaurant_codes)
+        i = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        found = (user_codes >= 0) & (restaurant_codes >= 0) & (self.keys[i] == keys)
+        positions[found] = self.positions[i[found]]
+        return positions
+
+
+def updated_table(table: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+    # Create a copy of table with rows appended, replacing the values of rows already in the table (at their position)
+    existing = rows.index.isin(table.index)
+    table = pd.concat([table, rows[~existing]])
+    if existing.any():
+        table.loc[rows.index[existing], rows.columns] = rows[existing]
+    return table
+
+
 class RecommenderBase:
     def __init__(self, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
-                 review_dict: Optional[Dict[str, str]] = None):
+                 review_index: Optional[ReviewIndex] = None):
         self._restaurants: pd.DataFrame = restaurants
         self._users: pd.DataFrame = users
         self._reviews: pd.DataFrame = reviews
 
-        if review_dict is None:
-            data = (reviews["user_id"] + reviews["business_id"]).tolist()
-            index_data = reviews.index.values
-            # For fast lookup of reviews
-            review_dict = dict(zip(data, index_data))
+        # For fast lookup of reviews
+        self._review_index: ReviewIndex = ReviewIndex(reviews) if review_index is None else review_index
 
-        self._review_dict = review_dict
+    def _add_data(self, reviews: pd.DataFrame, users: Optional[pd.DataFrame] = None,
+                  restaurants: Optional[pd.DataFrame] = None, review_index: Optional[ReviewIndex] = None):
+        # Append new reviews, users and restaurants to the tables (updating existing users and restaurants in place)
+        self._review_index = self._review_index.extended(reviews, self._reviews.shape[0]) \
+            if review_index is None else review_index
+        self._reviews = pd.concat([self._reviews, reviews])
+        if users is not None:
+            self._users = updated_table(self._users, users)
+        if restaurants is not None:
+            self._restaurants = updated_table(self._restaurants, restaurants)
 
     def reviewed(self, user_id: str, restaurant_id: str) -> bool:
-        return (user_id + restaurant_id) in self._review_dict
+        return self._review_index.position(user_id, restaurant_id) >= 0
 
     def review(self, user_id: str, restaurant_id: str) -> Optional[str]:
-        key = user_id + restaurant_id
-        return self._review_dict[key] if key in self._review_dict else None
+        position = self._review_index.position(user_id, restaurant_id)
+        return self._reviews.index[position] if position >= 0 else None
+
+    def reviewed_many(self, user_ids: Sequence[str], restaurant_ids: Sequence[str]) -> np.ndarray:
+        # Vectorised reviewed: a boolean array of whether each user reviewed the corresponding restaurant
+        return self._review_index.positions_many(user_ids, restaurant_ids) >= 0
+
+    def review_many(self, user_ids: Sequence[str], restaurant_ids: Sequence[str]) -> np.ndarray:
+        # Vectorised review: an object array of the review ID for each (user, restaurant) pair, or None
+        positions = self._review_index.positions_many(user_ids, restaurant_ids)
+        review_ids = np.full(positions.size, None, dtype=object)
+        review_ids[positions >= 0] = self._reviews.index.to_numpy()[positions[positions >= 0]]
+        return review_ids
 
     def get_user_by_id(self, user_id: str):
         return self._users.loc[user_id] if user_id in self._users.index else None
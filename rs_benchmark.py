@@ -0,0 +1,290 @@
+# %%
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable, Tuple, Any, Dict, Optional, Sequence, List
+import numpy as np
+import pandas as pd
+from rs_collaborative import CollaborativeFiltering
+from rs_content import ContentBasedFiltering
+from rs_hybrid import HybridRecommenderSystem
+from rs_mf import MatrixFactorization
+from rs_data import load_table, PREPROCESSED_DATA_PATH
+from rs_synthetic import make_synthetic_data
+
+SCALES = (1, 10, 100)  # Data scales of the scaling benchmark (multiples of the base size)
+BASE_SIZE = (500, 5000, 25000)  # Number of restaurants, users and reviews at scale 1
+# Recommenders of the scaling benchmark and the operations timed for each
+SCALING_RECOMMENDERS: Dict[str, Tuple[Callable, Tuple[str, ...]]] = {
+    "cf": (CollaborativeFiltering, ("item_item", "user_user", "predict_stars")),
+    "cbf": (ContentBasedFiltering, ("item_item", "predict_stars")),
+    "hybrid": (HybridRecommenderSystem, ("predict_stars", "recommend_user"))
+}
+
+
+# %%
+def measure(function: Callable[[], Any]) -> Tuple[Any, float, int]:
+    """
+    Run function, returning its result, the elapsed time (seconds) and the peak traced allocation (bytes).
+    Tracing allocations slows Python-heavy code considerably, so function is timed and traced in separate runs.
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def compare_item_similarity(restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+                            item_neighbours: int = 100, item_similarity_floor: Optional[float] = None) \
+        -> pd.DataFrame:
+    # Compare CollaborativeFiltering fit time and memory between the dense matrix and the sparse top-k index
+    results: Dict[str, Dict[str, float]] = {}
+    for name, kwargs in (
+            ("dense", {}),
+            (f"top-{item_neighbours}", dict(item_neighbours=item_neighbours,
+                                            item_similarity_floor=item_similarity_floor))
+    ):
+        _, elapsed, peak = measure(lambda: CollaborativeFiltering(restaurants, users, reviews, **kwargs))
+        results[name] = {"fit_seconds": elapsed, "peak_mib": peak / 2 ** 20}
+    return pd.DataFrame(results).transpose()
+
+
+def compare_table_loading(tables: Tuple[Tuple[str, str], ...] = (
+        ("restaurants", "business_id"), ("users", "user_id"), ("reviews", "review_id")
+)) -> pd.DataFrame:
+    # Compare the load time, peak traced allocation and resident size of each table between CSV and columnar storage
+    results: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for name, index in tables:
+        for storage in ("csv", "columnar"):
+            if storage == "columnar" and not PREPROCESSED_DATA_PATH.joinpath(name, "meta.json").exists():
+                continue
+            table, elapsed, peak = measure(lambda: load_table(name, index, backend=storage))
+            results[(name, storage)] = {
+                "load_seconds": elapsed,
+                "peak_mib": peak / 2 ** 20,
+                "table_mib": table.memory_usage(deep=True).sum() / 2 ** 20
+            }
+    return pd.DataFrame(results).transpose()
+
+
+def compare_rating_models(restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+                          test_fraction: float = 0.1, k: Optional[int] = 40, latency_samples: int = 200,
+                          seed: int = 0, factors: int = 24) -> pd.DataFrame:
+    """
+    Compare the CF, CBF and MF rating predictors on a seeded hold-out split of the reviews: fit time, batch and
+    single-call prediction latency, and the RMSE (and coverage) of the star predictions of the held-out reviews.
+    """
+    rng = np.random.default_rng(seed)
+    test = rng.random(reviews.shape[0]) < test_fraction
+    train_reviews, test_reviews = reviews[~test], reviews[test]
+    user_ids, restaurant_ids = test_reviews["user_id"].to_numpy(), test_reviews["business_id"].to_numpy()
+    stars = test_reviews["stars"].to_numpy(dtype=np.float64)
+    samples = rng.choice(test_reviews.shape[0], min(latency_samples, test_reviews.shape[0]), replace=False)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, fit in (
+            ("cf", lambda: CollaborativeFiltering(restaurants, users, train_reviews)),
+            ("cbf", lambda: ContentBasedFiltering(restaurants, users, train_reviews)),
+            ("mf", lambda: MatrixFactorization(restaurants, users, train_reviews, factors=factors))
+    ):
+        start = time.perf_counter()
+        model = fit()
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predictions = model.predict_stars_batch(user_ids, restaurant_ids, k)
+        batch_seconds = time.perf_counter() - start
+        # Single predictions of unknown users or restaurants raise (or return None) in some models, so skip those
+        start = time.perf_counter()
+        for i in samples:
+            try:
+                model.predict_stars(user_ids[i], restaurant_ids[i], k)
+            except KeyError:
+                pass
+        single_seconds = time.perf_counter() - start
+
+        predicted = ~np.isnan(predictions)
+        results[name] = {
+            "fit_seconds": fit_seconds,
+            "batch_predictions_per_second": stars.size / batch_seconds,
+            "single_prediction_ms": 1000 * single_seconds / max(1, samples.size),
+            "rmse": float(np.sqrt(np.mean((predictions[predicted] - stars[predicted]) ** 2))),
+            "coverage": float(predicted.mean())
+        }
+    return pd.DataFrame(results).transpose()
+
+
+def compare_user_ann(restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame, k: int = 20,
+                     probes: Sequence[int] = (4, 8, 16), lists: Optional[int] = None,
+                     queries: int = 500, seed: int = 0) -> pd.DataFrame:
+    """
+    Compare exact and approximate (inverted file index with each number of probes, see CosineIVF) user-user lookups in
+    CollaborativeFiltering: fit time, the time of user_user for a seeded sample of users, and the recall of the exact
+    top-k similar users.
+    """
+    sample = np.random.default_rng(seed).choice(reviews["user_id"].unique(), queries, replace=False)
+    results: Dict[str, Dict[str, float]] = {}
+    exact: Dict[str, set] = {}
+    for name, kwargs in [("exact", {})] + [
+        (f"ivf-{n_probes}", dict(user_ann_probes=n_probes, user_ann_lists=lists)) for n_probes in probes
+    ]:
+        start = time.perf_counter()
+        model = CollaborativeFiltering(restaurants, users, reviews, **kwargs)
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        similar = {user_id: set(model.user_user(user_id, k)["user_id"]) for user_id in sample}
+        query_seconds = time.perf_counter() - start
+        if name == "exact":
+            exact = similar
+        results[name] = {
+            "fit_seconds": fit_seconds,
+            "query_ms": 1000 * query_seconds / queries,
+            "recall": float(np.mean([len(similar[u] & exact[u]) / max(1, len(exact[u])) for u in sample]))
+        }
+    return pd.DataFrame(results).transpose()
+
+
+# %%
+def peak_rss_mib() -> Optional[float]:
+    # The peak resident set size of this process (None where the resource module is unavailable, e.g. Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def scaling_run(recommender: str, scale: int, base_size: Tuple[int, int, int] = BASE_SIZE, queries: int = 100,
+                k: Optional[int] = 40, count: int = 10, seed: int = 0, options: Optional[Dict[str, Any]] = None,
+                memory_limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Generate synthetic data at scale times base_size (see rs_synthetic), fit a recommender (of SCALING_RECOMMENDERS,
+    with options) and time its operations on a seeded sample of queries, returning the timings (mean milliseconds
+    per call) and the peak RSS. Run in a fresh process (see benchmark_scaling), so the peak RSS is the run's own.
+    With memory_limit (MiB) the address space is limited so running out of memory raises a MemoryError.
+    """
+    if memory_limit is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit * 2 ** 20, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    result: Dict[str, Any] = {"recommender": recommender, "scale": scale}
+    try:
+        start = time.perf_counter()
+        restaurants, users, reviews = make_synthetic_data(*(n * scale for n in base_size), seed=seed)
+        result.update(restaurants=restaurants.shape[0], users=users.shape[0], reviews=reviews.shape[0],
+                      generate_seconds=time.perf_counter() - start, data_rss_mib=peak_rss_mib())
+
+        recommender_class, operations = SCALING_RECOMMENDERS[recommender]
+        start = time.perf_counter()
+        model = recommender_class(restaurants, users, reviews, **(options or {}))
+        result["fit_seconds"] = time.perf_counter() - start
+
+        rng = np.random.default_rng(seed)
+        restaurant_ids = rng.choice(restaurants.index.to_numpy(), queries)
+        user_ids = rng.choice(users.index.to_numpy(), queries)
+        pairs = reviews.iloc[rng.choice(reviews.shape[0], queries)]
+        calls: Dict[str, Callable[[int], Any]] = {
+            "item_item": lambda i: model.item_item(restaurant_ids[i], count),
+            "user_user": lambda i: model.user_user(user_ids[i], count),
+            "predict_stars": lambda i: model.predict_stars(pairs["user_id"].iat[i], pairs["business_id"].iat[i], k),
+            "recommend_user": lambda i: model.recommend_user(user_ids[i], count)
+        }
+        for operation in operations:
+            start = time.perf_counter()
+            for i in range(queries):
+                calls[operation](i)
+            result[f"{operation}_ms"] = 1000 * (time.perf_counter() - start) / queries
+    except MemoryError:
+        result["error"] = "MemoryError"
+    result["peak_rss_mib"] = peak_rss_mib()
+    return result
+
+
+def benchmark_scaling(recommenders: Sequence[str] = tuple(SCALING_RECOMMENDERS), scales: Sequence[int] = SCALES,
+                      base_size: Tuple[int, int, int] = BASE_SIZE, queries: int = 100, k: Optional[int] = 40,
+                      seed: int = 0, options: Optional[Dict[str, Dict[str, Any]]] = None,
+                      memory_limit: Optional[int] = None, output_path: Optional[Path] = None) -> pd.DataFrame:
+    """
+    Run scaling_run for each recommender at each scale (ascending), each in a fresh process, skipping the larger
+    scales of a recommender once a run fails (by a MemoryError, or the process dying, e.g. killed out of memory).
+    options maps recommender names to their constructor options. If output_path is given the settings, platform and
+    results are written to it as JSON, so runs can be compared.
+    """
+    options = options or {}
+    results: List[Dict[str, Any]] = []
+    for recommender in recommenders:
+        for scale in sorted(scales):
+            if results and results[-1]["recommender"] == recommender and "error" in results[-1]:
+                results.append({"recommender": recommender, "scale": scale, "error": "skipped"})
+                continue
+            print(f"Benchmarking {recommender} at scale {scale}...")
+            try:
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                    results.append(executor.submit(scaling_run, recommender, scale, base_size, queries, k, 10, seed,
+                                                   options.get(recommender), memory_limit).result())
+            except BrokenProcessPool:
+                results.append({"recommender": recommender, "scale": scale, "error": "process died"})
+
+    if output_path is not None:
+        output_path.write_text(json.dumps({
+            "settings": {"base_size": list(base_size), "queries": queries, "k": k, "seed": seed, "options": options,
+                         "memory_limit": memory_limit},
+            "platform": {"python": platform.python_version(), "machine": platform.machine(),
+                         "system": platform.platform(), "numpy": np.__version__, "pandas": pd.__version__},
+            "results": results
+        }, indent=2))
+    return pd.DataFrame(results).set_index(["recommender", "scale"])
+
+
+# %%
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the recommenders.")
+    parser.add_argument("suite", nargs="?", choices=("data", "scaling"), default="data",
+                        help="benchmark the model variants on the preprocessed data, or the scaling on synthetic data")
+    parser.add_argument("--recommenders", nargs="+", choices=tuple(SCALING_RECOMMENDERS),
+                        default=tuple(SCALING_RECOMMENDERS), help="recommenders of the scaling benchmark")
+    parser.add_argument("--scales", nargs="+", type=int, default=SCALES, help="scales of the scaling benchmark")
+    parser.add_argument("--base-size", nargs=3, type=int, default=BASE_SIZE,
+                        metavar=("RESTAURANTS", "USERS", "REVIEWS"), help="synthetic data size at scale 1")
+    parser.add_argument("--queries", type=int, default=100, help="number of timed calls of each operation")
+    parser.add_argument("--neighbours", type=int, default=None,
+                        help="use top-k item similarity indices with this many neighbours in CF and CBF")
+    parser.add_argument("--memory-limit", type=int, default=None, help="address space limit of each run (MiB)")
+    parser.add_argument("--output", type=Path, default=Path("scaling.json"), help="JSON results file")
+    args = parser.parse_args()
+
+    if args.suite == "scaling":
+        options = {} if args.neighbours is None else {"cf": {"item_neighbours": args.neighbours},
+                                                      "cbf": {"neighbours": args.neighbours}}
+        with pd.option_context("display.max_columns", None, "display.width", 0):
+            print(benchmark_scaling(args.recommenders, args.scales, tuple(args.base_size), args.queries,
+                                    options=options, memory_limit=args.memory_limit, output_path=args.output))
+        return 0
+
+    from rs_data import load_data
+
+    data = load_data()
+    print(compare_item_similarity(*data))
+    print(compare_table_loading())
+    print(compare_rating_models(*data))
+    print(compare_user_ann(*data))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
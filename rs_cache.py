@@ -0,0 +1,101 @@
+# %%
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+
+ENTRY_OVERHEAD = 200  # Approximate bytes of bookkeeping per cache entry (dictionary slots, links and the key tuple)
+
+
+# %%
+def value_nbytes(value: Any) -> int:
+    # Approximate memory used by a cached value (or key)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(value_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache bounded by its number of entries and (approximate) bytes, evicting the
+    least recently used entries when either bound is exceeded (a bound of None is unlimited).
+    Keys are tuples whose first element is a group (e.g. a user ID), so all entries of a group can be invalidated.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_entries: Optional[int] = max_entries
+        self.max_bytes: Optional[int] = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.nbytes: int = 0
+        self.__entries: "OrderedDict[Tuple, Tuple[Any, int]]" = OrderedDict()
+        self.__groups: Dict[Hashable, Set[Tuple]] = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self.__entries
+
+    def get(self, key: Tuple, default: Any = None) -> Any:
+        # Get a value (marking it most recently used), counting a hit or a miss
+        with self.__lock:
+            if (entry := self.__entries.get(key)) is None:
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple, value: Any):
+        # Add or replace a value, then evict the least recently used entries until within the bounds
+        nbytes = ENTRY_OVERHEAD + value_nbytes(key) + value_nbytes(value)
+        if (self.max_entries is not None and self.max_entries < 1) or \
+                (self.max_bytes is not None and nbytes > self.max_bytes):
+            return
+        with self.__lock:
+            self.__remove(key)
+            self.__entries[key] = (value, nbytes)
+            self.__groups.setdefault(key[0], set()).add(key)
+            self.nbytes += nbytes
+            while (self.max_entries is not None and len(self.__entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def __remove(self, key: Tuple):
+        if (entry := self.__entries.pop(key, None)) is not None:
+            self.nbytes -= entry[1]
+            group = self.__groups[key[0]]
+            group.discard(key)
+            if not group:
+                del self.__groups[key[0]]
+
+    def invalidate(self, group: Hashable) -> int:
+        # Remove all entries of a group, returning how many were removed
+        with self.__lock:
+            keys = list(self.__groups.get(group, ()))
+            for key in keys:
+                self.__remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__groups.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        # The cache size, bounds and hit, miss and eviction counters
+        lookups = self.hits + self.misses
+        return {"entries": len(self.__entries), "bytes": self.nbytes, "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None, "evictions": self.evictions}
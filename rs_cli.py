@@ -1,7 +1,14 @@
+import argparse
+import functools
 import sys
-from typing import Optional, Tuple, List
+from pathlib import Path
+from typing import Callable, Optional, Tuple, List
+from rs_base import ReviewIndex
 from rs_hybrid import HybridRecommenderSystem
 from rs_data import load_data
+from rs_artifacts import model_path, temporary_directory, replace_directory
+import pandas as pd
+import rs_stats
 
 __version__ = "1.0.0"
 __author__ = "wcrr51"
@@ -31,8 +38,15 @@ def print_help():
     print("userid\t- get the current user ID")
     print("userid <id>\t- set the selected user ID to <id>")
     print("recommendations <count>\t- get <count> recommendations for the current user")
+    print("location\t- get the current location used to limit recommendations")
+    print("location <latitude> <longitude> <radius>\t- only recommend restaurants within <radius> km of a location")
+    print("location off\t- recommend restaurants at any location")
     print("takeaway-only\t- get whether only restaurants offering takeaway or delivery are shown")
     print("takeaway-only <off/on>\t- set whether only restaurants offering takeaway or delivery are shown")
+    print("stats\t- show the timing statistics of the recommender stages and the cache statistics")
+    print("stats <on/off>\t- enable or disable recording timing statistics")
+    print("stats reset\t- clear the timing statistics")
+    print("stats dump <file>\t- write the timing statistics to a JSON file")
     print("info\t- show system information")
     print("privacy\t- show privacy and data usage information")
     print("exit\t- exit the program")
@@ -67,9 +81,57 @@ def isint(value):
         return False
 
 
+def load_model(model_root: Optional[Path] = None, mmap_mode: Optional[str] = None,
+               data: Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]] = None) -> HybridRecommenderSystem:
+    # Fit or load the model on data (the restaurants, users and reviews tables), loading the tables if not given
+    data = load_data() if data is None else data
+    if model_root is None:
+        return HybridRecommenderSystem(*data)
+
+    # Load the model artifacts for the current data if they exist, otherwise fit and save them
+    path = model_path(model_root)
+    if path.exists():
+        print(f"Loading model from '{path}'...")
+        return HybridRecommenderSystem.load(path, *data, mmap_mode=mmap_mode)
+    rs = HybridRecommenderSystem(*data)
+    print(f"Saving model to '{path}'...")
+    rs.save(temporary_path := temporary_directory(path))
+    replace_directory(temporary_path, path)
+    # Reload the saved model so its arrays are memory-mapped
+    return rs if mmap_mode is None else HybridRecommenderSystem.load(path, *data, mmap_mode=mmap_mode)
+
+
+def mmap_model_loader(model_root: Path) -> Callable[[], HybridRecommenderSystem]:
+    """
+    Load the data tables and build the review index once, fitting and saving the model if it is not saved yet.
+    Returns a loader for worker processes (see rs_parallel.model_pool) which memory-maps the saved model with those
+    tables, so forked workers share the tables and review index (inherited copy-on-write) as well as the model
+    arrays (through the page cache), rather than each loading their own copy.
+    """
+    data = load_data()
+    if not (path := model_path(model_root)).exists():
+        load_model(model_root, data=data)
+    return functools.partial(HybridRecommenderSystem.load, path, *data, ReviewIndex(data[2]), "r")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Hybrid restaurant recommender system.")
+    parser.add_argument("--model-dir", type=Path, default=None,
+                        help="directory of saved models, used (and populated) to avoid refitting on startup")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory-map the saved model arrays (read-only) instead of reading them into memory")
+    parser.add_argument("--stats", action="store_true",
+                        help="record timing statistics of the recommender stages (see the stats command)")
+    return parser.parse_args()
+
+
 def main() -> int:
+    args = parse_args()
+    if args.stats:
+        rs_stats.enable()
+
     print("Loading data...")
-    rs = HybridRecommenderSystem(*load_data())
+    rs = load_model(args.model_dir, "r" if args.mmap and args.model_dir is not None else None)
     print("Done")
 
     # Output program and privacy information
@@ -81,7 +143,7 @@ def main() -> int:
 
     print("Type 'help' for a list of available commands.")
     user = rs.get_user_by_id("qmcTQ4RSOnKqW5eqc1CEfw")
-    # location = None
+    location: Optional[Tuple[float, float, float]] = None
     takeaway_only = True
 
     while True:
@@ -103,6 +165,24 @@ def main() -> int:
                 print("Invalid number of arguments, usages:")
                 print("userid")
                 print("userid <id>")
+        elif command == "location":
+            if len(args) == 0:
+                print("Location: {0:.5f}, {1:.5f} (radius {2:g} km)".format(*location)
+                      if location is not None else "No location set.")
+            elif len(args) == 1 and args[0] == "off":
+                location = None
+                print("Cleared location.")
+            elif len(args) == 3:
+                if not all(isfloat(arg) for arg in args) or float(args[2]) <= 0:
+                    print("<latitude> and <longitude> must be numbers and <radius> must be a positive number.")
+                    continue
+                location = float(args[0]), float(args[1]), float(args[2])
+                print(f"Set location to {location[0]:.5f}, {location[1]:.5f} (radius {location[2]:g} km)")
+            else:
+                print("Invalid number of arguments, usages:")
+                print("location")
+                print("location <latitude> <longitude> <radius>")
+                print("location off")
         elif command == "takeaway_only":
             if len(args) == 0:
                 print("Takeaway only is enabled." if takeaway_only else "Takeaway only is disabled.")
@@ -133,7 +213,8 @@ def main() -> int:
                 continue
 
             # Call to recommender system to get recommendations
-            recommendations = rs.recommend_user(user.name, count)
+            recommendations = rs.recommend_user(user.name, count) if location is None else \
+                rs.recommend_user(user.name, count, location[:2], location[2])
 
             # Format recommendations into a user-friendly table
             recommendation_strings = [(
@@ -145,6 +226,10 @@ def main() -> int:
                 "[✔] delivery or takeaway" if res["delivery_takeaway"] else "[✘] delivery or takeaway"
             ) for i, (res_id, _, score, star_prediction) in enumerate(recommendations.itertuples())
                 if (res := rs.get_restaurant_by_id(res_id))["delivery_takeaway"]]
+            # A small radius (or few similar restaurants) can leave nothing to recommend
+            if not recommendation_strings:
+                print("No recommendations found.")
+                continue
             string_lengths = [[len(part) for part in parts] for parts in recommendation_strings]
             s_p, s_n, s_c, s_st, s_si, s_sp, s_d = [max(string_lengths, key=lambda r: r[i])[i] for i in range(7)]
             print(f"Top {count} recommendations for '{user.name}' ({user['name']}):")
@@ -153,6 +238,33 @@ def main() -> int:
                     f"{pos:>{s_p}}: {name:{s_n}} [{city:{s_c}} {state:>{s_st}}] "
                     f"{score:{s_si}}-score, {star_prediction:{s_sp}}-stars, {d_t:{s_d}}"
                 )
+        elif command == "stats":
+            if len(args) == 0:
+                with pd.option_context("display.max_rows", None, "display.width", 0, "display.precision", 3):
+                    if (stats := rs_stats.table()).empty:
+                        print("No timing statistics recorded." if rs_stats.is_enabled() else
+                              "No timing statistics recorded, enable them with 'stats on'.")
+                    else:
+                        print(stats)
+                    print(rs.cache_stats())
+            elif len(args) == 1 and args[0] in ("on", "off"):
+                rs_stats.enable(args[0] == "on")
+                print("Enabled timing statistics." if args[0] == "on" else "Disabled timing statistics.")
+            elif len(args) == 1 and args[0] == "reset":
+                rs_stats.reset()
+                print("Cleared timing statistics.")
+            elif len(args) == 2 and args[0] == "dump":
+                try:
+                    rs_stats.dump(Path(args[1]))
+                    print(f"Wrote timing statistics to '{args[1]}'")
+                except OSError as error:
+                    print(f"Could not write '{args[1]}': {error}")
+            else:
+                print("Invalid arguments, usages:")
+                print("stats")
+                print("stats <on/off>")
+                print("stats reset")
+                print("stats dump <file>")
         elif command == "help":
             print_help()
         elif command == "info":
@@ -1,19 +1,27 @@
 # %%
-from typing import Union, List, Tuple, Optional, Dict
+from pathlib import Path
+from typing import Union, List, Tuple, Optional, Sequence, Callable
 import pandas as pd
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
 from scipy.sparse import csr_matrix
 from pandas.api.types import CategoricalDtype
-from rs_base import RecommenderBase
+from rs_base import RecommenderBase, ReviewIndex
+from rs_artifacts import save_meta, load_meta, save_array, load_array, save_ids, load_ids, save_csr, load_csr
+from rs_similarity import NeighbourIndex, CosineIVF, BATCH_ENTRIES, block_rows, top_k_columns, top_k_batch
+from rs_stats import timed
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 
 # %%
 class CollaborativeFiltering(RecommenderBase):
+    @timed
     def __init__(self, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
-                 review_dict: Optional[Dict[str, str]] = None):
-        super().__init__(restaurants, users, reviews, review_dict)
+                 review_index: Optional[ReviewIndex] = None, item_neighbours: Optional[int] = None,
+                 item_similarity_floor: Optional[float] = None, user_neighbours: Optional[int] = None,
+                 user_ann_probes: Optional[int] = None, user_ann_lists: Optional[int] = None):
+        super().__init__(restaurants, users, reviews, review_index)
 
         # Acquire numerical index-based categorical data for users and restaurants (ordered by ID)
         restaurant_categories = CategoricalDtype(sorted(reviews["business_id"].unique()), ordered=True)
@@ -28,45 +36,265 @@ class CollaborativeFiltering(RecommenderBase):
             shape=(user_categories.categories.size, restaurant_categories.categories.size)
         )
 
+        self.__set_maps(restaurant_categories.categories, user_categories.categories)
+        self.__set_item_norms()
+
+        self.__item_neighbours: Optional[int] = item_neighbours
+        self.__item_similarity_floor: Optional[float] = item_similarity_floor
+        self.__item_matrix: Optional[np.ndarray] = None
+        self.__item_index: Optional[NeighbourIndex] = None
+        if item_neighbours is None:
+            # Item similarity matrix
+            self.__item_matrix = cosine_similarity(self.__sparse_matrix.transpose())
+            np.fill_diagonal(self.__item_matrix, 0.0)
+        else:
+            # Sparse item similarity index holding only the top item_neighbours neighbours of each restaurant
+            item_vectors: csr_matrix = normalize(self.__sparse_matrix.transpose().tocsr())
+            self.__item_index = NeighbourIndex.build(
+                lambda start, stop: (item_vectors[start:stop] @ item_vectors.transpose()).toarray(),
+                (item_vectors.shape[0], item_vectors.shape[0]),
+                item_neighbours,
+                item_similarity_floor
+            )
+
+        # Optionally find similar users approximately with an inverted file index (see CosineIVF), probing
+        # user_ann_probes of its user_ann_lists lists (by default about the square root of the number of users)
+        self.__user_ann_probes: Optional[int] = user_ann_probes
+        self.__user_ann_lists: Optional[int] = user_ann_lists
+        self.__fit_user_model()
+
+        self.__user_neighbours: int = 0
+        self.__user_graph: Optional[NeighbourIndex] = None
+        if user_neighbours is not None:
+            # Precompute the top user_neighbours neighbours of every user from the row-normalised rating matrix
+            user_vectors: csr_matrix = normalize(self.__sparse_matrix)
+            self.__user_graph = NeighbourIndex.build(
+                lambda start, stop: (user_vectors[start:stop] @ user_vectors.transpose()).toarray(),
+                (user_vectors.shape[0], user_vectors.shape[0]),
+                user_neighbours
+            )
+            self.__user_neighbours = min(user_neighbours, user_vectors.shape[0] - 1)
+
+    def __set_maps(self, restaurant_ids: Sequence[str], user_ids: Sequence[str]):
         # Create a set of maps from IDs to indices and indices to IDs for users and restaurants
-        self.__restaurant_map = dict(enumerate(restaurant_categories.categories))
+        self.__restaurant_map = dict(enumerate(restaurant_ids))
         self.__restaurant_index_map = {v: k for k, v in self.__restaurant_map.items()}
-        self.__user_map = dict(enumerate(user_categories.categories))
+        self.__user_map = dict(enumerate(user_ids))
         self.__user_index_map = {v: k for k, v in self.__user_map.items()}
 
-        # Item similarity matrix
-        self.__item_matrix: np.array = cosine_similarity(self.__sparse_matrix.transpose())
-        np.fill_diagonal(self.__item_matrix, 0.0)
+    def __set_item_norms(self):
+        # Squared norms of the restaurant rating vectors (kept as running sums as reviews are added)
+        self.__item_norms_squared = np.asarray(self.__sparse_matrix.multiply(self.__sparse_matrix).sum(axis=0)).ravel()
 
+    def __fit_user_model(self, user_ann: Optional[CosineIVF] = None):
         # # Create and fit a scikit-learn NearestNeighbors model to the sparse matrix using cosine similarity
         self.__nn_user = NearestNeighbors(metric="cosine", algorithm="brute")
         self.__nn_user.fit(self.__sparse_matrix)
+        # Fit the approximate index (unless a saved or updated one is given)
+        self.__user_ann: Optional[CosineIVF] = user_ann if user_ann is not None or self.__user_ann_probes is None \
+            else CosineIVF(self.__sparse_matrix, self.__user_ann_lists, self.__user_ann_probes)
+
+    def save(self, path: Path):
+        # Save the rating matrix, ID maps and similarity structures as arrays in the directory path
+        save_meta(path, "CollaborativeFiltering", item_index=self.__item_index is not None,
+                  item_neighbours=self.__item_neighbours, item_similarity_floor=self.__item_similarity_floor,
+                  user_neighbours=self.__user_neighbours, user_ann_probes=self.__user_ann_probes,
+                  user_ann_lists=self.__user_ann_lists)
+        save_csr(path, "ratings", self.__sparse_matrix)
+        save_ids(path, "restaurant_ids", self.restaurant_ids)
+        save_ids(path, "user_ids", [self.__user_map[i] for i in range(len(self.__user_map))])
+        if self.__item_index is not None:
+            self.__item_index.save(path, "item_index")
+        else:
+            save_array(path, "item_matrix", self.__item_matrix)
+        if self.__user_graph is not None:
+            self.__user_graph.save(path, "user_graph")
+        if self.__user_ann is not None:
+            self.__user_ann.save(path, "user_ann")
+
+    @classmethod
+    @timed
+    def load(cls, path: Path, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+             review_index: Optional[ReviewIndex] = None, mmap_mode: Optional[str] = None) \
+            -> "CollaborativeFiltering":
+        """
+        Create a recommender from saved artifacts (see save) without refitting.
+        With mmap_mode="r" the model arrays are read-only memory-mapped views, shared between processes.
+        """
+        meta = load_meta(path, "CollaborativeFiltering")
+        recommender: CollaborativeFiltering = cls.__new__(cls)
+        RecommenderBase.__init__(recommender, restaurants, users, reviews, review_index)
+
+        recommender.__sparse_matrix = load_csr(path, "ratings", mmap_mode)
+        recommender.__set_maps(load_ids(path, "restaurant_ids").tolist(), load_ids(path, "user_ids").tolist())
+        recommender.__set_item_norms()
+        recommender.__item_neighbours = meta.get("item_neighbours")
+        recommender.__item_similarity_floor = meta.get("item_similarity_floor")
+        recommender.__item_matrix = None if meta["item_index"] else load_array(path, "item_matrix", mmap_mode)
+        recommender.__item_index = NeighbourIndex.load(path, "item_index", mmap_mode) if meta["item_index"] else None
+        recommender.__user_ann_probes = meta.get("user_ann_probes")
+        recommender.__user_ann_lists = meta.get("user_ann_lists")
+        recommender.__fit_user_model(CosineIVF.load(path, "user_ann", recommender.__sparse_matrix, mmap_mode)
+                                     if recommender.__user_ann_probes is not None else None)
+        recommender.__user_neighbours = meta["user_neighbours"]
+        recommender.__user_graph = NeighbourIndex.load(path, "user_graph", mmap_mode) \
+            if meta["user_neighbours"] else None
+        return recommender
+
+    @timed
+    def add_reviews(self, reviews: pd.DataFrame, users: Optional[pd.DataFrame] = None,
+                    restaurants: Optional[pd.DataFrame] = None, review_index: Optional[ReviewIndex] = None):
+        """
+        Add reviews (with any new or updated users and restaurants) without a full refit. New users and restaurants
+        are appended to the index maps, and only the similarities of the restaurants (and users) whose ratings changed
+        are recomputed. A review of an already-reviewed restaurant replaces the user's previous rating. The approximate
+        user index keeps its lists (see CosineIVF.update), which are only re-clustered by a full refit.
+        review_index may be given if it has already been extended with the reviews (e.g. when shared).
+        """
+        self._add_data(reviews, users, restaurants, review_index)
+        reviews = reviews.drop_duplicates(["user_id", "business_id"], keep="last")
+
+        # Append the new users and restaurants to the index maps
+        n_restaurants = self.__sparse_matrix.shape[1]
+        new_user_ids = np.sort(reviews.loc[~reviews["user_id"].isin(self.__user_index_map), "user_id"].unique())
+        new_restaurant_ids = np.sort(
+            reviews.loc[~reviews["business_id"].isin(self.__restaurant_index_map), "business_id"].unique()
+        )
+        self.__set_maps([*self.__restaurant_map.values(), *new_restaurant_ids],
+                        [*self.__user_map.values(), *new_user_ids])
+        shape = (len(self.__user_map), len(self.__restaurant_map))
+        rows = reviews["user_id"].map(self.__user_index_map).to_numpy(dtype=np.int64)
+        columns = reviews["business_id"].map(self.__restaurant_index_map).to_numpy(dtype=np.int64)
+        ratings = reviews["rating"].to_numpy(dtype=np.float64)
+
+        # Replace the ratings of reviewed pairs and add the new ones (keeping explicit zero ratings)
+        matrix = self.__sparse_matrix.tocoo()
+        replaced = np.isin(matrix.row.astype(np.int64) * shape[1] + matrix.col, rows * shape[1] + columns)
+        self.__sparse_matrix = csr_matrix((
+            np.concatenate((matrix.data[~replaced], ratings)),
+            (np.concatenate((matrix.row[~replaced], rows)), np.concatenate((matrix.col[~replaced], columns)))
+        ), shape=shape)
+        # Update the running squared norms of the restaurant rating vectors
+        norms_squared = np.zeros(shape[1])
+        norms_squared[:n_restaurants] = self.__item_norms_squared
+        np.subtract.at(norms_squared, matrix.col[replaced], matrix.data[replaced] ** 2)
+        np.add.at(norms_squared, columns, ratings ** 2)
+        self.__item_norms_squared = np.maximum(norms_squared, 0.0)
+
+        # Recompute the similarities of the changed restaurants
+        changed = np.unique(columns)
+        item_similarities = self.__item_similarities()
+        if self.__item_index is not None:
+            k = self.__item_neighbours or int(np.diff(self.__item_index.indptr).max(initial=1))
+            self.__item_index = self.__item_index.update(
+                changed, item_similarities, shape[1], k, self.__item_similarity_floor
+            )
+        else:
+            item_matrix = np.zeros((shape[1], shape[1]))
+            item_matrix[:n_restaurants, :n_restaurants] = self.__item_matrix
+            step = block_rows((changed.size, shape[1]))
+            for start in range(0, changed.size, step):
+                block = changed[start:start + step]
+                item_matrix[block] = similarities = item_similarities(block)
+                item_matrix[:, block] = similarities.transpose()
+            item_matrix[changed, changed] = 0.0
+            self.__item_matrix = item_matrix
+
+        # Assign the users who added reviews to the existing lists of the approximate index (without re-clustering)
+        self.__fit_user_model(None if self.__user_ann is None else
+                              self.__user_ann.update(self.__sparse_matrix, np.unique(rows)))
+        if self.__user_graph is not None:
+            # Recompute the neighbours of the users who added reviews
+            user_vectors: csr_matrix = normalize(self.__sparse_matrix)
+            self.__user_graph = self.__user_graph.update(
+                np.unique(rows), lambda block: (user_vectors[block] @ user_vectors.transpose()).toarray(),
+                shape[0], self.__user_neighbours
+            )
+
+    def __item_similarities(self) -> Callable[[np.ndarray], np.ndarray]:
+        # Create a function giving the cosine similarities of restaurants to every restaurant, using the running norms
+        # (zero for restaurants without ratings)
+        ratings = self.__sparse_matrix.tocsc()
+        norms = np.sqrt(self.__item_norms_squared)
+
+        def item_similarities(items: np.ndarray) -> np.ndarray:
+            dots = (ratings[:, items].transpose() @ ratings).toarray()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.nan_to_num(dots / np.outer(norms[items], norms), nan=0.0, posinf=0.0, neginf=0.0)
+        return item_similarities
 
     def reviewed(self, user: Union[str, int], restaurant: Union[str, int]):
         user_id = user if type(user) is str else self.__user_map[user]
         restaurant_id = restaurant if type(restaurant) is str else self.__restaurant_map[restaurant]
         return super().reviewed(user_id, restaurant_id)
 
-    def __get_similar_items(self, index: int, k: int):
+    def __get_similar_items(self, index: int, k: int, candidates: Optional[np.ndarray] = None):
+        if self.__item_index is not None:
+            # Read the (already sorted) k nearest neighbours from the sparse index
+            indices, similarities = self.__item_index.neighbours(index, None if candidates is not None else k)
+            if candidates is not None:
+                # Keep only the neighbours among the candidates
+                in_candidates = np.isin(indices, candidates)
+                indices, similarities = indices[in_candidates][:k], similarities[in_candidates][:k]
+            return list(zip(indices, similarities))
+        if candidates is not None:
+            # Only consider the similarities to the candidates
+            indices, similarities = top_k_columns(self.__item_matrix[np.newaxis, index, candidates], k)
+            return list(zip(candidates[indices[0]], similarities[0]))
         # Calculate the k indices in the similarity matrix with the greatest similarity to index
         return sorted(zip(
             (indices := np.argpartition(self.__item_matrix[index], -k)[-k:]), self.__item_matrix[index, indices]
         ), key=lambda r: r[1], reverse=True)
 
-    def item_item(self, restaurant_id: str, count: int) -> pd.DataFrame:
+    @timed
+    def item_item(self, restaurant_id: str, count: int, candidates: Optional[Sequence[str]] = None) -> pd.DataFrame:
         # Convert restaurant into its matrix index position
         restaurant_index: int = self.__restaurant_index_map[restaurant_id]
+        # Convert the (optional) candidate restaurants into matrix index positions, ignoring unknown IDs
+        candidate_indices: Optional[np.ndarray] = None if candidates is None else \
+            pd.Series(candidates, dtype=object).map(self.__restaurant_index_map).dropna().to_numpy(dtype=np.int64)
 
         # Get the count restaurants with the highest similarity (not including the source restaurant)
         restaurants = map(
             # Map restaurant indices to IDs
             lambda r: (self.__restaurant_map[r[0]], r[1]),
-            self.__get_similar_items(restaurant_index, count)
+            self.__get_similar_items(restaurant_index, count, candidate_indices)
         )
 
         # Return a DataFrame representing the count nearest neighbours
         return pd.DataFrame(restaurants, columns=["business_id", "similarity"])
 
+    @timed
+    def item_item_batch(self, restaurant_ids: Sequence[str], count: int, candidates: Optional[Sequence[str]] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the count most similar restaurants to each of many restaurants in one call (optionally only considering
+        the candidate restaurants). Returns (len(restaurant_ids), count) arrays of restaurant indices (see
+        restaurant_ids) and similarities, sorted by similarity descending and padded with -1 and NaN.
+        """
+        query_indices = pd.Series(restaurant_ids, dtype=object).map(self.__restaurant_index_map) \
+            .fillna(-1).to_numpy(dtype=np.int64)
+        candidate_indices: Optional[np.ndarray] = None if candidates is None else \
+            pd.Series(candidates, dtype=object).map(self.__restaurant_index_map).dropna().to_numpy(dtype=np.int64)
+
+        indices = np.full((query_indices.size, count), -1, dtype=np.int64)
+        similarities = np.full((query_indices.size, count), np.nan)
+        # Unknown restaurant IDs are left as padding
+        known = np.flatnonzero(query_indices >= 0)
+        if self.__item_index is not None:
+            indices[known], similarities[known] = \
+                self.__item_index.neighbours_batch(query_indices[known], count, candidate_indices)
+        else:
+            indices[known], similarities[known] = \
+                top_k_batch(self.__item_matrix, query_indices[known], count, candidate_indices)
+        return indices, similarities
+
+    @property
+    def restaurant_ids(self) -> np.ndarray:
+        # Restaurant IDs ordered by their matrix index
+        return np.array([self.__restaurant_map[i] for i in range(len(self.__restaurant_map))], dtype=object)
+
+    @timed
     def user_user(self, user_id: str, count: int) -> pd.DataFrame:
         # Convert restaurant into its matrix index position
         user_index: int = self.__user_index_map[user_id]
@@ -83,7 +311,17 @@ class CollaborativeFiltering(RecommenderBase):
 
     def __get_similar_users(self, user_index: int, k: int, including_user: bool) -> List[Tuple[int, float]]:
         assert k <= self.get_user_count()
-        return list(map(
+        if k <= self.__user_neighbours:
+            # Slice the precomputed neighbour graph (which never includes the user themselves)
+            similar_users = list(zip(*self.__user_graph.neighbours(user_index, k - 1 if including_user else k)))
+            return [(user_index, 1.0)] + similar_users if including_user else similar_users
+        if self.__user_ann is not None:
+            # Query the approximate index (which never includes the user themselves)
+            indices, similarities = self.__user_ann.query(np.array([user_index]), k - 1 if including_user else k)
+            similar_users = [(index, similarity) for index, similarity in zip(indices[0], similarities[0])
+                             if index >= 0]
+            return [(user_index, 1.0)] + similar_users if including_user else similar_users
+        similar_users = list(map(
             # Map (distance, index) to (index, similarity)
             lambda r: (r[1], 1.0 - r[0]),
             zip(*map(
@@ -93,28 +331,109 @@ class CollaborativeFiltering(RecommenderBase):
                     k if including_user else k + 1
                 )
             ))
-        ))[0 if including_user else 1:]
+        ))
+        if including_user:
+            return similar_users
+        # Remove the user themselves (not necessarily first, as users with the same ratings are at distance zero too)
+        own = [i for i, (index, _) in enumerate(similar_users) if index == user_index]
+        del similar_users[own[0] if own else -1]
+        return similar_users
+
+    def __get_similar_users_batch(self, user_indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if k <= self.__user_neighbours:
+            return self.__user_graph.neighbours_batch(user_indices, k)
+        if self.__user_ann is not None:
+            return self.__user_ann.query(user_indices, k)
+        # Query the k nearest neighbours of many users at once, dropping the users themselves (or the furthest
+        # neighbour where a user is not returned, among other users with the same ratings)
+        distances, indices = self.__nn_user.kneighbors(self.__sparse_matrix[user_indices], k + 1)
+        own = indices == user_indices[:, np.newaxis]
+        own[~own.any(axis=1), -1] = True
+        return indices[~own].reshape(-1, k), 1.0 - distances[~own].reshape(-1, k)
+
+    @timed
+    def predict_stars_batch(self, user_ids: Sequence[str], restaurant_ids: Sequence[str],
+                            k: Optional[int] = None) -> np.ndarray:
+        """
+        Predict the star ratings of many (user, restaurant) pairs, equivalent to calling predict_stars on each pair.
+        Pairs are grouped by user so each user's neighbours are found once, and the neighbour ratings are combined
+        with sparse matrix products. Returns NaN for pairs where predict_stars would return None.
+        """
+        user_ids = np.asarray(user_ids)
+        restaurant_ids = np.asarray(restaurant_ids)
+        predictions = np.full(user_ids.shape[0], np.nan)
+
+        # Convert the user and restaurant IDs to indices (NaN for unknown IDs)
+        user_indices = pd.Series(user_ids).map(self.__user_index_map).to_numpy(dtype=np.float64)
+        restaurant_indices = pd.Series(restaurant_ids).map(self.__restaurant_index_map).to_numpy(dtype=np.float64)
+        known = np.flatnonzero(~(np.isnan(user_indices) | np.isnan(restaurant_indices)))
+        if known.size == 0:
+            return predictions
+        user_indices = user_indices[known].astype(np.int64)
+        restaurant_indices = restaurant_indices[known].astype(np.int64)
+
+        n_users = self.__sparse_matrix.shape[0]
+        k = min(self.get_restaurant_count() - 1 if k is None else k, n_users - 1)
+        # Column-oriented rating and "reviewed" matrices for fast selection of the queried restaurants
+        ratings = self.__sparse_matrix.tocsc()
+        reviewed = ratings.copy()
+        reviewed.data[:] = 1.0
+
+        # Group the pairs by user
+        unique_users, pair_users = np.unique(user_indices, return_inverse=True)
+        order = np.argsort(pair_users, kind="stable")
+        bounds = np.searchsorted(pair_users[order], np.arange(unique_users.size + 1))
+
+        chunk_size = max(1, BATCH_ENTRIES // max(k, self.get_restaurant_count(), 1))
+        for start in range(0, unique_users.size, chunk_size):
+            stop = min(start + chunk_size, unique_users.size)
+            # Pairs belonging to this chunk of users
+            pairs = order[bounds[start]:bounds[stop]]
+            rows = pair_users[pairs] - start
+            columns, pair_columns = np.unique(restaurant_indices[pairs], return_inverse=True)
 
+            # Sparse weight matrix with a row of neighbour similarities for each user in the chunk
+            neighbours, similarities = self.__get_similar_users_batch(unique_users[start:stop], k)
+            valid = neighbours >= 0
+            indptr = np.concatenate(([0], np.cumsum(valid.sum(axis=1))))
+            weights = csr_matrix((similarities[valid], neighbours[valid], indptr), shape=(stop - start, n_users))
+            counts = csr_matrix((np.ones(indptr[-1]), neighbours[valid], indptr), shape=weights.shape)
+
+            # Weighted rating totals and the number of neighbours who reviewed each queried restaurant
+            totals = (weights @ ratings[:, columns]).toarray()[rows, pair_columns]
+            n = (counts @ reviewed[:, columns]).toarray()[rows, pair_columns]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                predictions[known[pairs]] = np.where(n > 0, totals / n, np.nan)
+
+        # Normalise the predictions for the users' average stars
+        predictions[known] += self._users["average_stars"].reindex(user_ids[known]).to_numpy()
+        return predictions
+
+    @timed
     def predict_stars(self, user_id: str, restaurant_id: str, k: Optional[int] = None) -> Optional[float]:
-        # Convert the user and restaurant IDs to indices
-        user_index: int = self.__user_index_map[user_id]
-        restaurant_index: int = self.__restaurant_index_map[restaurant_id]
+        # Convert the user and restaurant IDs to indices (with no prediction for unknown IDs, as in predict_stars_batch)
+        user_index: Optional[int] = self.__user_index_map.get(user_id)
+        restaurant_index: Optional[int] = self.__restaurant_index_map.get(restaurant_id)
+        if user_index is None or restaurant_index is None:
+            return None
         # Get the k most similar users
         similar_users = self.__get_similar_users(user_index, self.get_restaurant_count() - 1 if k is None else k, False)
         # similar_items =
         # self.__get_similar_items(restaurant_index, self.get_restaurant_count() - 1 if k is None else k)
 
-        total = 0
-        n = 0
-        # Calculate totals from the similarities
-        for sim_user_index, similarity in similar_users:
-            if self.reviewed(sim_user_index, restaurant_index):
-                total += similarity * self.__sparse_matrix[sim_user_index, restaurant_index]
-                n += 1
+        if not similar_users:
+            return None
+        # Find which similar users reviewed the restaurant, looking them all up at once
+        neighbours = np.array([index for index, _ in similar_users], dtype=np.int64)
+        similarities = np.array([similarity for _, similarity in similar_users], dtype=np.float64)
+        reviewed = self.reviewed_many([self.__user_map[index] for index in neighbours],
+                                      np.repeat(restaurant_id, neighbours.size))
 
         # If there were no similar users who had reviewed the restaurant, return None
-        if n == 0:
+        if not reviewed.any():
             return None
 
-        # Return the predicted star rating for the restaurant (normalised for the user's average stars)
-        return total / n + self._users["average_stars"].loc[user_id]
+        # Return the similarity weighted rating total over the number of reviewers (normalised for the user's average
+        # stars)
+        ratings = self.__sparse_matrix[neighbours[reviewed], restaurant_index].toarray().ravel()
+        return np.sum(similarities[reviewed] * ratings) / reviewed.sum() + self._users["average_stars"].loc[user_id]
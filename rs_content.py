@@ -1,48 +1,223 @@
 # %%
-from typing import Optional, Union, Dict
+from pathlib import Path
+from typing import Optional, Union, Sequence, Tuple
 import pandas as pd
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel, cosine_similarity
-from rs_base import RecommenderBase
+from sklearn.metrics.pairwise import linear_kernel
+from sklearn.preprocessing import normalize
+from rs_base import RecommenderBase, ReviewIndex, updated_table
+from rs_artifacts import save_meta, load_meta, save_array, load_array, save_ids, load_ids, save_csr, load_csr
+from rs_similarity import NeighbourIndex, top_k_batch, block_rows, BATCH_ENTRIES
+from rs_stats import timed
+
+
+# %%
+def tf_idf_vectorizer(vocabulary: Optional[Sequence[str]] = None) -> TfidfVectorizer:
+    # TF-IDF model of the restaurant categories (with a fixed vocabulary when restoring a fitted model)
+    return TfidfVectorizer(
+        analyzer="word",
+        ngram_range=(1, 3),
+        min_df=0,
+        stop_words="english",
+        vocabulary=None if vocabulary is None else {term: i for i, term in enumerate(vocabulary)}
+    )
 
 
 # %%
 class ContentBasedFiltering(RecommenderBase):
+    @timed
     def __init__(self, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
-                 review_dict: Optional[Dict[str, str]] = None):
-        super().__init__(restaurants, users, reviews, review_dict)
+                 review_index: Optional[ReviewIndex] = None, neighbours: Optional[int] = None,
+                 similarity_floor: Optional[float] = None):
+        super().__init__(restaurants, users, reviews, review_index)
 
         self.index = restaurants["name"].index
 
-        # Fit a TF-IDF model on the names of the restaurants
-        tf_idf_v: TfidfVectorizer = TfidfVectorizer(
-            analyzer="word",
-            ngram_range=(1, 3),
-            min_df=0,
-            stop_words="english"
+        # Fit a TF-IDF model on the names of the restaurants (kept to transform restaurants added later)
+        self.__tf_idf_v: TfidfVectorizer = tf_idf_vectorizer()
+        self.__tf_idf_matrix: csr_matrix = self.__tf_idf_v.fit_transform(restaurants["categories"])
+
+        # Get item profiles for non-text features, and which restaurants are low-rated
+        self.__feature_vectors: np.ndarray
+        self.__low_rated: np.ndarray
+        self.__feature_vectors, self.__low_rated = self.__item_features(restaurants)
+
+        self.__neighbours: Optional[int] = neighbours
+        self.__similarity_floor: Optional[float] = similarity_floor
+        self.similarity_matrix: Optional[np.ndarray] = None
+        self.similarity_index: Optional[NeighbourIndex] = None
+        self.__dropped_neighbours: Optional[np.ndarray] = None
+        if neighbours is None:
+            # Calculate the cosine similarity matrix for the feature phrases
+            self.similarity_matrix = linear_kernel(self.__tf_idf_matrix, self.__tf_idf_matrix)
+
+            # Average the text and the feature vector similarity
+            self.similarity_matrix += self.__feature_vectors @ self.__feature_vectors.transpose()
+            self.similarity_matrix /= 2.0
+
+            # Remove similarities for low-rated restaurants
+            low_rated_indices = np.flatnonzero(self.__low_rated)
+            self.similarity_matrix[np.ix_(low_rated_indices, low_rated_indices)] = 0.0
+
+            # Set diagonals to 0
+            np.fill_diagonal(self.similarity_matrix, 0.0)
+        else:
+            # Compute the same blended similarity one block of rows at a time, keeping the top neighbours of each
+            self.similarity_index = NeighbourIndex.build(
+                lambda start, stop: self.__similarity_rows(np.arange(start, stop)),
+                (self.index.size, self.index.size),
+                neighbours,
+                similarity_floor
+            )
+
+        # User profiles: a sparse user by restaurant matrix of normalised ratings (ordered by user ID)
+        self.__user_index: pd.Index = pd.Index(sorted(reviews["user_id"].unique()))
+        row = self.__user_index.get_indexer(reviews["user_id"])
+        col = self.index.get_indexer(reviews["business_id"])
+        self.__user_profiles: csr_matrix = csr_matrix(
+            (reviews["rating"].to_numpy(dtype=np.float64)[col >= 0], (row[col >= 0], col[col >= 0])),
+            shape=(self.__user_index.size, self.index.size)
         )
-        tf_idf_matrix: csr_matrix = tf_idf_v.fit_transform(restaurants["categories"])
-        del tf_idf_v
 
-        # Calculate the cosine similarity matrix for the feature phrases
-        self.similarity_matrix: np.ndarray = linear_kernel(tf_idf_matrix, tf_idf_matrix)
-        del tf_idf_matrix
+    @staticmethod
+    def __item_features(restaurants: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        # Normalised non-text feature vectors (so their products are cosine similarities) and the low-rated mask
+        feature_vectors = normalize(restaurants[["latitude", "longitude", "delivery_takeaway"]].to_numpy(dtype=float))
+        return feature_vectors, ~(restaurants["average_stars"] > 3).to_numpy()
+
+    def __similarity_rows(self, rows: np.ndarray) -> np.ndarray:
+        # Blended text and feature similarities of the given restaurant positions to every restaurant
+        block = (self.__tf_idf_matrix[rows] @ self.__tf_idf_matrix.transpose()).toarray()
+        block += self.__feature_vectors[rows] @ self.__feature_vectors.transpose()
+        block /= 2.0
+        # Remove similarities between the low-rated restaurants among rows and all other low-rated ones
+        block[np.ix_(np.flatnonzero(self.__low_rated[rows]), np.flatnonzero(self.__low_rated))] = 0.0
+        return block
+
+    @timed
+    def add_restaurants(self, restaurants: pd.DataFrame):
+        """
+        Add new restaurants to the catalogue without a refit. Their categories are transformed with the fitted TF-IDF
+        vocabulary (so terms not in it are ignored until the next full fit), and only their similarities to the
+        catalogue are computed.
+        """
+        if (existing := restaurants.index.isin(self.index)).any():
+            raise ValueError(f"Restaurants {list(restaurants.index[existing])} are already in the catalogue")
+        self._restaurants = updated_table(self._restaurants, restaurants)
+        n = self.index.size
+        new = np.arange(n, n + restaurants.shape[0])
+        self.index = self.index.append(pd.Index(restaurants.index, name=self.index.name))
+
+        # Transform the new restaurants' features and append them to the (possibly memory-mapped) item profiles
+        feature_vectors, low_rated = self.__item_features(restaurants)
+        self.__tf_idf_matrix = vstack((self.__tf_idf_matrix, self.__tf_idf_v.transform(restaurants["categories"])),
+                                      format="csr")
+        self.__feature_vectors = np.concatenate((self.__feature_vectors, feature_vectors))
+        self.__low_rated = np.concatenate((self.__low_rated, low_rated))
+
+        if self.similarity_index is not None:
+            # Existing similarities are unchanged, so the update merges the new restaurants in exactly
+            self.similarity_index = self.similarity_index.update(
+                new, self.__similarity_rows, self.index.size, self.__neighbours, self.__similarity_floor
+            )
+        else:
+            similarity_matrix = np.zeros((self.index.size, self.index.size))
+            similarity_matrix[:n, :n] = self.similarity_matrix
+            similarity_matrix[n:] = self.__similarity_rows(new)
+            similarity_matrix[:n, n:] = similarity_matrix[n:, :n].transpose()
+            similarity_matrix[new, new] = 0.0
+            self.similarity_matrix = similarity_matrix
+            self.__dropped_neighbours = None
+
+        # Widen the user profiles to the new restaurants (which have no ratings)
+        self.__user_profiles = csr_matrix(
+            (self.__user_profiles.data, self.__user_profiles.indices, self.__user_profiles.indptr),
+            shape=(self.__user_index.size, self.index.size)
+        )
+
+    @timed
+    def add_reviews(self, reviews: pd.DataFrame, users: Optional[pd.DataFrame] = None,
+                    restaurants: Optional[pd.DataFrame] = None, review_index: Optional[ReviewIndex] = None):
+        """
+        Add reviews (with any new or updated users and restaurants) to the user profiles without a refit. New
+        restaurants are first added to the catalogue (see add_restaurants). A review of an already-reviewed restaurant
+        replaces the user's previous rating.
+        review_index may be given if it has already been extended with the reviews (e.g. when shared).
+        """
+        if restaurants is not None and (new := ~restaurants.index.isin(self.index)).any():
+            self.add_restaurants(restaurants[new])
+        self._add_data(reviews, users, restaurants, review_index)
+        reviews = reviews.drop_duplicates(["user_id", "business_id"], keep="last")
+
+        # Insert the new users into the (ordered) user index, re-coding the existing profile rows
+        user_index = self.__user_index.union(pd.Index(reviews["user_id"].unique()))
+        profiles = self.__user_profiles.tocoo()
+        profile_rows = user_index.get_indexer(self.__user_index)[profiles.row]
+        rows = user_index.get_indexer(reviews["user_id"])
+        columns = self.index.get_indexer(reviews["business_id"])
+        rows, columns, ratings = rows[columns >= 0], columns[columns >= 0], \
+            reviews["rating"].to_numpy(dtype=np.float64)[columns >= 0]
 
-        # Get item profiles for non-text features
-        feature_matrix: np.ndarray = restaurants[["latitude", "longitude", "delivery_takeaway"]].to_numpy()
-        # Average the text and the feature vector similarity
-        self.similarity_matrix += cosine_similarity(feature_matrix)
-        self.similarity_matrix /= 2.0
+        # Replace the ratings of reviewed pairs and add the new ones (keeping explicit zero ratings)
+        n = self.index.size
+        replaced = np.isin(profile_rows.astype(np.int64) * n + profiles.col, rows.astype(np.int64) * n + columns)
+        self.__user_profiles = csr_matrix((
+            np.concatenate((profiles.data[~replaced], ratings)),
+            (np.concatenate((profile_rows[~replaced], rows)), np.concatenate((profiles.col[~replaced], columns)))
+        ), shape=(user_index.size, n))
+        self.__user_index = user_index
 
-        # Remove similarities for low-rated restaurants
-        low_rated_indices = restaurants[~(restaurants["average_stars"] > 3)] \
-            .index.map(lambda r_id: self.index.get_loc(r_id))
-        self.similarity_matrix[np.ix_(low_rated_indices, low_rated_indices)] = 0.0
+    def save(self, path: Path):
+        # Save the restaurant index, item profiles, similarity structure and user profiles as arrays in the directory
+        save_meta(path, "ContentBasedFiltering", similarity_index=self.similarity_index is not None,
+                  neighbours=self.__neighbours, similarity_floor=self.__similarity_floor)
+        save_ids(path, "restaurant_ids", self.index)
+        # The TF-IDF model is saved as its vocabulary (ordered by term index) and inverse document frequencies
+        vocabulary = np.empty(len(self.__tf_idf_v.vocabulary_), dtype=object)
+        vocabulary[list(self.__tf_idf_v.vocabulary_.values())] = list(self.__tf_idf_v.vocabulary_.keys())
+        save_ids(path, "vocabulary", vocabulary)
+        save_array(path, "idf", self.__tf_idf_v.idf_)
+        save_csr(path, "tf_idf", self.__tf_idf_matrix)
+        save_array(path, "feature_vectors", self.__feature_vectors)
+        save_array(path, "low_rated", self.__low_rated)
+        if self.similarity_index is not None:
+            self.similarity_index.save(path, "similarity_index")
+        else:
+            save_array(path, "similarity_matrix", self.similarity_matrix)
+        save_ids(path, "user_ids", self.__user_index)
+        save_csr(path, "user_profiles", self.__user_profiles)
 
-        # Set diagonals to 0
-        np.fill_diagonal(self.similarity_matrix, 0.0)
+    @classmethod
+    @timed
+    def load(cls, path: Path, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+             review_index: Optional[ReviewIndex] = None, mmap_mode: Optional[str] = None) \
+            -> "ContentBasedFiltering":
+        """
+        Create a recommender from saved artifacts (see save) without refitting.
+        With mmap_mode="r" the model arrays are read-only memory-mapped views, shared between processes.
+        """
+        meta = load_meta(path, "ContentBasedFiltering")
+        recommender: ContentBasedFiltering = cls.__new__(cls)
+        RecommenderBase.__init__(recommender, restaurants, users, reviews, review_index)
+
+        recommender.index = pd.Index(load_ids(path, "restaurant_ids"), name=restaurants.index.name)
+        recommender.__tf_idf_v = tf_idf_vectorizer(load_ids(path, "vocabulary"))
+        recommender.__tf_idf_v.idf_ = load_array(path, "idf")
+        recommender.__tf_idf_matrix = load_csr(path, "tf_idf", mmap_mode)
+        recommender.__feature_vectors = load_array(path, "feature_vectors", mmap_mode)
+        recommender.__low_rated = load_array(path, "low_rated", mmap_mode)
+        recommender.__neighbours = meta["neighbours"]
+        recommender.__similarity_floor = meta["similarity_floor"]
+        recommender.similarity_matrix = None if meta["similarity_index"] else \
+            load_array(path, "similarity_matrix", mmap_mode)
+        recommender.similarity_index = NeighbourIndex.load(path, "similarity_index", mmap_mode) \
+            if meta["similarity_index"] else None
+        recommender.__dropped_neighbours = None
+        recommender.__user_index = pd.Index(load_ids(path, "user_ids"))
+        recommender.__user_profiles = load_csr(path, "user_profiles", mmap_mode)
+        return recommender
 
     def reviewed(self, user_id: str, restaurant: Union[str, int]):
         restaurant_id = restaurant if type(restaurant) is str else self.index[restaurant]
@@ -52,48 +227,209 @@ class ContentBasedFiltering(RecommenderBase):
         restaurant_id = restaurant if type(restaurant) is str else self.index[restaurant]
         return super().review(user_id, restaurant_id)
 
-    def item_item(self, restaurant_id: str, count: int):
+    @timed
+    def item_item(self, restaurant_id: str, count: int, candidates: Optional[Sequence[str]] = None):
         # Convert a restaurant ID into its matrix index (position)
         query_index = self.index.get_loc(restaurant_id)
+        # Convert the (optional) candidate restaurants into matrix positions, ignoring unknown IDs
+        candidate_indices: Optional[np.ndarray] = None
+        if candidates is not None:
+            candidate_indices = self.index.get_indexer(candidates)
+            candidate_indices = candidate_indices[candidate_indices >= 0]
 
-        # Fetch similarity values between the selected restaurant and all other restaurants
-        cosine_similarities = list(enumerate(self.similarity_matrix[query_index]))
+        if self.similarity_index is not None:
+            # Read the (already sorted) nearest neighbours from the sparse index (only the stored neighbours can be
+            # among the candidates)
+            indices, similarities = self.similarity_index.neighbours_batch(np.array([query_index]), count,
+                                                                           candidate_indices)
+        else:
+            # Select the count most similar restaurants with a partial sort of the similarity row
+            indices, similarities = top_k_batch(self.similarity_matrix, np.array([query_index]), count,
+                                                candidate_indices)
+        valid = indices[0] >= 0
+        return pd.DataFrame({"similarity": similarities[0, valid], "business_id": self.index[indices[0, valid]]})
 
-        # Put recommendations into DataFrame and sort by similarity descending
-        recommendations = pd.DataFrame(cosine_similarities, columns=["index", "similarity"]) \
-            .sort_values("similarity", ascending=False)
-        # Merge the restaurant IDs into the recommendations
-        recommendations["business_id"] = self.index[recommendations["index"]]
-        recommendations.drop(columns=["index"], inplace=True)
+    @timed
+    def item_item_batch(self, restaurant_ids: Sequence[str], count: int, candidates: Optional[Sequence[str]] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the count most similar restaurants to each of many restaurants in one call (optionally only considering
+        the candidate restaurants). Returns (len(restaurant_ids), count) arrays of restaurant positions (in self.index)
+        and similarities, sorted by similarity descending and padded with -1 and NaN where fewer than count exist.
+        """
+        query_indices = self.index.get_indexer(restaurant_ids)
+        candidate_indices: Optional[np.ndarray] = None
+        if candidates is not None:
+            candidate_indices = self.index.get_indexer(candidates)
+            candidate_indices = candidate_indices[candidate_indices >= 0]
 
-        return recommendations.iloc[:count]
+        indices = np.full((query_indices.size, count), -1, dtype=np.int64)
+        similarities = np.full((query_indices.size, count), np.nan)
+        # Unknown restaurant IDs are left as padding
+        known = np.flatnonzero(query_indices >= 0)
+        if self.similarity_index is not None:
+            indices[known], similarities[known] = \
+                self.similarity_index.neighbours_batch(query_indices[known], count, candidate_indices)
+        else:
+            indices[known], similarities[known] = \
+                top_k_batch(self.similarity_matrix, query_indices[known], count, candidate_indices)
+        return indices, similarities
 
     def __get_similar_items(self, index: int, k: int):
+        if self.similarity_index is not None:
+            # Read the (already sorted) k nearest neighbours from the sparse index
+            return list(zip(*self.similarity_index.neighbours(index, k)))
         # Calculate the k indices in the similarity matrix with the greatest similarity to index
+        k = min(k, self.similarity_matrix.shape[1])
         return sorted(zip(
             (indices := np.argpartition(self.similarity_matrix[index], -k)[-k:]), self.similarity_matrix[index, indices]
         ), key=lambda r: r[1], reverse=True)
 
+    def __get_dropped_neighbours(self) -> np.ndarray:
+        """
+        The restaurant left out of each restaurant's n - 1 most similar restaurants in the similarity matrix (as
+        __get_similar_items selects them for predict_stars with k=None), which is an arbitrary least similar
+        restaurant and not necessarily the restaurant itself. Computed once per similarity matrix.
+        """
+        if self.__dropped_neighbours is None:
+            n = self.similarity_matrix.shape[0]
+            dropped = np.empty(n, dtype=np.int64)
+            step = block_rows(self.similarity_matrix.shape)
+            for start in range(0, n, step):
+                # The same partition of each row as __get_similar_items, so ties are broken the same way
+                dropped[start:start + step] = np.argpartition(
+                    self.similarity_matrix[start:start + step], -(n - 1), axis=1
+                )[:, 0]
+            self.__dropped_neighbours = dropped
+        return self.__dropped_neighbours
+
+    def __profile_weights(self, restaurant_indices: np.ndarray, k: int) -> csr_matrix:
+        # Sparse rows holding the similarities of each given restaurant to its k most similar restaurants
+        if self.similarity_index is not None:
+            indices, similarities = self.similarity_index.neighbours_batch(restaurant_indices, k)
+        else:
+            indices, similarities = self.item_item_batch(self.index[restaurant_indices], k)
+        valid = indices >= 0
+        indptr = np.concatenate(([0], np.cumsum(valid.sum(axis=1))))
+        return csr_matrix(
+            (similarities[valid], indices[valid], indptr), shape=(restaurant_indices.size, self.index.size)
+        )
+
+    def __profile_totals(self, profiles: csr_matrix, weights: Optional[csr_matrix] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Weighted rating totals and numbers of contributing reviews of a block of user profiles against each row of
+        weights (restaurant neighbourhoods), or against every restaurant when weights is None.
+        """
+        reviewed = profiles.copy()
+        reviewed.data[:] = 1.0
+        if weights is None and self.similarity_matrix is not None:
+            # Every restaurant is a neighbour (the similarity matrix is symmetric), less the one predict_stars drops
+            totals = np.asarray(profiles @ self.similarity_matrix)
+            counts = np.repeat(np.asarray(reviewed.sum(axis=1), dtype=np.float64), self.index.size, axis=1)
+            if self.index.size > 1:
+                dropped = self.__get_dropped_neighbours()
+                totals -= profiles[:, dropped].toarray() * self.similarity_matrix[np.arange(self.index.size), dropped]
+                counts -= reviewed[:, dropped].toarray()
+            return totals, counts
+        if weights is None:
+            weights = self.similarity_index.to_csr()
+        pattern = weights.copy()
+        pattern.data[:] = 1.0
+        return (profiles @ weights.transpose()).toarray(), (reviewed @ pattern.transpose()).toarray()
+
+    @timed
+    def predict_users(self, user_ids: Sequence[str]) -> np.ndarray:
+        """
+        Predict the star ratings of each user for every restaurant (in self.index order) using sparse products of the
+        user profiles with the similarity structure. Each restaurant is scored against the same neighbourhood as
+        predict_stars with k=None, so the predictions match it (with NaN for None).
+        """
+        user_indices = self.__user_index.get_indexer(user_ids)
+        predictions = np.full((user_indices.size, self.index.size), np.nan)
+        known = np.flatnonzero(user_indices >= 0)
+
+        step = max(1, BATCH_ENTRIES // max(1, self.index.size))
+        for start in range(0, known.size, step):
+            rows = known[start:start + step]
+            totals, counts = self.__profile_totals(self.__user_profiles[user_indices[rows]])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                predictions[rows] = np.where(counts > 0, totals / counts, np.nan)
+
+        # Normalise the predictions for the users' average stars
+        return predictions + self._users["average_stars"].reindex(user_ids).to_numpy()[:, np.newaxis]
+
+    def predict_user(self, user_id: str) -> np.ndarray:
+        return self.predict_users([user_id])[0]
+
+    @timed
+    def predict_stars_batch(self, user_ids: Sequence[str], restaurant_ids: Sequence[str],
+                            k: Optional[int] = None) -> np.ndarray:
+        """
+        Predict the star ratings of many (user, restaurant) pairs, using the same neighbourhoods as predict_stars so
+        the predictions match it. Pairs are grouped by user and scored against the queried restaurants' neighbourhoods
+        with sparse products. Returns NaN for pairs where predict_stars would return None.
+        """
+        user_ids = np.asarray(user_ids)
+        user_indices = self.__user_index.get_indexer(user_ids)
+        restaurant_indices = self.index.get_indexer(restaurant_ids)
+        predictions = np.full(user_indices.size, np.nan)
+        known = np.flatnonzero((user_indices >= 0) & (restaurant_indices >= 0))
+        if known.size == 0:
+            return predictions
+
+        # Group the pairs by user
+        unique_users, pair_users = np.unique(user_indices[known], return_inverse=True)
+        order = np.argsort(pair_users, kind="stable")
+        bounds = np.searchsorted(pair_users[order], np.arange(unique_users.size + 1))
+
+        weights = None
+        if k is not None:
+            # Restrict each queried restaurant to its k most similar restaurants
+            columns, pair_columns = np.unique(restaurant_indices[known], return_inverse=True)
+            weights = self.__profile_weights(columns, k)
+        else:
+            pair_columns = restaurant_indices[known]
+
+        step = max(1, BATCH_ENTRIES // max(1, self.index.size))
+        for start in range(0, unique_users.size, step):
+            stop = min(start + step, unique_users.size)
+            pairs = order[bounds[start]:bounds[stop]]
+            rows = pair_users[pairs] - start
+            totals, counts = self.__profile_totals(self.__user_profiles[unique_users[start:stop]], weights)
+            totals, counts = totals[rows, pair_columns[pairs]], counts[rows, pair_columns[pairs]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                predictions[known[pairs]] = np.where(counts > 0, totals / counts, np.nan)
+
+        # Normalise the predictions for the users' average stars
+        predictions[known] += self._users["average_stars"].reindex(user_ids[known]).to_numpy()
+        return predictions
+
+    @timed
     def predict_stars(self, user_id: str, restaurant_id: str, k: Optional[int] = None) -> Optional[float]:
-        # Convert the restaurant ID to its index
+        # Convert the restaurant ID to its index (with no prediction for unknown IDs, as in predict_stars_batch)
+        if restaurant_id not in self.index:
+            return None
         restaurant_index: int = self.index.get_loc(restaurant_id)
         # Get the k most similar users
         similar_items = self.__get_similar_items(restaurant_index, self.get_restaurant_count() - 1 if k is None else k)
 
-        total = 0
-        n = 0
-        # Calculate totals from the similarities
-        for sim_restaurant_index, similarity in similar_items:
-            if (review_id := self.review(user_id, sim_restaurant_index)) is not None:
-                total += similarity * self._reviews["rating"].loc[review_id]
-                n += 1
+        if not similar_items:
+            return None
+        # Find the user's reviews of the similar restaurants, looking them all up at once
+        indices = np.array([index for index, _ in similar_items], dtype=np.int64)
+        similarities = np.array([similarity for _, similarity in similar_items], dtype=np.float64)
+        positions = self._review_index.positions_many(np.repeat(user_id, indices.size), self.index[indices])
+        reviewed = positions >= 0
 
-        # If there were no similar users who had reviewed the restaurant, return None
-        if n == 0:
+        # If the user had not reviewed any of the similar restaurants, return None
+        if not reviewed.any():
             return None
 
-        # Return the predicted star rating for the restaurant (normalised for the user's average stars)
-        return total / n + self._users["average_stars"].loc[user_id]
+        # Return the similarity weighted rating total over the number of reviews (normalised for the user's average
+        # stars)
+        ratings = self._reviews["rating"].to_numpy()[positions[reviewed]]
+        return np.sum(similarities[reviewed] * ratings) / reviewed.sum() + self._users["average_stars"].loc[user_id]
 
 
 # # %%
@@ -101,13 +437,11 @@ class ContentBasedFiltering(RecommenderBase):
 #
 # rs, us, vs = load_data()
 #
-# d = (vs["user_id"] + vs["business_id"]).tolist()
-# index_data = vs.index.values
 # # Fast lookup of reviews
-# r_d = dict(zip(d, index_data))
+# r_i = ReviewIndex(vs)
 #
 # # %%
-# cbf_rs = ContentBasedFiltering(rs, us, vs, r_d)
+# cbf_rs = ContentBasedFiltering(rs, us, vs, r_i)
 #
 # # %%
 # print(cbf_rs.predict_stars("WisFHRRiQmiPz9d2pZ-25Q", "k1QpHAkzKTrFYfk6u--VgQ"))
@@ -1,24 +1,101 @@
-from typing import Tuple
+from typing import Tuple, Optional, List, Dict, Callable, Iterator, Sequence
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 from pathlib import Path
+import hashlib
 import json
 from tqdm import tqdm
 
+try:
+    # Use the faster ujson parser if it is installed
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 DATA_PATH: Path = Path().joinpath("data")  # Path for data
 RAW_DATA_PATH: Path = DATA_PATH.joinpath("raw")  # Path for raw data
 SAMPLED_DATA_PATH: Path = DATA_PATH.joinpath("sampled")  # Path for sampled data
 PREPROCESSED_DATA_PATH: Path = DATA_PATH.joinpath("preprocessed")  # Path for preprocessed data
 
+# Explicit storage types of numeric columns in the columnar tables (text columns are stored as categorical codes)
+COLUMN_DTYPES: Dict[str, Dict[str, str]] = {
+    "restaurants": {"latitude": "float64", "longitude": "float64", "review_count": "int32",
+                    "average_stars": "float32", "delivery_takeaway": "int8"},
+    "users": {"review_count": "int32", "average_stars": "float32"},
+    "reviews": {"stars": "int8", "useful": "int32", "date": "datetime64[s]", "rating": "float32"},
+}
+
 
 def read_raw_data_file(data_file_path, buffer_size=65536, encoding="utf8"):
     with tqdm(total=data_file_path.stat().st_size, unit="bytes") as progress, \
             open(data_file_path, "rt", encoding=encoding) as raw_data_file:
         # While there are lines to read
         while lines := raw_data_file.readlines(buffer_size):
+            # Update the progress once per buffer rather than for every line
+            progress.update(sum(len(line) for line in lines))
             # Loop through each line and convert it to a json object
             for line in lines:
-                progress.update(len(line))
-                yield json.loads(line)
+                yield json_loads(line)
+
+
+def raw_data_chunks(data_file_path: Path, chunk_size: int) -> List[Tuple[int, int]]:
+    # Split a file into byte ranges of about chunk_size bytes, each starting at the beginning of a line
+    size = data_file_path.stat().st_size
+    starts = [0]
+    with open(data_file_path, "rb") as raw_data_file:
+        while starts[-1] + chunk_size < size:
+            # Move to the end of the line containing the chunk boundary
+            raw_data_file.seek(starts[-1] + chunk_size)
+            raw_data_file.readline()
+            starts.append(raw_data_file.tell())
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [size]) if start < stop]
+
+
+# The filter function and fields of the records read by read_raw_data_chunk in this (worker) process
+_chunk_filter: Tuple[Optional[Callable[[dict], bool]], Optional[Sequence[str]]] = (None, None)
+
+
+def set_chunk_filter(filter_function: Optional[Callable[[dict], bool]], fields: Optional[Sequence[str]]):
+    # Pool initializer, so the filter (which may hold large ID sets) is sent to each worker once rather than per chunk
+    global _chunk_filter
+    _chunk_filter = (filter_function, fields)
+
+
+def read_raw_data_chunk(task: Tuple[Path, int, int, str]) -> Tuple[int, List[dict]]:
+    # Parse the records in a byte range of a file, returning the range size and the records accepted by the filter
+    data_file_path, start, stop, encoding = task
+    filter_function, fields = _chunk_filter
+    with open(data_file_path, "rb") as raw_data_file:
+        raw_data_file.seek(start)
+        data = raw_data_file.read(stop - start).decode(encoding)
+
+    records = []
+    # Split on new lines only (JSON strings may contain other line separators such as U+2028)
+    for line in data.split("\n"):
+        if not line.strip():
+            continue
+        record = json_loads(line)
+        if filter_function is None or filter_function(record):
+            # Only send back the requested fields
+            records.append(record if fields is None else {field: record[field] for field in fields})
+    return stop - start, records
+
+
+def read_raw_data_file_parallel(data_file_path: Path, filter_function: Optional[Callable[[dict], bool]] = None,
+                                fields: Optional[Sequence[str]] = None, processes: Optional[int] = None,
+                                chunk_size: int = 1 << 25, encoding: str = "utf8") -> Iterator[dict]:
+    """
+    Read the records of a JSON lines file in parallel, yielding them in file order.
+    The file is split into newline-aligned byte ranges which are parsed (and filtered, keeping only the given fields)
+    in a pool of processes, so filter_function must be picklable (e.g. a module-level function or class instance).
+    """
+    tasks = [(data_file_path, start, stop, encoding) for start, stop in raw_data_chunks(data_file_path, chunk_size)]
+    with tqdm(total=data_file_path.stat().st_size, unit="bytes") as progress, \
+            Pool(processes, initializer=set_chunk_filter, initargs=(filter_function, fields)) as pool:
+        for size, records in pool.imap(read_raw_data_chunk, tasks):
+            progress.update(size)
+            yield from records
 
 
 def write_csv_file(csv_file_path, data, headings, encoding="utf8"):
@@ -83,25 +160,95 @@ def load_sampled_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.Da
     return load_sampled_restaurants(), load_sampled_users(), load_sampled_reviews(), load_sampled_covid()
 
 
-def load_table(name: str, index: str, **kwargs) -> pd.DataFrame:
+def save_columnar_table(name: str, data: pd.DataFrame):
+    """
+    Save a table as a directory of typed .npy columns. Text columns (and the index) are stored as int32 category
+    codes plus an array of the (sorted) categories; other columns use the dtypes in COLUMN_DTYPES.
+    """
+    path = PREPROCESSED_DATA_PATH.joinpath(name)
+    path.mkdir(parents=True, exist_ok=True)
+    dtypes = COLUMN_DTYPES.get(name, {})
+
+    columns = []
+    for column, values in [(data.index.name, data.index.to_series()), *data.items()]:
+        if column in dtypes or values.dtype.kind in "biuf":
+            array = values.to_numpy()
+            if np.dtype(dtype := dtypes.get(column, values.dtype.str)).kind == "M":
+                array = pd.to_datetime(values).to_numpy()
+            np.save(path.joinpath(f"{column}.npy"), array.astype(dtype), allow_pickle=False)
+            columns.append({"name": column, "kind": "array"})
+        else:
+            categorical = pd.Categorical(values)
+            np.save(path.joinpath(f"{column}.npy"), categorical.codes.astype(np.int32), allow_pickle=False)
+            np.save(path.joinpath(f"{column}_categories.npy"), categorical.categories.to_numpy(dtype=str),
+                    allow_pickle=False)
+            columns.append({"name": column, "kind": "categorical"})
+    path.joinpath("meta.json").write_text(json.dumps({"index": data.index.name, "columns": columns}))
+
+
+def load_columnar_table(name: str, columns: Optional[List[str]] = None, categorical: bool = False) -> pd.DataFrame:
+    """
+    Load a table saved by save_columnar_table, reading only the given columns (and the index).
+    Text columns are decoded to strings, or left as pandas Categoricals if categorical is True.
+    """
+    path = PREPROCESSED_DATA_PATH.joinpath(name)
+    meta = json.loads(path.joinpath("meta.json").read_text())
+
+    data = {}
+    for column in meta["columns"]:
+        if column["name"] != meta["index"] and columns is not None and column["name"] not in columns:
+            continue
+        values = np.load(path.joinpath(f"{column['name']}.npy"), allow_pickle=False)
+        if column["kind"] == "categorical":
+            categories = np.load(path.joinpath(f"{column['name']}_categories.npy"), allow_pickle=False).astype(object)
+            if categorical and column["name"] != meta["index"]:
+                values = pd.Categorical.from_codes(values, categories)
+            else:
+                # Decode the codes (with the missing value code -1 selecting the appended NaN)
+                values = np.append(categories, np.nan)[values]
+        data[column["name"]] = values
+
+    index = pd.Index(data.pop(meta["index"]), name=meta["index"])
+    return pd.DataFrame(data, index=index)
+
+
+def load_table(name: str, index: str, columns: Optional[List[str]] = None, backend: Optional[str] = None,
+               **kwargs) -> pd.DataFrame:
+    """
+    Load a preprocessed table from the "columnar" backend (the typed columns saved by save_columnar_table) or the
+    "csv" backend (read with pandas.read_csv, passing it kwargs). By default the columnar table is used if it has
+    been saved, otherwise the CSV file.
+    The backends give the same index and columns but not the same types: columnar columns have the COLUMN_DTYPES, so
+    e.g. the review date is datetime64 rather than str, stars are int8, and review_count and rating are int32 and
+    float32 rather than int64 and float64.
+    """
+    if backend is None:
+        backend = "columnar" if PREPROCESSED_DATA_PATH.joinpath(name, "meta.json").exists() else "csv"
+    if backend == "columnar":
+        if kwargs:
+            raise ValueError(f"CSV options {list(kwargs)} cannot be used with the columnar backend")
+        return load_columnar_table(name, columns)
+    if backend != "csv":
+        raise ValueError(f"Unknown table backend '{backend}', expected 'columnar' or 'csv'")
     return pd.read_csv(
         PREPROCESSED_DATA_PATH.joinpath(f"{name}.csv"),
         escapechar="\\",
         index_col=index,
+        usecols=None if columns is None else [index, *columns],
         **kwargs
     )
 
 
-def load_restaurants() -> pd.DataFrame:
-    return load_table("restaurants", "business_id")
+def load_restaurants(columns: Optional[List[str]] = None) -> pd.DataFrame:
+    return load_table("restaurants", "business_id", columns)
 
 
-def load_users() -> pd.DataFrame:
-    return load_table("users", "user_id")
+def load_users(columns: Optional[List[str]] = None) -> pd.DataFrame:
+    return load_table("users", "user_id", columns)
 
 
-def load_reviews() -> pd.DataFrame:
-    return load_table("reviews", "review_id")
+def load_reviews(columns: Optional[List[str]] = None) -> pd.DataFrame:
+    return load_table("reviews", "review_id", columns)
 
 
 def load_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
@@ -110,3 +257,22 @@ def load_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
 
 def save_preprocessed_table(name: str, data: pd.DataFrame):
     data.to_csv(PREPROCESSED_DATA_PATH.joinpath(f"{name}.csv"), escapechar="\\")
+    save_columnar_table(name, data)
+
+
+def convert_preprocessed_tables(names: Tuple[str, ...] = ("restaurants", "users", "reviews")):
+    # Create columnar copies of existing preprocessed CSV tables
+    for name in names:
+        data = pd.read_csv(PREPROCESSED_DATA_PATH.joinpath(f"{name}.csv"), escapechar="\\", index_col=0)
+        save_columnar_table(name, data)
+
+
+def data_hash(names: Tuple[str, ...] = ("restaurants", "users", "reviews")) -> str:
+    # Hash the contents of the preprocessed data files (used to key model artifacts built from them)
+    digest = hashlib.blake2b(digest_size=16)
+    for name in names:
+        digest.update(name.encode("utf8"))
+        with open(PREPROCESSED_DATA_PATH.joinpath(f"{name}.csv"), "rb") as data_file:
+            while chunk := data_file.read(1 << 20):
+                digest.update(chunk)
+    return digest.hexdigest()
@@ -1,3 +1,6 @@
+import sys
+from typing import Tuple
+import numpy as np
 import pandas as pd
 from rs_data import load_sampled_data, save_preprocessed_table
 
@@ -8,73 +11,95 @@ pd.options.display.width = 0
 MIN_RESTAURANT_RATINGS = 40  # Minimum number of business ratings to be included
 MIN_USER_RATINGS = 4  # Minimum number of in-sample ratings by a user to be included
 
-# %%
-sampled_restaurants, sampled_users, sampled_reviews, sampled_covid = load_sampled_data()
 
 # %%
-# Drop all but the first review made by each user for any given business
-processed_reviews = sampled_reviews \
-    .sort_values(by="date") \
-    .drop_duplicates(["user_id", "business_id"], keep="first")
-
-# Get number of reviews by restaurant
-restaurant_review_counts = processed_reviews.groupby("business_id").size()
-# Get the set of restaurants with more reviews than MIN_RESTAURANT_RATINGS
-restaurants_to_keep = restaurant_review_counts[restaurant_review_counts >= MIN_RESTAURANT_RATINGS].index
-# Update the processed reviews to only contain the selected businesses
-processed_reviews = processed_reviews[processed_reviews["business_id"].isin(restaurants_to_keep)]
-
-# Get number of reviews by user
-user_review_counts = processed_reviews.groupby("user_id").size()
-# Get the set of users with more reviews than MIN_USER_RATINGS
-users_to_keep = user_review_counts[user_review_counts >= MIN_USER_RATINGS].index
-# Update the processed reviews to only contain the selected users
-processed_reviews = processed_reviews[processed_reviews["user_id"].isin(users_to_keep)]
+def k_core_reviews(reviews: pd.DataFrame, min_restaurant_ratings: int = MIN_RESTAURANT_RATINGS,
+                   min_user_ratings: int = MIN_USER_RATINGS) -> pd.DataFrame:
+    """
+    Keep the largest subset of reviews in which every restaurant has at least min_restaurant_ratings reviews and every
+    user has at least min_user_ratings reviews. Removing a restaurant can take a user below the threshold (and vice
+    versa), so the filtering is repeated (on integer-coded IDs) until both thresholds hold.
+    """
+    restaurant_codes, restaurant_ids = pd.factorize(reviews["business_id"])
+    user_codes, user_ids = pd.factorize(reviews["user_id"])
+    keep = np.ones(reviews.shape[0], dtype=bool)
+    while True:
+        # Count the remaining reviews of each restaurant and by each user
+        restaurant_counts = np.bincount(restaurant_codes[keep], minlength=restaurant_ids.size)
+        user_counts = np.bincount(user_codes[keep], minlength=user_ids.size)
+        # Remove the reviews of restaurants and users below the thresholds
+        remove = keep & ((restaurant_counts[restaurant_codes] < min_restaurant_ratings) |
+                         (user_counts[user_codes] < min_user_ratings))
+        if not remove.any():
+            return reviews[keep]
+        keep &= ~remove
 
-# %%
-# Take only the selected restaurants from the sampled ones
-processed_restaurants = sampled_restaurants[sampled_restaurants.index.isin(restaurants_to_keep)].copy()
-# Regroup the reviews by restaurant
-restaurant_review_data = processed_reviews.groupby("business_id")
-# Update the restaurant entries with their preprocessed review counts
-processed_restaurants["review_count"] = restaurant_review_data.size()
-# Update the restaurant entries with their preprocessed average review stars
-processed_restaurants["average_stars"] = restaurant_review_data["stars"].mean()
-# Merge the covid data into the restaurant data
-processed_restaurants = pd.merge(processed_restaurants, sampled_covid, left_index=True, right_index=True)
-# Cast Covid-19 delivery_takeaway feature from bool to int
-processed_restaurants["delivery_takeaway"] = processed_restaurants["delivery_takeaway"].astype(int)
-# Combine name and categories into text feature for TF-IDF
-processed_restaurants["categories"] = processed_restaurants["categories"].str.replace("Restaurants", "")
 
-# %%
-# Take only the selected users from the sampled ones
-processed_users = sampled_users[sampled_users.index.isin(users_to_keep)].copy()
-# Regroup the reviews by user
-user_review_data = processed_reviews.groupby("user_id")
-# Update the user entries with their preprocessed review counts
-processed_users["review_count"] = user_review_data.size()
-# Update the user entries with their preprocessed average review stars
-processed_users["average_stars"] = user_review_data["stars"].mean()
+def preprocess_reviews(sampled_reviews: pd.DataFrame, restaurant_ids: pd.Index) -> pd.DataFrame:
+    reviews = sampled_reviews[sampled_reviews["business_id"].isin(restaurant_ids)]
+    # Drop all but the first review made by each user for any given business
+    # (only the few repeated pairs are sorted by date, as sorting every review by its date string is slow)
+    repeated = reviews.duplicated(["user_id", "business_id"], keep=False).to_numpy()
+    repeated_positions = np.flatnonzero(repeated)
+    order = np.argsort(reviews["date"].to_numpy()[repeated_positions], kind="stable")
+    first = ~reviews.iloc[repeated_positions[order]].duplicated(["user_id", "business_id"]).to_numpy()
+    keep = ~repeated
+    keep[repeated_positions[order[first]]] = True
+    reviews = reviews[keep]
+    reviews = k_core_reviews(reviews).copy()
+    # Calculate normalised review ratings by subtracting the users' average stars from the review stars
+    reviews["rating"] = reviews["stars"] - reviews.groupby("user_id")["stars"].transform("mean")
+    return reviews
+
+
+def preprocess_restaurants(sampled_restaurants: pd.DataFrame, sampled_covid: pd.DataFrame,
+                           reviews: pd.DataFrame) -> pd.DataFrame:
+    # Take only the reviewed restaurants from the sampled ones
+    restaurant_review_data = reviews.groupby("business_id")
+    restaurants = sampled_restaurants[sampled_restaurants.index.isin(reviews["business_id"].unique())].copy()
+    # Update the restaurant entries with their preprocessed review counts and average review stars
+    restaurants["review_count"] = restaurant_review_data.size()
+    restaurants["average_stars"] = restaurant_review_data["stars"].mean()
+    # Merge the covid data into the restaurant data
+    restaurants = pd.merge(restaurants, sampled_covid, left_index=True, right_index=True)
+    # Cast Covid-19 delivery_takeaway feature from bool to int
+    restaurants["delivery_takeaway"] = restaurants["delivery_takeaway"].astype(int)
+    # Combine name and categories into text feature for TF-IDF
+    restaurants["categories"] = restaurants["categories"].str.replace("Restaurants", "")
+    return restaurants
+
+
+def preprocess_users(sampled_users: pd.DataFrame, reviews: pd.DataFrame) -> pd.DataFrame:
+    # Take only the reviewing users from the sampled ones
+    user_review_data = reviews.groupby("user_id")
+    users = sampled_users[sampled_users.index.isin(reviews["user_id"].unique())].copy()
+    # Update the user entries with their preprocessed review counts and average review stars
+    users["review_count"] = user_review_data.size()
+    users["average_stars"] = user_review_data["stars"].mean()
+    return users
+
+
+def preprocess_data(sampled_restaurants: pd.DataFrame, sampled_users: pd.DataFrame, sampled_reviews: pd.DataFrame,
+                    sampled_covid: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # Only keep reviews of restaurants with covid data, so every reviewed restaurant is in the restaurant table
+    restaurant_ids = sampled_restaurants.index.intersection(sampled_covid.index)
+    reviews = preprocess_reviews(sampled_reviews, restaurant_ids)
+    return preprocess_restaurants(sampled_restaurants, sampled_covid, reviews), \
+        preprocess_users(sampled_users, reviews), reviews
 
-# %%
-print("Updating normalised ratings...")
-# Calculate normalised review ratings by subtracting the users' average stars from the review stars
-processed_reviews["rating"] = processed_reviews.apply(
-    lambda x: x["stars"] - processed_users["average_stars"].loc[x["user_id"]],
-    axis=1
-)
-print("Done")
 
 # %%
-print("Writing review data...")
-save_preprocessed_table("reviews", processed_reviews)
-print("Done")
-# %%
-print("Writing restaurant data...")
-save_preprocessed_table("restaurants", processed_restaurants)
-print("Done")
-# %%
-print("Writing user data...")
-save_preprocessed_table("users", processed_users)
-print("Done")
+def main() -> int:
+    print("Preprocessing data...")
+    restaurants, users, reviews = preprocess_data(*load_sampled_data())
+    print("Done")
+
+    for name, data in (("reviews", reviews), ("restaurants", restaurants), ("users", users)):
+        print(f"Writing {name[:-1]} data...")
+        save_preprocessed_table(name, data)
+        print("Done")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
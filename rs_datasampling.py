@@ -1,30 +1,60 @@
 # %%
-from datetime import datetime
-from rs_data import RAW_DATA_PATH, SAMPLED_DATA_PATH, read_raw_data_file, write_csv_file
+import argparse
+import sys
+from pathlib import Path
+from typing import Optional, Set, Dict, List, Sequence, Union, Iterator, Callable
+from rs_data import RAW_DATA_PATH, SAMPLED_DATA_PATH, read_raw_data_file_parallel, write_csv_file
 import pandas as pd
 
 # %%
-MIN_DATE = datetime(2004, 1, 1)  # Review start date
-MAX_DATE = datetime(2020, 1, 1)  # Review end date
-RESAMPLE = True  # Resample the raw data
+# Review date bounds, compared lexically with the fixed-format ("%Y-%m-%d %H:%M:%S") review dates
+MIN_DATE = "2004-01-01 00:00:00"  # Review start date (exclusive)
+MAX_DATE = "2020-01-01 00:00:00"  # Review end date (inclusive)
+
+STAGES = ("restaurants", "reviews", "users", "covid")  # Sampling stages, in dependency order
 
 
 # %% Functions to sample records from raw data and load saved sampled data
-def sample_data_records(raw_data_json_file_path, processed_data_csv_file_path, filter_function, headings):
-    # Create a generator that loads and filters the raw data
-    record_filterer = (record
-                       for record in read_raw_data_file(raw_data_json_file_path)
-                       if filter_function(record))
-    # Write the filtered data to the CSV file given the headings
-    write_csv_file(processed_data_csv_file_path, record_filterer, headings)
+def sampled_data_path(name: str) -> Path:
+    return SAMPLED_DATA_PATH.joinpath(f"sampled_{name}.csv")
 
 
 def load_sampled_data(name, **kwargs):
-    sampled_file_path = SAMPLED_DATA_PATH.joinpath(f"sampled_{name}.csv")
-    return pd.read_csv(sampled_file_path, escapechar="\\", **kwargs)
+    return pd.read_csv(sampled_data_path(name), escapechar="\\", **kwargs)
+
+
+def heading_fields(headings: Sequence[Union[str, dict]]) -> List[str]:
+    # Get the top-level record fields needed to write the headings
+    return [heading if type(heading) is str else heading["path"][0] if "path" in heading else heading["name"]
+            for heading in headings]
+
+
+def sample_data_records(raw_data_json_file_path: Path, processed_data_csv_file_path: Path,
+                        filter_function: Callable[[dict], bool], headings: Sequence[Union[str, dict]], id_field: str,
+                        unique: bool = False, processes: Optional[int] = None) -> Set[str]:
+    """
+    Write the raw records accepted by filter_function to a CSV file given the headings, returning the set of their
+    id_field values. If unique is True, only the first record of each id_field value is kept.
+    The CSV file is written under a temporary name and renamed when complete, so it only exists if the stage finished.
+    """
+    ids: Set[str] = set()
 
+    def accepted_records() -> Iterator[dict]:
+        # Load and filter the raw data in parallel, collecting the accepted IDs
+        for record in read_raw_data_file_parallel(raw_data_json_file_path, filter_function, heading_fields(headings),
+                                                  processes):
+            if unique and record[id_field] in ids:
+                continue
+            ids.add(record[id_field])
+            yield record
 
-# %% Sample business records
+    temporary_path = processed_data_csv_file_path.with_suffix(".csv.tmp")
+    write_csv_file(temporary_path, accepted_records(), headings)
+    temporary_path.replace(processed_data_csv_file_path)
+    return ids
+
+
+# %% Record filters (classes and module-level functions, so they can be sent to worker processes)
 def filter_business_record(record):
     # Remove businesses that are permanently closed
     if not record["is_open"]:
@@ -41,99 +71,121 @@ def filter_business_record(record):
     return True
 
 
-def sample_restaurants():
-    print("Sampling restaurants...")
-    raw_data_path = RAW_DATA_PATH.joinpath("yelp_academic_dataset_business.json")
-    processed_data_path = SAMPLED_DATA_PATH.joinpath("sampled_restaurants.csv")
-    headings = ["business_id", "name", "city", "state", "latitude", "longitude", "categories"]
-
-    sample_data_records(raw_data_path, processed_data_path, filter_business_record, headings)
-
-
-if RESAMPLE:
-    sample_restaurants()
-
-# %% Load sampled restaurant data as DataFrame
-sampled_restaurants = load_sampled_data("restaurants", index_col="business_id")
-
-restaurant_ids = set(sampled_restaurants.index.values)
-
-
-def is_sampled_restaurant(record):
-    return record["business_id"] in restaurant_ids
-
-
-# %% Sample review records
-def filter_review_record(record):
-    if not is_sampled_restaurant(record):
+class IdFilter:
+    # Accept records whose field value is in a set of IDs
+    def __init__(self, field: str, ids: Set[str]):
+        self.field = field
+        self.ids = ids
+
+    def __call__(self, record) -> bool:
+        return record[self.field] in self.ids
+
+
+class ReviewFilter(IdFilter):
+    # Accept reviews of sampled restaurants made within the date bounds
+    def __init__(self, restaurant_ids: Set[str], min_date: str = MIN_DATE, max_date: str = MAX_DATE):
+        super().__init__("business_id", restaurant_ids)
+        self.min_date = min_date
+        self.max_date = max_date
+
+    def __call__(self, record) -> bool:
+        return super().__call__(record) and self.min_date < record["date"] <= self.max_date
+
+
+# %% Sampling pipeline
+class SamplingPipeline:
+    """
+    Sample the raw Yelp data in stages (see STAGES), each reading one raw file once.
+    A stage is skipped if its output is newer than its inputs (the raw file and the outputs of the stages it depends
+    on), unless forced. The accepted ID sets are passed between stages in memory, or read back from a skipped stage's
+    output only when a later stage needs them.
+    """
+    def __init__(self, force: bool = False, processes: Optional[int] = None):
+        self.force = force
+        self.processes = processes
+        self.__ids: Dict[str, Set[str]] = {}
+
+    def __ids_of(self, name: str, field: str) -> Set[str]:
+        if name not in self.__ids:
+            self.__ids[name] = set(load_sampled_data(name, usecols=[field])[field])
+        return self.__ids[name]
+
+    def __up_to_date(self, name: str, raw_file_name: str, dependencies: Sequence[str] = ()) -> bool:
+        output_path = sampled_data_path(name)
+        if self.force or not output_path.exists():
+            return False
+        input_paths = [RAW_DATA_PATH.joinpath(raw_file_name), *map(sampled_data_path, dependencies)]
+        if all(output_path.stat().st_mtime >= input_path.stat().st_mtime for input_path in input_paths):
+            print(f"Sampled {name} are up to date")
+            return True
         return False
-    return MIN_DATE < datetime.strptime(record["date"], "%Y-%m-%d %H:%M:%S") <= MAX_DATE
-
-
-def sample_reviews():
-    print("Sampling reviews...")
-    raw_data_path = RAW_DATA_PATH.joinpath("yelp_academic_dataset_review.json")
-    processed_data_path = SAMPLED_DATA_PATH.joinpath("sampled_reviews.csv")
-    headings = ["review_id", "user_id", "business_id", "stars", "useful", "date"]
-
-    # Remove reviews if they are not for a sampled business
-    sample_data_records(raw_data_path, processed_data_path, filter_review_record, headings)
 
+    def sample_restaurants(self):
+        raw_file_name = "yelp_academic_dataset_business.json"
+        if self.__up_to_date("restaurants", raw_file_name):
+            return
+        print("Sampling restaurants...")
+        headings = ["business_id", "name", "city", "state", "latitude", "longitude", "categories"]
+        self.__ids["restaurants"] = sample_data_records(
+            RAW_DATA_PATH.joinpath(raw_file_name), sampled_data_path("restaurants"), filter_business_record, headings,
+            "business_id", processes=self.processes
+        )
+
+    def sample_reviews(self):
+        raw_file_name = "yelp_academic_dataset_review.json"
+        if self.__up_to_date("reviews", raw_file_name, ["restaurants"]):
+            return
+        print("Sampling reviews...")
+        headings = ["review_id", "user_id", "business_id", "stars", "useful", "date"]
+        # Remove reviews if they are not for a sampled business, collecting the IDs of the reviewing users
+        self.__ids["reviews"] = sample_data_records(
+            RAW_DATA_PATH.joinpath(raw_file_name), sampled_data_path("reviews"),
+            ReviewFilter(self.__ids_of("restaurants", "business_id")), headings, "user_id", processes=self.processes
+        )
+
+    def sample_users(self):
+        raw_file_name = "yelp_academic_dataset_user.json"
+        if self.__up_to_date("users", raw_file_name, ["reviews"]):
+            return
+        print("Sampling users...")
+        headings = ["user_id", "name"]
+        # Remove users if they do not show up in any reviews
+        sample_data_records(
+            RAW_DATA_PATH.joinpath(raw_file_name), sampled_data_path("users"),
+            IdFilter("user_id", self.__ids_of("reviews", "user_id")), headings, "user_id", processes=self.processes
+        )
+
+    def sample_covid(self):
+        raw_file_name = "yelp_academic_dataset_covid_features.json"
+        if self.__up_to_date("covid", raw_file_name, ["restaurants"]):
+            return
+        print("Sampling covid data...")
+        headings = ["business_id", {"name": "delivery or takeout", "display_name": "delivery_takeaway"}]
+        # Keep the first record of each sampled restaurant (duplicates are removed here, after the parallel filter)
+        sample_data_records(
+            RAW_DATA_PATH.joinpath(raw_file_name), sampled_data_path("covid"),
+            IdFilter("business_id", self.__ids_of("restaurants", "business_id")), headings, "business_id",
+            unique=True, processes=self.processes
+        )
+
+    def run(self, stages: Sequence[str] = STAGES):
+        for stage in STAGES:
+            if stage in stages:
+                getattr(self, f"sample_{stage}")()
 
-if RESAMPLE:
-    sample_reviews()
 
-# %% Load sampled review data as DataFrame
-sampled_reviews = load_sampled_data("reviews", parse_dates=["date"], index_col="review_id")
-
-# print(all(business_id in business_ids for business_id in sampled_reviews["business_id"]))
-user_ids = set(sampled_reviews["user_id"])
-
-
-def is_sampled_user(record):
-    return record["user_id"] in user_ids
-
-
-# %% Sample user records
-def sample_users():
-    print("Sampling users...")
-    raw_data_path = RAW_DATA_PATH.joinpath("yelp_academic_dataset_user.json")
-    processed_data_path = SAMPLED_DATA_PATH.joinpath("sampled_users.csv")
-    headings = ["user_id", "name"]
-
-    # Remove users if they do not show up in any reviews
-    sample_data_records(raw_data_path, processed_data_path, is_sampled_user, headings)
-
-
-if RESAMPLE:
-    sample_users()
-
-# %% Load sampled user data as DataFrame
-sampled_users = load_sampled_data("users", index_col="user_id")
-
-# %% Sample Covid records
-covid_sampled_businesses = set()
-
-
-def filter_covid(record):
-    if not is_sampled_restaurant(record) or record["business_id"] in covid_sampled_businesses:
-        return False
-    covid_sampled_businesses.add(record["business_id"])
-    return True
-
-
-def sample_covid():
-    print("Sampling covid data...")
-    raw_data_path = RAW_DATA_PATH.joinpath("yelp_academic_dataset_covid_features.json")
-    processed_data_path = SAMPLED_DATA_PATH.joinpath("sampled_covid.csv")
-    headings = ["business_id", {"name": "delivery or takeout", "display_name": "delivery_takeaway"}]
-
-    covid_sampled_businesses.clear()
-    sample_data_records(raw_data_path, processed_data_path, filter_covid, headings)
+# %%
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Sample the raw Yelp data, skipping stages which are up to date.")
+    parser.add_argument("--force", action="store_true", help="resample stages even if they are up to date")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run")
+    args = parser.parse_args()
 
+    SAMPLED_DATA_PATH.mkdir(parents=True, exist_ok=True)
+    SamplingPipeline(args.force, args.processes).run(args.stages)
+    return 0
 
-if RESAMPLE:
-    sample_covid()
 
-# %% Load sampled covid data as DataFrame
-sampled_covid = load_sampled_data("covid", index_col="business_id")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,136 @@
 # %%
-from typing import Optional
-from rs_hybrid import HybridRecommenderSystem
-from rs_collaborative import CollaborativeFiltering
-from rs_data import load_data
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Sequence, Tuple, Optional, Callable, Any, Dict
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from rs_parallel import model_pool, get_model
 
-# %%
-restaurants, users, reviews = data = load_data()
-# %%
-cf_rs = CollaborativeFiltering(*data)
-h_rs = HybridRecommenderSystem(*data)
+RECOMMENDERS = ("hybrid", "cf", "cbf", "mf")  # Recommenders which can be evaluated from the command line
 
 
 # %%
-def rmse(recommender, max_samples: Optional[int] = None, k: Optional[int] = None):
-    n = 0
-    total = 0
-    for row in reviews.itertuples():
-        user_id, restaurant_id, stars = row[1], row[2], row[3]
-        predicted = recommender.predict_stars(user_id, restaurant_id, k)
-        if predicted is not None:
-            total += (stars - predicted) ** 2
-            n += 1
-        if n % 100 == 0:
-            print(f"{n} reviews ({100 * n / reviews.shape[0]:.3f}%), RMSE {(total / n) ** 0.5} stars")
+def sample_reviews(reviews: pd.DataFrame, max_samples: Optional[int] = None, seed: int = 0) -> pd.DataFrame:
+    # Take a seeded random sample of max_samples reviews (the same for a given seed), ordered by user
+    if max_samples is not None and max_samples < reviews.shape[0]:
+        reviews = reviews.iloc[np.sort(np.random.default_rng(seed).choice(reviews.shape[0], max_samples,
+                                                                           replace=False))]
+    return reviews.iloc[np.argsort(reviews["user_id"].to_numpy(), kind="stable")]
+
+
+def error_totals(stars: np.ndarray, predictions: np.ndarray) -> Dict[str, float]:
+    # Totals from which the error metrics of any union of shards can be calculated (see error_metrics)
+    predicted = ~np.isnan(predictions)
+    errors = predictions[predicted] - stars[predicted]
+    return {"reviews": stars.size, "predicted": int(predicted.sum()),
+            "squared_error": float(np.sum(errors ** 2)), "absolute_error": float(np.sum(np.abs(errors)))}
+
+
+def error_metrics(totals: pd.DataFrame) -> pd.DataFrame:
+    # RMSE and MAE (in stars) over the predicted reviews, and coverage (the fraction of reviews predicted)
+    predicted = totals["predicted"].where(totals["predicted"] > 0)
+    return pd.DataFrame({
+        "rmse": np.sqrt(totals["squared_error"] / predicted),
+        "mae": totals["absolute_error"] / predicted,
+        "coverage": totals["predicted"] / totals["reviews"]
+    }, index=totals.index)
+
+
+def evaluate_shard(task: Tuple[int, Sequence[str], Sequence[str], np.ndarray, Optional[int]]) -> Dict[str, float]:
+    # Predict the stars of one shard of reviews with the worker's model, returning the shard's error totals
+    shard, user_ids, restaurant_ids, stars, k = task
+    start = time.perf_counter()
+    predictions = get_model().predict_stars_batch(user_ids, restaurant_ids, k)
+    return {"shard": shard, **error_totals(stars, predictions), "seconds": time.perf_counter() - start}
+
 
-        if n == max_samples:
-            break
+def evaluate(model, reviews: pd.DataFrame, k: Optional[int] = None, max_samples: Optional[int] = None, seed: int = 0,
+             processes: Optional[int] = None, shard_size: int = 10000,
+             loader: Optional[Callable[[], Any]] = None) -> pd.DataFrame:
+    """
+    Evaluate the star predictions (predict_stars_batch, which matches predict_stars as used by the former rmse) of a
+    recommender on reviews, or a seeded random sample of max_samples of them, sharding the reviews (ordered by user,
+    so each user's reviews are predicted together) across a process pool. The workers share model, or each load their
+    own with loader (see rs_parallel.model_pool).
+    Returns the RMSE, MAE, coverage and predictions per second of each shard, and of all reviews in the "all" row
+    (whose predictions per second are for the whole run, across all workers).
+    """
+    reviews = sample_reviews(reviews, max_samples, seed)
+    user_ids, restaurant_ids = reviews["user_id"].to_numpy(), reviews["business_id"].to_numpy()
+    stars = reviews["stars"].to_numpy(dtype=np.float64)
+    tasks = ((shard, user_ids[i:i + shard_size], restaurant_ids[i:i + shard_size], stars[i:i + shard_size], k)
+             for shard, i in enumerate(range(0, stars.size, shard_size)))
 
-    print(f"Finished: {n} reviews ({100 * n / reviews.shape[0]:.3f}%), RMSE {(total / n) ** 0.5} stars")
+    results = []
+    start = time.perf_counter()
+    with model_pool(model, processes, loader) as pool, tqdm(total=stars.size, unit="reviews") as progress:
+        for result in pool.imap_unordered(evaluate_shard, tasks):
+            results.append(result)
+            progress.update(result["reviews"])
+    elapsed = time.perf_counter() - start
+
+    totals = pd.DataFrame(results).set_index("shard").sort_index()
+    totals.loc["all"] = totals.sum()
+    totals.loc["all", "seconds"] = elapsed
+    return pd.concat([
+        totals[["reviews", "predicted"]].astype(int),
+        error_metrics(totals),
+        pd.DataFrame({"seconds": totals["seconds"], "predictions_per_second": totals["reviews"] / totals["seconds"]})
+    ], axis=1)
 
 
 # %%
-rmse(cf_rs, 100000, 10000)
+def load_recommender(name: str, model_root: Optional[Path] = None, mmap_mode: Optional[str] = None):
+    # Fit (or for the hybrid recommender, load if saved in model_root) a recommender of the given name
+    from rs_data import load_data
+    from rs_cli import load_model
+
+    if name == "hybrid":
+        return load_model(model_root, mmap_mode)
+    if name == "cf":
+        from rs_collaborative import CollaborativeFiltering
+        return CollaborativeFiltering(*load_data())
+    if name == "cbf":
+        from rs_content import ContentBasedFiltering
+        return ContentBasedFiltering(*load_data())
+    from rs_mf import MatrixFactorization
+    return MatrixFactorization(*load_data())
+
+
+def main() -> int:
+    from rs_data import load_reviews
+    from rs_cli import mmap_model_loader
+
+    parser = argparse.ArgumentParser(description="Evaluate the star predictions of a recommender on the reviews.")
+    parser.add_argument("--recommender", choices=RECOMMENDERS, default="hybrid", help="recommender to evaluate")
+    parser.add_argument("--k", type=int, default=None, help="number of neighbours used by the predictions")
+    parser.add_argument("--max-samples", type=int, default=None, help="evaluate a random sample of this many reviews")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the review sample")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--shard-size", type=int, default=10000, help="number of reviews per shard")
+    parser.add_argument("--model-dir", type=Path, default=None,
+                        help="directory of saved models to load from (hybrid recommender only)")
+    parser.add_argument("--mmap", action="store_true",
+                        help="have each worker memory-map the saved model (hybrid recommender, requires --model-dir)")
+    args = parser.parse_args()
+
+    print("Loading data...")
+    if args.mmap and args.recommender == "hybrid" and args.model_dir is not None:
+        # Have each worker memory-map the saved model (with the tables loaded once here) rather than copying it
+        model, loader = None, mmap_model_loader(args.model_dir)
+    else:
+        model, loader = load_recommender(args.recommender, args.model_dir), None
+    print("Done")
+
+    results = evaluate(model, load_reviews(), args.k, args.max_samples, args.seed, args.processes, args.shard_size,
+                       loader)
+    with pd.option_context("display.max_rows", 20, "display.width", 0):
+        print(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
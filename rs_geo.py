@@ -0,0 +1,32 @@
+# %%
+from typing import Optional
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+EARTH_RADIUS_KM = 6371.0088  # Mean radius of the Earth in kilometres
+
+
+# %%
+class RestaurantLocator:
+    """Spatial index over restaurant locations supporting great-circle (haversine) radius and nearest queries."""
+
+    def __init__(self, restaurants: pd.DataFrame):
+        self.index: pd.Index = restaurants.index
+        # The haversine metric expects (latitude, longitude) in radians
+        self.__tree = BallTree(np.radians(restaurants[["latitude", "longitude"]].to_numpy()), metric="haversine")
+
+    def within_radius(self, latitude: float, longitude: float, radius: float) -> pd.Series:
+        # Find the restaurants within radius kilometres of the point, ordered by distance ascending
+        indices, distances = self.__tree.query_radius(
+            np.radians([[latitude, longitude]]), radius / EARTH_RADIUS_KM, return_distance=True, sort_results=True
+        )
+        return pd.Series(distances[0] * EARTH_RADIUS_KM, index=self.index[indices[0]], name="distance")
+
+    def nearest(self, latitude: float, longitude: float, count: int, radius: Optional[float] = None) -> pd.Series:
+        # Find the count restaurants nearest to the point (optionally limited to radius kilometres)
+        distances, indices = self.__tree.query(np.radians([[latitude, longitude]]), min(count, self.index.size))
+        distances, indices = distances[0] * EARTH_RADIUS_KM, indices[0]
+        if radius is not None:
+            distances, indices = distances[distances <= radius], indices[distances <= radius]
+        return pd.Series(distances, index=self.index[indices], name="distance")
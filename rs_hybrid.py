@@ -1,77 +1,329 @@
 # %%
-from typing import Optional, List, Dict
+from pathlib import Path
+from typing import List, Optional, Tuple, Sequence
+import numpy as np
 import pandas as pd
-from rs_base import RecommenderBase
+from scipy.sparse import csr_matrix
+from rs_base import RecommenderBase, ReviewIndex, updated_table
+from rs_artifacts import save_meta, load_meta, save_array, load_array, save_ids, load_ids, save_csr, load_csr
 from rs_collaborative import CollaborativeFiltering
 from rs_content import ContentBasedFiltering
+from rs_mf import MatrixFactorization
+from rs_geo import RestaurantLocator
+from rs_stats import timed, span
+from rs_cache import LRUCache
+
+MAX_CACHED_BATCH = 256  # Largest batch of star predictions which is looked up in (and added to) the prediction cache
 
 
 # %%
 class HybridRecommenderSystem(RecommenderBase):
+    @timed
     def __init__(self, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
-                 review_dict: Optional[Dict[str, str]] = None):
-        super().__init__(restaurants, users, reviews, review_dict)
+                 review_index: Optional[ReviewIndex] = None, factors: Optional[int] = None,
+                 cache_entries: Optional[int] = 1 << 16, cache_bytes: Optional[int] = 1 << 26):
+        super().__init__(restaurants, users, reviews, review_index)
+        self.__set_caches(cache_entries, cache_bytes)
 
         # Create a Collaborative Filtering recommender
-        self.__rs_cf: CollaborativeFiltering = CollaborativeFiltering(restaurants, users, reviews, self._review_dict)
+        self.__rs_cf: CollaborativeFiltering = CollaborativeFiltering(restaurants, users, reviews, self._review_index)
         # Create a Content-based Filtering recommender
-        self.__rs_cbf: ContentBasedFiltering = ContentBasedFiltering(restaurants, users, reviews, self._review_dict)
-
-    def recommend_user(self, user_id: str, count: int) -> pd.DataFrame:
-        # Prepare a DataFrame to store the candidate recommendations for CF and CBF
-        results: pd.DataFrame = pd.DataFrame(columns=["business_id", "similarity", "score"])
-
-        reviewed_ids: List[str] = self._reviews[
-            (self._reviews["user_id"] == user_id) & (self._reviews["rating"] > 0)
-            ]["business_id"].tolist()
-
-        # Loop through each restaurant reviewed positively by the user
-        for business_id in reviewed_ids:
-            # Generate the CF candidate recommendations
-            cf_candidates = self.__rs_cf.item_item(business_id, count).copy()
-            # Apply weighting to CF candidates
-            cf_candidates["score"] = cf_candidates["similarity"] * 12.0
-            # Add CF candidates to the results
-            results: pd.DataFrame = results.append(cf_candidates, ignore_index=True)
-
-            # Generate the CBF candidate recommendations
-            cbf_candidates = self.__rs_cbf.item_item(business_id, count).copy()
-            # Apply weighting to CF candidates
-            cbf_candidates["score"] = cbf_candidates["similarity"] * 0.70
-            # Add CBF candidates to the results
-            results: pd.DataFrame = results.append(cbf_candidates, ignore_index=True)
+        self.__rs_cbf: ContentBasedFiltering = ContentBasedFiltering(restaurants, users, reviews, self._review_index)
+        # Optionally create a Matrix Factorization recommender with factors latent factors (for star predictions)
+        self.__rs_mf: Optional[MatrixFactorization] = None if factors is None else \
+            MatrixFactorization(restaurants, users, reviews, self._review_index, factors)
+        # Create a spatial index over the restaurant locations
+        self.__locator: RestaurantLocator = RestaurantLocator(restaurants)
 
-        # Remove previously-reviewed restaurants
-        results: pd.DataFrame = results[~results["business_id"].isin(reviewed_ids)]
-
-        # Sort the candidate recommendations by similarity descending (higher is better)
-        results.sort_values(by="score", ascending=False, inplace=True, ignore_index=True)
-        # Drop duplicate candidate recommendations
-        results.drop_duplicates(subset=["business_id"], keep="first", inplace=True)
-        # Re-index by business_id
-        results.set_index("business_id", inplace=True)
-        # Get the top count recommendations from the candidates
-        recommendations: pd.DataFrame = results.iloc[:count].copy()
-        # Add the predicted star rating data to the recommendations
-        # noinspection PyTypeChecker
-        recommendations.loc[:, "star_prediction"] = recommendations.apply(
-            lambda r: self.predict_stars(user_id, r.name),
-            axis=1
+        # Map CF restaurant indices to restaurant positions (in the restaurants table)
+        self.__cf_positions: np.ndarray = restaurants.index.get_indexer(self.__rs_cf.restaurant_ids)
+        self.__set_user_ratings(reviews)
+
+    def __set_caches(self, cache_entries: Optional[int], cache_bytes: Optional[int]):
+        # LRU caches of recommendations and star predictions, keyed by (user ID, model version, ...) so results
+        # computed before a model change are never returned (see add_reviews)
+        self.model_version: int = 0
+        self.__recommendation_cache: LRUCache = LRUCache(cache_entries, cache_bytes)
+        self.__prediction_cache: LRUCache = LRUCache(cache_entries, cache_bytes)
+
+    def __set_user_ratings(self, reviews: pd.DataFrame):
+        # Sparse user by restaurant position matrix of normalised ratings (with explicit zeros), ordered by user ID
+        self.__user_index: pd.Index = pd.Index(sorted(reviews["user_id"].unique()))
+        rows = self.__user_index.get_indexer(reviews["user_id"])
+        columns = self._restaurants.index.get_indexer(reviews["business_id"])
+        # Ignore reviews of restaurants which are not in the restaurants table
+        known = columns >= 0
+        self.__user_ratings: csr_matrix = csr_matrix(
+            (reviews["rating"].to_numpy(dtype=np.float64)[known], (rows[known], columns[known])),
+            shape=(self.__user_index.size, self._restaurants.shape[0])
+        )
+
+    def save(self, path: Path):
+        # Save the CF and CBF recommenders and the user rating index as arrays in the directory path
+        save_meta(path, "HybridRecommenderSystem", matrix_factorization=self.__rs_mf is not None)
+        self.__rs_cf.save(path.joinpath("cf"))
+        self.__rs_cbf.save(path.joinpath("cbf"))
+        if self.__rs_mf is not None:
+            self.__rs_mf.save(path.joinpath("mf"))
+        save_array(path, "cf_positions", self.__cf_positions)
+        save_ids(path, "user_ids", self.__user_index)
+        save_csr(path, "user_ratings", self.__user_ratings)
+
+    @classmethod
+    @timed
+    def load(cls, path: Path, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+             review_index: Optional[ReviewIndex] = None, mmap_mode: Optional[str] = None,
+             cache_entries: Optional[int] = 1 << 16, cache_bytes: Optional[int] = 1 << 26) \
+            -> "HybridRecommenderSystem":
+        """
+        Create a recommender from saved artifacts (see save) without refitting.
+        With mmap_mode="r" the model arrays are read-only memory-mapped views, shared between processes.
+        """
+        meta = load_meta(path, "HybridRecommenderSystem")
+        recommender: HybridRecommenderSystem = cls.__new__(cls)
+        RecommenderBase.__init__(recommender, restaurants, users, reviews, review_index)
+        recommender.__set_caches(cache_entries, cache_bytes)
+
+        recommender.__rs_cf = CollaborativeFiltering.load(
+            path.joinpath("cf"), restaurants, users, reviews, recommender._review_index, mmap_mode
         )
-        return recommendations
+        recommender.__rs_cbf = ContentBasedFiltering.load(
+            path.joinpath("cbf"), restaurants, users, reviews, recommender._review_index, mmap_mode
+        )
+        recommender.__rs_mf = MatrixFactorization.load(
+            path.joinpath("mf"), restaurants, users, reviews, recommender._review_index, mmap_mode
+        ) if meta.get("matrix_factorization") else None
+        recommender.__locator = RestaurantLocator(restaurants)
+        recommender.__cf_positions = load_array(path, "cf_positions", mmap_mode)
+        recommender.__user_index = pd.Index(load_ids(path, "user_ids"))
+        recommender.__user_ratings = load_csr(path, "user_ratings", mmap_mode)
+        return recommender
+
+    @timed
+    def add_reviews(self, reviews: pd.DataFrame, users: Optional[pd.DataFrame] = None,
+                    restaurants: Optional[pd.DataFrame] = None):
+        """
+        Add reviews (with any new or updated users and restaurants) to each recommender without a full refit (see
+        their add_reviews), sharing one extended review index. New ratings change the similarities used for other
+        users too, so this is a model change: every cached result is invalidated.
+        """
+        self._add_data(reviews, users, restaurants)
+        self.__rs_cbf.add_reviews(reviews, users, restaurants, self._review_index)
+        self.__rs_cf.add_reviews(reviews, users, restaurants, self._review_index)
+        if self.__rs_mf is not None:
+            self.__rs_mf.add_reviews(reviews, users, restaurants, self._review_index)
+
+        self.__cf_positions = self._restaurants.index.get_indexer(self.__rs_cf.restaurant_ids)
+        # The review index keeps the position of the latest review of each (user, restaurant) pair
+        self.__set_user_ratings(self._reviews.iloc[np.sort(self._review_index.positions)])
+        if restaurants is not None:
+            self.__locator = RestaurantLocator(self._restaurants)
+        self.invalidate()
+
+    @timed
+    def add_restaurants(self, restaurants: pd.DataFrame):
+        """
+        Add new (unreviewed) restaurants to the catalogue without a refit, so they can be recommended by CBF (see
+        ContentBasedFiltering.add_restaurants). This is a model change: every cached result is invalidated.
+        """
+        self.__rs_cbf.add_restaurants(restaurants)
+        self._restaurants = updated_table(self._restaurants, restaurants)
+        self.__locator = RestaurantLocator(self._restaurants)
+        # Widen the user ratings to the new restaurants
+        self.__user_ratings = csr_matrix(
+            (self.__user_ratings.data, self.__user_ratings.indices, self.__user_ratings.indptr),
+            shape=(self.__user_index.size, self._restaurants.shape[0])
+        )
+        self.invalidate()
+
+    def invalidate(self, user_id: Optional[str] = None):
+        # Invalidate the cached results of a user, or of every user after a model change (by a new model version)
+        if user_id is not None:
+            self.__recommendation_cache.invalidate(user_id)
+            self.__prediction_cache.invalidate(user_id)
+            return
+        self.model_version += 1
+        self.__recommendation_cache.clear()
+        self.__prediction_cache.clear()
+
+    def cache_stats(self) -> pd.DataFrame:
+        # The size, bounds and hit, miss and eviction counters of the recommendation and prediction caches
+        return pd.DataFrame({"recommendations": self.__recommendation_cache.stats(),
+                             "predictions": self.__prediction_cache.stats()}).transpose()
+
+    @timed
+    def recommend_user(self, user_id: str, count: int, location: Optional[Tuple[float, float]] = None,
+                       radius: Optional[float] = None) -> pd.DataFrame:
+        # Get the ranked recommendations from the cache, or compute them (returning a copy the caller may modify)
+        return self.recommend_users([user_id], count, location, radius)[0]
+
+    @timed
+    def recommend_users(self, user_ids: Sequence[str], count: int, location: Optional[Tuple[float, float]] = None,
+                        radius: Optional[float] = None) -> List[pd.DataFrame]:
+        """
+        Recommend count restaurants to each of several users (see recommend_user), returning the same recommendations
+        as separate calls. Cached recommendations are looked up, and the others computed together: one CF and one CBF
+        candidate generation for the seed restaurants of all the users, and one batch of star predictions.
+        """
+        location = None if location is None else tuple(map(float, location))
+        keys = [(user_id, self.model_version, count, location, radius) for user_id in user_ids]
+        recommendations = [self.__recommendation_cache.get(key) for key in keys]
+        if missing := [i for i, cached in enumerate(recommendations) if cached is None]:
+            computed = self.__recommend_users([user_ids[i] for i in missing], count, location, radius)
+            for i, user_recommendations in zip(missing, computed):
+                recommendations[i] = user_recommendations
+                self.__recommendation_cache.put(keys[i], user_recommendations)
+        return [user_recommendations.copy() for user_recommendations in recommendations]
+
+    def __recommend_users(self, user_ids: Sequence[str], count: int, location: Optional[Tuple[float, float]] = None,
+                          radius: Optional[float] = None) -> List[pd.DataFrame]:
+        # Limit candidate generation to restaurants within radius kilometres of location (latitude, longitude)
+        candidates: Optional[pd.Index] = None
+        if location is not None and radius is not None:
+            with span("HybridRecommenderSystem.recommend_user/locate"):
+                candidates = self.__locator.within_radius(*location, radius).index
+
+        # Get the positions and ratings of the restaurants reviewed by each user
+        reviewed, seeds = [], []
+        for user_id in user_ids:
+            reviewed_positions, ratings = np.empty(0, dtype=np.int64), np.empty(0)
+            if (user_index := self.__user_index.get_indexer([user_id])[0]) >= 0:
+                start, stop = self.__user_ratings.indptr[user_index], self.__user_ratings.indptr[user_index + 1]
+                reviewed_positions = self.__user_ratings.indices[start:stop]
+                ratings = self.__user_ratings.data[start:stop]
+            reviewed.append(reviewed_positions)
+            # Generate candidates from each restaurant reviewed positively by the user
+            seeds.append(reviewed_positions[ratings > 0])
+        unique_seeds = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + seeds))
+
+        # Generate the CF and CBF candidate recommendations for the seeds of all users at once
+        cf_indices, cf_similarities, cbf_indices, cbf_similarities = self.__candidates(unique_seeds, count, candidates)
+
+        selections = []
+        with span("HybridRecommenderSystem.recommend_user/merge"):
+            for reviewed_positions, user_seeds in zip(reviewed, seeds):
+                rows = np.searchsorted(unique_seeds, user_seeds)
+                selections.append(self.__merge_candidates(
+                    cf_indices[rows], cf_similarities[rows], cbf_indices[rows], cbf_similarities[rows],
+                    reviewed_positions, count
+                ))
+
+        # Add the predicted star rating data to the recommendations, predicting for all users at once
+        sizes = [selected.size for selected, _, _ in selections]
+        business_ids = self._restaurants.index[np.concatenate([np.empty(0, dtype=np.int64)] +
+                                                              [selected for selected, _, _ in selections])]
+        with span("HybridRecommenderSystem.recommend_user/star_prediction"):
+            star_predictions = self.predict_stars_batch(np.repeat(np.asarray(user_ids), sizes),
+                                                        business_ids)
+        offsets = np.cumsum([0] + sizes)
+        return [pd.DataFrame({
+            "similarity": similarities,
+            "score": scores,
+            "star_prediction": star_predictions[start:stop]
+        }, index=pd.Index(business_ids[start:stop], name="business_id"))
+            for (_, similarities, scores), start, stop in zip(selections, offsets[:-1], offsets[1:])]
+
+    def __candidates(self, seed_positions: np.ndarray, count: int, candidates: Optional[pd.Index] = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # The CF and CBF candidates (restaurant positions, -1 padded) and similarities of each seed restaurant
+        seed_ids = self._restaurants.index[seed_positions]
+        with span("HybridRecommenderSystem.recommend_user/cf_candidates"):
+            cf_indices, cf_similarities = self.__rs_cf.item_item_batch(seed_ids, count, candidates)
+            cf_indices = np.where(cf_indices >= 0, self.__cf_positions[cf_indices], -1)
+        with span("HybridRecommenderSystem.recommend_user/cbf_candidates"):
+            cbf_indices, cbf_similarities = self.__rs_cbf.item_item_batch(seed_ids, count, candidates)
+        return cf_indices, cf_similarities, cbf_indices, cbf_similarities
+
+    def __merge_candidates(self, cf_indices: np.ndarray, cf_similarities: np.ndarray, cbf_indices: np.ndarray,
+                           cbf_similarities: np.ndarray, excluded_positions: np.ndarray, count: int) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Select the top count candidates (excluding excluded_positions) by their best weighted score, returning their
+        # positions (by score descending), and the similarity and score of the candidate which gave each its best score
+        # Flatten the candidates and apply the CF and CBF weightings
+        positions = np.concatenate((cf_indices.ravel(), cbf_indices.ravel()))
+        similarities = np.concatenate((cf_similarities.ravel(), cbf_similarities.ravel()))
+        scores = np.concatenate((cf_similarities.ravel() * 12.0, cbf_similarities.ravel() * 0.70))
+        valid = positions >= 0
+        positions, similarities, scores = positions[valid], similarities[valid], scores[valid]
+
+        # Take the best score of each candidate restaurant
+        best_scores = np.full(self.get_restaurant_count(), -np.inf)
+        np.maximum.at(best_scores, positions, scores)
+        # Remove previously-reviewed restaurants
+        best_scores[excluded_positions] = -np.inf
+
+        # Select the top count candidates and sort them by score descending (higher is better)
+        selected = np.flatnonzero(np.isfinite(best_scores))
+        if count < selected.size:
+            selected = selected[np.argpartition(-best_scores[selected], count - 1)[:count]]
+        selected = selected[np.argsort(-best_scores[selected], kind="stable")]
+
+        # Find the similarity of the candidate which gave each selected restaurant its best score
+        is_selected = np.zeros(self.get_restaurant_count(), dtype=bool)
+        is_selected[selected] = True
+        best = is_selected[positions] & (scores == best_scores[positions])
+        best_similarities = np.empty(self.get_restaurant_count())
+        best_similarities[positions[best]] = similarities[best]
+        return selected, best_similarities[selected], best_scores[selected]
+
+    @timed
+    def similar_restaurants(self, restaurant_ids: Sequence[str], count: int) -> List[pd.DataFrame]:
+        """
+        The count restaurants most similar to each restaurant, merging its CF and CBF neighbours with the weightings
+        used for recommendations (see recommend_user), with one candidate generation for all the restaurants.
+        Unknown restaurants have no similar restaurants.
+        """
+        positions = self._restaurants.index.get_indexer(restaurant_ids)
+        known = positions >= 0
+        cf_indices, cf_similarities, cbf_indices, cbf_similarities = self.__candidates(positions[known], count)
+        rows = np.cumsum(known) - 1
+        similar = []
+        for position, row in zip(positions, rows):
+            selected, similarities, scores = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)) if position < 0 \
+                else self.__merge_candidates(cf_indices[row], cf_similarities[row], cbf_indices[row],
+                                             cbf_similarities[row], np.array([position]), count)
+            similar.append(pd.DataFrame({"similarity": similarities, "score": scores},
+                                        index=pd.Index(self._restaurants.index[selected], name="business_id")))
+        return similar
+
+    @timed
+    def predict_stars_batch(self, user_ids: Sequence[str], restaurant_ids: Sequence[str],
+                            k: Optional[int] = None) -> np.ndarray:
+        # Look up the cached predictions (NaN where there is no prediction), computing and caching the others at once.
+        # Larger batches (e.g. evaluation or offline jobs) are computed without the cache: a lookup per pair would
+        # cost more than the vectorised prediction, and their single-use pairs would evict the cached recommendations
+        user_ids, restaurant_ids = np.asarray(user_ids), np.asarray(restaurant_ids)
+        if user_ids.size > MAX_CACHED_BATCH:
+            return self.__predict_stars_batch(user_ids, restaurant_ids, k)
+        version = self.model_version
+        keys = [(user_id, version, restaurant_id, k) for user_id, restaurant_id in zip(user_ids, restaurant_ids)]
+        cached = [self.__prediction_cache.get(key) for key in keys]
+        predictions = np.array([np.nan if prediction is None else prediction for prediction in cached], dtype=float)
+        missing = np.array([prediction is None for prediction in cached], dtype=bool)
+        if missing.any():
+            predictions[missing] = self.__predict_stars_batch(user_ids[missing], restaurant_ids[missing], k)
+            for i in np.flatnonzero(missing):
+                self.__prediction_cache.put(keys[i], float(predictions[i]))
+        return predictions
+
+    def __predict_stars_batch(self, user_ids: np.ndarray, restaurant_ids: np.ndarray,
+                              k: Optional[int] = None) -> np.ndarray:
+        # Get star predictions for CBF and CF (and MF if present)
+        ratings = [self.__rs_cbf.predict_stars_batch(user_ids, restaurant_ids, k),
+                   self.__rs_cf.predict_stars_batch(user_ids, restaurant_ids, k)]
+        if self.__rs_mf is not None:
+            ratings.append(self.__rs_mf.predict_stars_batch(user_ids, restaurant_ids))
+        # Average the star ratings which are not NaN (NaN if all are)
+        ratings = np.stack(ratings)
+        counts = np.sum(~np.isnan(ratings), axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(counts > 0, np.nansum(ratings, axis=0) / counts, np.nan)
 
+    @timed
     def predict_stars(self, user_id: str, restaurant_id: str, k: Optional[int] = None) -> Optional[float]:
-        # Get star predictions for CBF and CF
-        cbf_rating = self.__rs_cbf.predict_stars(user_id, restaurant_id, k)
-        cf_rating = self.__rs_cf.predict_stars(user_id, restaurant_id, k)
-
-        # Return the other if one is None
-        if cbf_rating is None:
-            return None if cf_rating is None else cf_rating
-        elif cf_rating is None:
-            return None if cbf_rating is None else cbf_rating
-        # Combine star rating from CBF with CF
-        return (cbf_rating + cf_rating) * 0.5
+        # Predict through predict_stars_batch, so both share one definition (and its cached predictions)
+        prediction = self.predict_stars_batch([user_id], [restaurant_id], k)[0]
+        return None if np.isnan(prediction) else float(prediction)
 
 # # %% if __name__ == "__main__":
 # from rs_data import load_data
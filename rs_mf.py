@@ -0,0 +1,186 @@
+# %%
+from pathlib import Path
+from typing import Optional, Sequence
+import pandas as pd
+import numpy as np
+from scipy.sparse import csr_matrix
+from rs_base import RecommenderBase, ReviewIndex
+from rs_artifacts import save_meta, load_meta, save_array, load_array, save_ids, load_ids, save_csr, load_csr
+from rs_similarity import BATCH_ENTRIES
+from rs_stats import timed
+
+
+# %%
+def outer_products(factors: np.ndarray) -> np.ndarray:
+    # The flattened outer product of each row of factors with itself
+    return (factors[:, :, np.newaxis] * factors[:, np.newaxis, :]).reshape(factors.shape[0], -1)
+
+
+def als_step(ratings: csr_matrix, fixed: np.ndarray, regularization: float) -> np.ndarray:
+    """
+    Solve the regularised least-squares problem of each row of ratings given the (fixed) factors of the columns:
+    (F_I' F_I + regularization * |I| * I) x = F_I' r, where I are the columns rated in the row.
+    Both sides are sparse products: the right-hand sides of the ratings with the factors, and the Gram matrices of
+    the rating pattern with the flattened outer products of the factors. Rows (and, for many columns, the outer
+    products) are processed in batches of at most BATCH_ENTRIES entries.
+    """
+    (n_rows, n_columns), factors = ratings.shape, fixed.shape[1]
+    pattern = csr_matrix((np.ones(ratings.indices.size), ratings.indices, ratings.indptr), shape=ratings.shape)
+    counts = np.diff(ratings.indptr)
+    right = np.asarray(ratings @ fixed)
+    solution = np.zeros((n_rows, factors))
+
+    step = max(1, BATCH_ENTRIES // (factors * factors))
+    column_chunks = [(start, min(start + step, n_columns)) for start in range(0, n_columns, step)]
+    outer = outer_products(fixed) if len(column_chunks) <= 1 else None
+    for start in range(0, n_rows, step):
+        rows = pattern[start:start + step]
+        if outer is not None:
+            gram = np.asarray(rows @ outer)
+        else:
+            gram = sum(np.asarray(rows[:, first:last] @ outer_products(fixed[first:last]))
+                       for first, last in column_chunks)
+        gram = gram.reshape(-1, factors, factors)
+        # Weight the regularisation by the number of ratings (keeping rows without ratings solvable)
+        gram += (regularization * np.maximum(counts[start:start + step], 1))[:, np.newaxis, np.newaxis] * \
+            np.eye(factors)
+        solution[start:start + step] = np.linalg.solve(gram, right[start:start + step, :, np.newaxis])[:, :, 0]
+    return solution
+
+
+# %%
+class MatrixFactorization(RecommenderBase):
+    """
+    Latent factor model of the normalised ratings fitted by alternating least squares, so a star prediction is the
+    dot product of a user and a restaurant factor vector (plus the user's average stars).
+    """
+    @timed
+    def __init__(self, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+                 review_index: Optional[ReviewIndex] = None, factors: int = 24, regularization: float = 0.1,
+                 iterations: int = 10, seed: int = 0):
+        super().__init__(restaurants, users, reviews, review_index)
+        self.__set_ratings(reviews)
+
+        # Alternately solve for the user factors and the restaurant factors
+        self.__parameters = dict(factors=factors, regularization=regularization, iterations=iterations, seed=seed)
+        rng = np.random.default_rng(seed)
+        self.user_factors: np.ndarray = rng.normal(0.0, 0.1, (self.__user_index.size, factors))
+        self.item_factors: np.ndarray = rng.normal(0.0, 0.1, (restaurants.shape[0], factors))
+        self.__fit()
+
+    def __set_ratings(self, reviews: pd.DataFrame):
+        # Sparse user by restaurant position matrix of normalised ratings (ordered by user ID)
+        self.__user_index: pd.Index = pd.Index(sorted(reviews["user_id"].unique()))
+        row = self.__user_index.get_indexer(reviews["user_id"])
+        col = self._restaurants.index.get_indexer(reviews["business_id"])
+        self.__ratings: csr_matrix = csr_matrix(
+            (reviews["rating"].to_numpy(dtype=np.float64)[col >= 0], (row[col >= 0], col[col >= 0])),
+            shape=(self.__user_index.size, self._restaurants.shape[0])
+        )
+
+    def __fit(self):
+        # Run the ALS iterations from the current factors
+        ratings_t: csr_matrix = self.__ratings.transpose().tocsr()
+        for _ in range(self.__parameters["iterations"]):
+            self.user_factors = als_step(self.__ratings, self.item_factors, self.__parameters["regularization"])
+            self.item_factors = als_step(ratings_t, self.user_factors, self.__parameters["regularization"])
+        self.__rated_items: np.ndarray = np.diff(ratings_t.indptr) > 0
+
+    @timed
+    def add_reviews(self, reviews: pd.DataFrame, users: Optional[pd.DataFrame] = None,
+                    restaurants: Optional[pd.DataFrame] = None, review_index: Optional[ReviewIndex] = None):
+        """
+        Add reviews (with any new or updated users and restaurants) and refit. ALS has no exact incremental update, so
+        every rating is refitted, but warm-started from the current factors (new users and restaurants start random).
+        A review of an already-reviewed restaurant replaces the user's previous rating.
+        review_index may be given if it has already been extended with the reviews (e.g. when shared).
+        """
+        self._add_data(reviews, users, restaurants, review_index)
+        user_index = self.__user_index
+        # The review index keeps the position of the latest review of each (user, restaurant) pair
+        self.__set_ratings(self._reviews.iloc[np.sort(self._review_index.positions)])
+
+        rng = np.random.default_rng(self.__parameters["seed"])
+        factors = self.__parameters["factors"]
+        user_factors = rng.normal(0.0, 0.1, (self.__user_index.size, factors))
+        user_factors[self.__user_index.get_indexer(user_index)] = self.user_factors
+        item_factors = rng.normal(0.0, 0.1, (self._restaurants.shape[0], factors))
+        # Restaurants are appended to the table, so the existing ones keep their positions
+        item_factors[:self.item_factors.shape[0]] = self.item_factors
+        self.user_factors, self.item_factors = user_factors, item_factors
+        self.__fit()
+
+    def save(self, path: Path):
+        # Save the factors, the rating matrix and the user index as arrays in the directory path
+        save_meta(path, "MatrixFactorization", **self.__parameters)
+        save_ids(path, "user_ids", self.__user_index)
+        save_csr(path, "ratings", self.__ratings)
+        save_array(path, "user_factors", self.user_factors)
+        save_array(path, "item_factors", self.item_factors)
+
+    @classmethod
+    @timed
+    def load(cls, path: Path, restaurants: pd.DataFrame, users: pd.DataFrame, reviews: pd.DataFrame,
+             review_index: Optional[ReviewIndex] = None, mmap_mode: Optional[str] = None) -> "MatrixFactorization":
+        """
+        Create a recommender from saved artifacts (see save) without refitting.
+        With mmap_mode="r" the model arrays are read-only memory-mapped views, shared between processes.
+        """
+        meta = load_meta(path, "MatrixFactorization")
+        recommender: MatrixFactorization = cls.__new__(cls)
+        RecommenderBase.__init__(recommender, restaurants, users, reviews, review_index)
+
+        recommender.__parameters = {name: meta[name] for name in ("factors", "regularization", "iterations", "seed")}
+        recommender.__user_index = pd.Index(load_ids(path, "user_ids"))
+        recommender.__ratings = load_csr(path, "ratings", mmap_mode)
+        recommender.user_factors = load_array(path, "user_factors", mmap_mode)
+        recommender.item_factors = load_array(path, "item_factors", mmap_mode)
+        recommender.__rated_items = np.bincount(recommender.__ratings.indices, minlength=restaurants.shape[0]) > 0
+        return recommender
+
+    @timed
+    def predict_stars_batch(self, user_ids: Sequence[str], restaurant_ids: Sequence[str],
+                            k: Optional[int] = None) -> np.ndarray:
+        """
+        Predict the star ratings of many (user, restaurant) pairs as row-wise dot products of their factors.
+        Returns NaN for unknown users and restaurants, and for restaurants without ratings. (k is ignored.)
+        """
+        user_ids = np.asarray(user_ids)
+        user_indices = self.__user_index.get_indexer(user_ids)
+        restaurant_indices = self._restaurants.index.get_indexer(restaurant_ids)
+        predictions = np.full(user_indices.size, np.nan)
+        known = np.flatnonzero((user_indices >= 0) & (restaurant_indices >= 0))
+        known = known[self.__rated_items[restaurant_indices[known]]]
+
+        predictions[known] = np.einsum(
+            "ij,ij->i", self.user_factors[user_indices[known]], self.item_factors[restaurant_indices[known]]
+        )
+        # Normalise the predictions for the users' average stars
+        predictions[known] += self._users["average_stars"].reindex(user_ids[known]).to_numpy()
+        return predictions
+
+    @timed
+    def predict_stars(self, user_id: str, restaurant_id: str, k: Optional[int] = None) -> Optional[float]:
+        prediction = self.predict_stars_batch([user_id], [restaurant_id])[0]
+        return None if np.isnan(prediction) else float(prediction)
+
+    @timed
+    def recommend_user(self, user_id: str, count: int) -> pd.DataFrame:
+        # Score every restaurant with a single matrix-vector product, excluding those the user has reviewed
+        scores = np.full(self.get_restaurant_count(), -np.inf)
+        if (user_index := self.__user_index.get_indexer([user_id])[0]) >= 0:
+            scores = self.item_factors @ self.user_factors[user_index]
+            scores[~self.__rated_items] = -np.inf
+            scores[self.__ratings.indices[self.__ratings.indptr[user_index]:self.__ratings.indptr[user_index + 1]]] = \
+                -np.inf
+
+        # Select the top count restaurants and sort them by score descending (higher is better)
+        selected = np.flatnonzero(np.isfinite(scores))
+        if count < selected.size:
+            selected = selected[np.argpartition(-scores[selected], count - 1)[:count]]
+        selected = selected[np.argsort(-scores[selected], kind="stable")]
+
+        return pd.DataFrame({
+            "score": scores[selected],
+            "star_prediction": scores[selected] + self._users["average_stars"].get(user_id, np.nan)
+        }, index=pd.Index(self._restaurants.index[selected], name="business_id"))
@@ -0,0 +1,122 @@
+# %%
+import argparse
+import hashlib
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Sequence, Tuple, Optional, List, Callable, Any
+import numpy as np
+from tqdm import tqdm
+from rs_data import DATA_PATH
+from rs_parallel import model_pool, get_model
+
+RECOMMENDATIONS_PATH: Path = DATA_PATH.joinpath("recommendations")  # Default path for offline recommendations
+
+
+# %%
+def shard_path(output_path: Path, shard: int) -> Path:
+    return output_path.joinpath(f"shard_{shard:05d}.jsonl")
+
+
+def recommend_shard(task: Tuple[int, Sequence[str], int, Path]) -> Tuple[int, int]:
+    # Write the recommendations for one shard of users, returning the shard and its number of users
+    shard, user_ids, count, output_path = task
+    model = get_model()
+
+    # Write to a temporary file and rename it once complete so partial shards are never mistaken as done
+    temporary_path = shard_path(output_path, shard).with_suffix(".tmp")
+    with open(temporary_path, "wt", encoding="utf8") as shard_file:
+        for user_id in user_ids:
+            recommendations = model.recommend_user(user_id, count)
+            shard_file.write(json.dumps({
+                "user_id": user_id,
+                "business_id": recommendations.index.tolist(),
+                "score": np.round(recommendations["score"].to_numpy(), 4).tolist(),
+                # NaN (no prediction) is written as null
+                "star_prediction": [None if np.isnan(stars) else round(float(stars), 4)
+                                    for stars in recommendations["star_prediction"]]
+            }) + "\n")
+    temporary_path.replace(shard_path(output_path, shard))
+    return shard, len(user_ids)
+
+
+def users_hash(user_ids: Sequence[str]) -> str:
+    # Hash an ordered list of user IDs
+    digest = hashlib.blake2b(digest_size=16)
+    for user_id in user_ids:
+        digest.update(user_id.encode("utf8") + b"\n")
+    return digest.hexdigest()
+
+
+def recommend_all(model, user_ids: Sequence[str], count: int, output_path: Path = RECOMMENDATIONS_PATH,
+                  processes: Optional[int] = None, shard_size: int = 1000,
+                  loader: Optional[Callable[[], Any]] = None, model_id: Optional[str] = None) -> int:
+    """
+    Compute the top count recommendations of every user, sharding the users across a process pool and streaming
+    each shard to a JSONL file in output_path. Shards already written by a previous (partial) run with the same
+    settings, users and model (model_id, e.g. rs_artifacts.model_version()) are skipped, and resuming a different run
+    is an error. Returns the number of users processed by this run.
+    The workers share model, or each load their own with loader (see rs_parallel.model_pool).
+    """
+    user_ids = sorted(user_ids)
+    shards: List[Sequence[str]] = [user_ids[i:i + shard_size] for i in range(0, len(user_ids), shard_size)]
+
+    # Record the run settings so a resumed run can check it is continuing the same job
+    output_path.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_path.joinpath("manifest.json")
+    manifest = {"count": count, "shard_size": shard_size, "users": len(user_ids), "shards": len(shards),
+                "users_hash": users_hash(user_ids), "model": model_id}
+    if manifest_path.exists():
+        if (previous := json.loads(manifest_path.read_text())) != manifest:
+            raise ValueError(f"'{output_path}' contains a different run ({previous}), cannot resume")
+    else:
+        manifest_path.write_text(json.dumps(manifest))
+
+    pending = [shard for shard in range(len(shards)) if not shard_path(output_path, shard).exists()]
+    pending_users = sum(len(shards[shard]) for shard in pending)
+    print(f"{len(shards) - len(pending)}/{len(shards)} shards already complete, {pending_users} users remaining")
+    if not pending:
+        return 0
+
+    start = time.perf_counter()
+    with model_pool(model, processes, loader) as pool, \
+            tqdm(total=len(user_ids), initial=len(user_ids) - pending_users, unit="users") as progress:
+        tasks = ((shard, shards[shard], count, output_path) for shard in pending)
+        for _, n in pool.imap_unordered(recommend_shard, tasks):
+            progress.update(n)
+    elapsed = time.perf_counter() - start
+    print(f"Finished: {pending_users} users in {elapsed:.1f}s ({pending_users / elapsed:.1f} users/s)")
+    return pending_users
+
+
+# %%
+def main() -> int:
+    from rs_data import load_users
+    from rs_cli import load_model, mmap_model_loader
+    from rs_artifacts import model_version
+
+    parser = argparse.ArgumentParser(description="Precompute the top recommendations of every user.")
+    parser.add_argument("--count", type=int, default=10, help="number of recommendations per user")
+    parser.add_argument("--output", type=Path, default=RECOMMENDATIONS_PATH, help="output directory")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--shard-size", type=int, default=1000, help="number of users per output shard")
+    parser.add_argument("--model-dir", type=Path, default=None, help="directory of saved models to load from")
+    parser.add_argument("--mmap", action="store_true",
+                        help="have each worker memory-map the saved model (requires --model-dir)")
+    args = parser.parse_args()
+
+    print("Loading data...")
+    if args.mmap and args.model_dir is not None:
+        # Have each worker memory-map the saved model (with the tables loaded once here) rather than copying it
+        model, loader = None, mmap_model_loader(args.model_dir)
+    else:
+        model, loader = load_model(args.model_dir), None
+    print("Done")
+    recommend_all(model, load_users().index.tolist(), args.count, args.output, args.processes, args.shard_size, loader,
+                  model_version())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# %%
+import multiprocessing
+from multiprocessing.pool import Pool
+from typing import Optional, Any, Callable
+
+_model: Any = None  # The fitted model shared by the worker processes
+
+
+# %%
+def _initialise_worker(model: Any):
+    global _model
+    _model = model
+
+
+def _load_worker_model(loader: Callable[[], Any]):
+    global _model
+    _model = loader()
+
+
+def get_model() -> Any:
+    # Get the fitted model within a worker process
+    return _model
+
+
+def model_pool(model: Any, processes: Optional[int] = None, loader: Optional[Callable[[], Any]] = None) -> Pool:
+    """
+    Create a process pool whose workers share a fitted model (fetched with get_model).
+    Where fork is available workers inherit the parent's model pages copy-on-write, so the model is only read,
+    never copied; otherwise the model is pickled to each worker once when it starts.
+    If loader is given each worker instead calls it to load its own model, e.g. from memory-mapped artifacts so the
+    model arrays are shared through the page cache. Where fork is available the loader (and any tables it holds) is
+    inherited rather than pickled to each worker.
+    """
+    if loader is not None:
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        return context.Pool(processes, initializer=_load_worker_model, initargs=(loader,))
+    if "fork" in multiprocessing.get_all_start_methods():
+        _initialise_worker(model)
+        return multiprocessing.get_context("fork").Pool(processes)
+    return multiprocessing.Pool(processes, initializer=_initialise_worker, initargs=(model,))
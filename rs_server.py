@@ -0,0 +1,480 @@
+# %%
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit, urlencode
+import numpy as np
+import rs_stats
+
+WINDOW = 0.005  # Seconds a batch waits for more concurrent requests after its first request
+MAX_BATCH = 64  # Maximum number of requests scored in one batch
+SAMPLES = 4096  # Number of recent batch sizes and latencies kept per endpoint for the percentiles
+DEFAULT_COUNT = 10  # Number of recommendations or similar restaurants returned when no count is given
+MAX_COUNT = 1000  # Maximum number of recommendations or similar restaurants a request may ask for
+ENDPOINTS = ("/recommendations", "/predict", "/similar")  # Batched endpoints (as well as /stats)
+
+
+# %%
+class HTTPError(Exception):
+    # An error returned to the client as a JSON response with an HTTP status
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status: HTTPStatus = status
+
+
+def summary(values: Sequence[float], scale: float = 1.0) -> Dict[str, Optional[float]]:
+    # Mean, percentiles (see rs_stats.PERCENTILES) and maximum of values (times scale), or None if there are none
+    if len(values) == 0:
+        return {"mean": None, **{f"p{p}": None for p in rs_stats.PERCENTILES}, "max": None}
+    values = np.asarray(values, dtype=np.float64) * scale
+    percentiles = np.percentile(values, rs_stats.PERCENTILES)
+    return {"mean": float(values.mean()),
+            **{f"p{p}": float(value) for p, value in zip(rs_stats.PERCENTILES, percentiles)},
+            "max": float(values.max())}
+
+
+def json_value(value: Any) -> Any:
+    # Convert a value to plain JSON types, with NaN (no prediction) as null
+    if isinstance(value, dict):
+        return {str(key): json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [json_value(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+# %%
+class MicroBatcher:
+    """
+    Collect concurrent requests into batches, each waiting up to window seconds after its first request (or until
+    there are max_batch requests), and score each batch with one call of function in executor, so the event loop keeps
+    accepting requests while a batch is scored (and the next batch grows). function takes a list of requests and
+    returns a list of their results, where a result which is an exception is raised for its request only.
+    """
+
+    def __init__(self, function: Callable[[List[Any]], List[Any]], executor: ThreadPoolExecutor,
+                 window: float = WINDOW, max_batch: int = MAX_BATCH):
+        self.function: Callable[[List[Any]], List[Any]] = function
+        self.window: float = window
+        self.max_batch: int = max(max_batch, 1)
+        self.batches: int = 0
+        self.requests: int = 0
+        self.batch_sizes: Deque[int] = deque(maxlen=SAMPLES)
+        self.batch_seconds: Deque[float] = deque(maxlen=SAMPLES)
+        self.__executor: ThreadPoolExecutor = executor
+        self.__queue: Optional[asyncio.Queue] = None
+        self.__full: Optional[asyncio.Event] = None
+        self.__task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # Start collecting batches (in the running event loop)
+        self.__queue, self.__full = asyncio.Queue(), asyncio.Event()
+        self.__task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+
+    async def submit(self, request: Any) -> Any:
+        # Queue a request for the next batch and wait for its result
+        future = asyncio.get_running_loop().create_future()
+        self.__queue.put_nowait((request, future))
+        if self.__queue.qsize() >= self.max_batch - 1:
+            self.__full.set()
+        return await future
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.__queue.get()]
+            # Wait for more requests, unless there are already enough for a full batch
+            if self.window > 0 and self.__queue.qsize() < self.max_batch - 1:
+                self.__full.clear()
+                try:
+                    await asyncio.wait_for(self.__full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.__executor, self.function, [request for request, _ in batch])
+            except Exception as error:
+                results = [error] * len(batch)
+            self.batches += 1
+            self.requests += len(batch)
+            self.batch_sizes.append(len(batch))
+            self.batch_seconds.append(time.perf_counter() - start)
+
+            for (_, future), result in zip(batch, results):
+                # Skip requests whose client has gone
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        # The number of batches and requests, and the batch size and batch scoring time (ms) statistics
+        return {"batches": self.batches, "requests": self.requests,
+                "batch_size": summary(self.batch_sizes), "batch_ms": summary(self.batch_seconds, 1000.0)}
+
+
+# %%
+def get_parameter(query: Dict[str, str], name: str, parse: Callable[[str], Any] = str, default: Any = None,
+                  required: bool = False, minimum: Optional[float] = None, maximum: Optional[float] = None) -> Any:
+    # Get a query parameter, parsed by parse (a bad request if it is invalid, outside [minimum, maximum], or missing but
+    # required)
+    if (value := query.get(name)) is None or value == "":
+        if required:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Missing parameter '{name}'")
+        return default
+    try:
+        parsed = parse(value)
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid parameter '{name}': '{value}'")
+    if minimum is not None and parsed < minimum:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Parameter '{name}' must be at least {minimum}")
+    if maximum is not None and parsed > maximum:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Parameter '{name}' must be at most {maximum}")
+    return parsed
+
+
+def group_requests(keys: Sequence[Any]) -> Dict[Any, List[int]]:
+    # The indices of the requests with each key (the options which must be the same to be scored together)
+    groups: Dict[Any, List[int]] = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    return groups
+
+
+def score_groups(requests: Sequence[Any], keys: Sequence[Any],
+                 score: Callable[[Any, List[Any]], List[Any]]) -> List[Any]:
+    """
+    Score the requests with each key together (score takes the key and the group's requests, and returns their
+    results). If a group fails, its requests are scored one at a time, so a failing request only fails itself (its
+    result is the exception).
+    """
+    results: List[Any] = [None] * len(requests)
+    for key, indices in group_requests(keys).items():
+        try:
+            group_results = score(key, [requests[i] for i in indices])
+        except Exception:
+            group_results = []
+            for i in indices:
+                try:
+                    group_results.append(score(key, [requests[i]])[0])
+                except Exception as error:
+                    group_results.append(error)
+        for i, result in zip(indices, group_results):
+            results[i] = result
+    return results
+
+
+class RecommenderServer:
+    """
+    Asynchronous HTTP/1.1 JSON server for a recommender (HybridRecommenderSystem), which micro-batches concurrent
+    requests (see MicroBatcher). The recommender is only used by a single worker thread, one batch at a time.
+    GET endpoints:
+        /recommendations?user_id=&count=&latitude=&longitude=&radius=  recommendations for a user (see recommend_user)
+        /predict?user_id=&business_id=&k=  star prediction of a user for a restaurant (null if there is none)
+        /similar?business_id=&count=  the restaurants most similar to a restaurant
+        /stats  request, latency and batch size statistics of each endpoint, with the cache and span statistics
+    A count must be between 1 and MAX_COUNT (scoring allocates arrays of count entries per request).
+    """
+
+    def __init__(self, rs, window: float = WINDOW, max_batch: int = MAX_BATCH):
+        self.rs = rs
+        self.__executor: ThreadPoolExecutor = ThreadPoolExecutor(1, thread_name_prefix="rs_server")
+        self.__batchers: Dict[str, MicroBatcher] = {
+            "/recommendations": MicroBatcher(self.__recommend_batch, self.__executor, window, max_batch),
+            "/predict": MicroBatcher(self.__predict_batch, self.__executor, window, max_batch),
+            "/similar": MicroBatcher(self.__similar_batch, self.__executor, window, max_batch)
+        }
+        self.__requests: Counter = Counter()
+        self.__errors: Counter = Counter()
+        self.__latencies: Dict[str, Deque[float]] = {path: deque(maxlen=SAMPLES) for path in ENDPOINTS}
+        self.__server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> int:
+        # Start serving (in the running event loop), returning the port (which is chosen if port is 0)
+        for batcher in self.__batchers.values():
+            batcher.start()
+        self.__server = await asyncio.start_server(self.__handle_connection, host, port)
+        return self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+        for batcher in self.__batchers.values():
+            await batcher.stop()
+        self.__executor.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        # The requests, errors and latency (ms, from request to response) of each endpoint, with its batch statistics
+        return {"endpoints": {path: {"requests": self.__requests[path], "errors": self.__errors[path],
+                                     "latency_ms": summary(self.__latencies[path], 1000.0),
+                                     "batching": self.__batchers[path].stats()} for path in ENDPOINTS},
+                "caches": self.rs.cache_stats().to_dict(orient="index"),
+                "spans": rs_stats.snapshot()}
+
+    # Batch scoring (in the worker thread)
+    def __recommend_batch(self, requests: List[Tuple[str, int, Optional[Tuple[float, float]], Optional[float]]]) \
+            -> List[Any]:
+        return score_groups(requests, [request[1:] for request in requests], self.__recommend_group)
+
+    def __recommend_group(self, options: Tuple[int, Optional[Tuple[float, float]], Optional[float]],
+                          requests: List[Tuple[str, int, Optional[Tuple[float, float]], Optional[float]]]) -> List[Any]:
+        results: List[Any] = [None] * len(requests)
+        known = []
+        for i, (user_id, *_) in enumerate(requests):
+            if self.rs.get_user_by_id(user_id) is None:
+                results[i] = HTTPError(HTTPStatus.NOT_FOUND, f"Unknown user '{user_id}'")
+            else:
+                known.append(i)
+        recommendations = self.rs.recommend_users([requests[i][0] for i in known], *options) if known else []
+        for i, user_recommendations in zip(known, recommendations):
+            results[i] = {"user_id": requests[i][0],
+                          "recommendations": user_recommendations.reset_index().to_dict(orient="records")}
+        return results
+
+    def __predict_batch(self, requests: List[Tuple[str, str, Optional[int]]]) -> List[Any]:
+        return score_groups(requests, [request[2] for request in requests], self.__predict_group)
+
+    def __predict_group(self, k: Optional[int], requests: List[Tuple[str, str, Optional[int]]]) -> List[Any]:
+        predictions = self.rs.predict_stars_batch([user_id for user_id, _, _ in requests],
+                                                  [restaurant_id for _, restaurant_id, _ in requests], k)
+        return [{"user_id": user_id, "business_id": restaurant_id, "star_prediction": prediction}
+                for (user_id, restaurant_id, _), prediction in zip(requests, predictions)]
+
+    def __similar_batch(self, requests: List[Tuple[str, int]]) -> List[Any]:
+        return score_groups(requests, [request[1] for request in requests], self.__similar_group)
+
+    def __similar_group(self, count: int, requests: List[Tuple[str, int]]) -> List[Any]:
+        similar = self.rs.similar_restaurants([restaurant_id for restaurant_id, _ in requests], count)
+        return [HTTPError(HTTPStatus.NOT_FOUND, f"Unknown restaurant '{restaurant_id}'")
+                if self.rs.get_restaurant_by_id(restaurant_id) is None else
+                {"business_id": restaurant_id, "similar": restaurants.reset_index().to_dict(orient="records")}
+                for (restaurant_id, _), restaurants in zip(requests, similar)]
+
+    # Request handling (in the event loop)
+    async def __respond(self, method: str, target: str) -> Tuple[HTTPStatus, Any]:
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path != "/stats" and url.path not in self.__batchers:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"Unknown path '{url.path}'")
+        if method != "GET":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"Method {method} not allowed")
+
+        if url.path == "/stats":
+            return HTTPStatus.OK, self.stats()
+        if url.path == "/recommendations":
+            # Recommendations are only limited to a radius of a location if all three are given
+            latitude = get_parameter(query, "latitude", float)
+            longitude = get_parameter(query, "longitude", float)
+            location = None if latitude is None or longitude is None else (latitude, longitude)
+            user_id = get_parameter(query, "user_id", required=True)
+            request = (user_id, get_parameter(query, "count", int, DEFAULT_COUNT, minimum=1, maximum=MAX_COUNT),
+                       location, get_parameter(query, "radius", float, minimum=0))
+        elif url.path == "/predict":
+            request = (get_parameter(query, "user_id", required=True),
+                       get_parameter(query, "business_id", required=True), get_parameter(query, "k", int, minimum=1))
+        else:
+            request = (get_parameter(query, "business_id", required=True),
+                       get_parameter(query, "count", int, DEFAULT_COUNT, minimum=1, maximum=MAX_COUNT))
+        return HTTPStatus.OK, await self.__batchers[url.path].submit(request)
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Serve the requests of a (keep-alive) connection in turn until it is closed
+        try:
+            while request_line := await reader.readline():
+                start = time.perf_counter()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                # Requests have no body, so discard any
+                if length := int(headers.get("content-length", 0)):
+                    await reader.readexactly(length)
+
+                parts = request_line.decode("latin-1").split()
+                path, version = None, parts[2] if len(parts) == 3 else "HTTP/1.0"
+                try:
+                    if len(parts) != 3:
+                        raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+                    path = urlsplit(parts[1]).path
+                    status, payload = await self.__respond(parts[0], parts[1])
+                except HTTPError as error:
+                    status, payload = error.status, {"error": str(error)}
+                except Exception as error:
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(error)}
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                body = json.dumps(json_value(payload)).encode()
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                             f"\r\n\r\n".encode("latin-1") + body)
+                await writer.drain()
+
+                if path in self.__latencies:
+                    self.__requests[path] += 1
+                    self.__errors[path] += status != HTTPStatus.OK
+                    self.__latencies[path].append(time.perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # The client went away, or sent a malformed header or an overlong line
+            pass
+        finally:
+            writer.close()
+
+
+# %%
+async def fetch(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, target: str) \
+        -> Tuple[int, bytes]:
+    # Send a GET request on a keep-alive connection, returning the response status and body
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+def load_test_targets(user_ids: Sequence[str], restaurant_ids: Sequence[str], requests: int,
+                      endpoints: Sequence[str] = ENDPOINTS, count: int = DEFAULT_COUNT, seed: int = 0) -> List[str]:
+    # A seeded random sequence of requests to the endpoints (in turn) for random users and restaurants
+    rng = np.random.default_rng(seed)
+    users = np.asarray(user_ids)[rng.integers(0, len(user_ids), requests)]
+    restaurants = np.asarray(restaurant_ids)[rng.integers(0, len(restaurant_ids), requests)]
+    parameters = {
+        "/recommendations": lambda i: {"user_id": users[i], "count": count},
+        "/predict": lambda i: {"user_id": users[i], "business_id": restaurants[i]},
+        "/similar": lambda i: {"business_id": restaurants[i], "count": count}
+    }
+    return [f"{endpoint}?{urlencode(parameters[endpoint](i))}"
+            for i, endpoint in zip(range(requests), np.resize(np.asarray(endpoints), requests))]
+
+
+async def load_test(host: str, port: int, targets: Sequence[str], concurrency: int = 32) -> Dict[str, Any]:
+    """
+    Send the requests (targets, paths with queries) to a server over concurrency keep-alive connections, each sending
+    its next request when the previous is answered. Returns the throughput, the latency (ms) statistics and the
+    number of responses with each status.
+    """
+    remaining = iter(targets)
+    latencies, statuses = [], Counter()
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for target in remaining:
+                start = time.perf_counter()
+                status, _ = await fetch(reader, writer, host, target)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests": len(latencies), "concurrency": concurrency, "seconds": elapsed,
+            "requests_per_second": len(latencies) / elapsed, "latency_ms": summary(latencies, 1000.0),
+            "statuses": dict(statuses)}
+
+
+async def load_test_synthetic(size: Tuple[int, int, int], requests: int, concurrency: int,
+                              window: float = WINDOW, max_batch: int = MAX_BATCH, seed: int = 0) -> Dict[str, Any]:
+    # Serve a recommender fitted on synthetic data (see rs_synthetic) on a localhost port, and load test it
+    from rs_synthetic import make_synthetic_data
+    from rs_hybrid import HybridRecommenderSystem
+
+    restaurants, users, reviews = make_synthetic_data(*size, seed=seed)
+    server = RecommenderServer(HybridRecommenderSystem(restaurants, users, reviews), window, max_batch)
+    port = await server.start("127.0.0.1", 0)
+    try:
+        results = await load_test("127.0.0.1", port, load_test_targets(users.index, restaurants.index, requests,
+                                                                       seed=seed), concurrency)
+        return {"client": results, "server": server.stats()["endpoints"]}
+    finally:
+        await server.stop()
+
+
+# %%
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Serve the hybrid recommender over HTTP, or load test a server.")
+    parser.add_argument("command", choices=("serve", "load-test"),
+                        help="serve: run the server, load-test: send random requests to a server on --host and --port "
+                             "(or with --synthetic, to a server on synthetic data in this process)")
+    parser.add_argument("--host", default="127.0.0.1", help="host to serve on or to load test")
+    parser.add_argument("--port", type=int, default=8080, help="port to serve on or to load test")
+    parser.add_argument("--window", type=float, default=WINDOW,
+                        help="seconds a batch waits for more concurrent requests (0 to not wait)")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH,
+                        help="maximum requests per batch (1 to score requests one at a time)")
+    parser.add_argument("--model-dir", type=Path, default=None,
+                        help="directory of saved models, used (and populated) to avoid refitting on startup")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory-map the saved model arrays (read-only) instead of reading them into memory")
+    parser.add_argument("--stats", action="store_true", help="record timing statistics of the recommender stages")
+    parser.add_argument("--requests", type=int, default=2000, help="number of load test requests")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of concurrent load test connections")
+    parser.add_argument("--synthetic", type=int, nargs=3, default=None, metavar=("RESTAURANTS", "USERS", "REVIEWS"),
+                        help="load test a server on synthetic data of this size")
+    args = parser.parse_args()
+    if args.stats:
+        rs_stats.enable()
+
+    if args.command == "load-test":
+        if args.synthetic is not None:
+            results = asyncio.run(load_test_synthetic(tuple(args.synthetic), args.requests, args.concurrency,
+                                                      args.window, args.max_batch))
+        else:
+            from rs_data import load_restaurants, load_users
+            targets = load_test_targets(load_users([]).index, load_restaurants([]).index, args.requests)
+            results = asyncio.run(load_test(args.host, args.port, targets, args.concurrency))
+        print(json.dumps(json_value(results), indent=2))
+        return 0
+
+    from rs_cli import load_model
+
+    async def serve():
+        print("Loading data...")
+        rs = load_model(args.model_dir, "r" if args.mmap and args.model_dir is not None else None)
+        server = RecommenderServer(rs, args.window, args.max_batch)
+        port = await server.start(args.host, args.port)
+        print(f"Serving on http://{args.host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+# %%
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+from rs_artifacts import save_array, load_array
+
+BLOCK_BYTES = 1 << 26  # Upper bound on the size of a dense similarity block (64MiB)
+BATCH_ENTRIES = 1 << 24  # Upper bound on the number of entries in an intermediate batch matrix
+
+
+# %%
+def block_rows(shape: Tuple[int, int], block_size: Optional[int] = None) -> int:
+    # Choose a number of rows per block such that a dense float64 block stays within BLOCK_BYTES
+    if block_size is not None:
+        return max(1, block_size)
+    return int(max(1, min(shape[0], BLOCK_BYTES // (8 * max(1, shape[1])))))
+
+
+def top_k_columns(block: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Select the k largest values of each row of a dense block, using a partial sort where possible
+    k = min(k, block.shape[1])
+    if k < block.shape[1]:
+        columns = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.tile(np.arange(block.shape[1]), (block.shape[0], 1))
+    values = np.take_along_axis(block, columns, axis=1)
+
+    # Sort the selected values of each row by similarity descending
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def top_k_rows(block: np.ndarray, k: int, threshold: Optional[float] = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Select the sorted top k of each row as CSR-style (row counts, columns, values)
+    columns, values = top_k_columns(block, k)
+
+    # Discard excluded (-inf) entries and those below the similarity floor
+    keep = np.isfinite(values) if threshold is None else values >= threshold
+    return keep.sum(axis=1), columns[keep], values[keep]
+
+
+def restrict_columns(indices: np.ndarray, similarities: np.ndarray, candidates: np.ndarray, count: int) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    # Keep the first count entries of each (sorted, -1 padded) row whose column is among the candidates
+    keep = (indices >= 0) & np.isin(indices, candidates)
+    order = np.argsort(~keep, axis=1, kind="stable")[:, :count]
+    keep = np.take_along_axis(keep, order, axis=1)
+    return np.where(keep, np.take_along_axis(indices, order, axis=1), -1), \
+        np.where(keep, np.take_along_axis(similarities, order, axis=1), np.nan)
+
+
+def top_k_batch(matrix: np.ndarray, rows: np.ndarray, count: int, candidates: Optional[np.ndarray] = None) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The count largest (column, value) pairs of each of the given rows of a dense matrix (optionally only considering
+    the candidate columns) as (len(rows), count) arrays sorted descending, padded with -1 and NaN.
+    Rows are copied and partially sorted in blocks to bound memory.
+    """
+    columns = np.arange(matrix.shape[1]) if candidates is None else np.asarray(candidates)
+    width = min(count, columns.size)
+    indices = np.full((rows.size, count), -1, dtype=np.int64)
+    values = np.full((rows.size, count), np.nan)
+    if width == 0:
+        return indices, values
+
+    step = block_rows((rows.size, columns.size))
+    for start in range(0, rows.size, step):
+        chunk = rows[start:start + step]
+        block = matrix[chunk] if candidates is None else matrix[np.ix_(chunk, columns)]
+        block_indices, values[start:start + step, :width] = top_k_columns(block, width)
+        indices[start:start + step, :width] = columns[block_indices]
+    return indices, values
+
+
+# %%
+class NeighbourIndex:
+    """Top-k neighbour lists stored as CSR arrays, with each row sorted by similarity descending."""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, similarities: np.ndarray, shape: Tuple[int, int]):
+        self.indptr: np.ndarray = indptr
+        self.indices: np.ndarray = indices
+        self.similarities: np.ndarray = similarities
+        self.shape: Tuple[int, int] = shape
+
+    @classmethod
+    def build(cls, block_similarity: Callable[[int, int], np.ndarray], shape: Tuple[int, int], k: int,
+              threshold: Optional[float] = None, exclude_diagonal: bool = True,
+              block_size: Optional[int] = None) -> "NeighbourIndex":
+        """
+        Build the index one block of rows at a time so only a single dense block is held in memory.
+        block_similarity(start, stop) must return the dense similarities of rows [start, stop) to every column.
+        """
+        n_rows, n_cols = shape
+        step = block_rows(shape, block_size)
+
+        counts, indices, similarities = [], [], []
+        for start in range(0, n_rows, step):
+            stop = min(start + step, n_rows)
+            block = np.asarray(block_similarity(start, stop), dtype=np.float64)
+            if exclude_diagonal:
+                # Exclude each row from its own neighbour list
+                rows = np.arange(start, min(stop, n_cols))
+                block[rows - start, rows] = -np.inf
+            block_counts, block_indices, block_similarities = top_k_rows(block, k, threshold)
+            counts.append(block_counts)
+            indices.append(block_indices.astype(np.int32))
+            similarities.append(block_similarities.astype(np.float32))
+            del block
+
+        return cls.__from_counts(
+            np.concatenate(counts) if counts else np.zeros(n_rows, dtype=np.int64),
+            np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+            np.concatenate(similarities) if similarities else np.empty(0, dtype=np.float32),
+            shape
+        )
+
+    @classmethod
+    def __from_counts(cls, counts: np.ndarray, indices: np.ndarray, similarities: np.ndarray,
+                      shape: Tuple[int, int]) -> "NeighbourIndex":
+        # Create an index from the neighbour counts of each row and the (row-ordered) neighbours
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        # Match the index dtypes so the arrays can be used as a CSR matrix without copying
+        if indptr[-1] <= np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        return cls(indptr, indices.astype(np.int32), similarities.astype(np.float32), shape)
+
+    def update(self, changed: np.ndarray, changed_similarity: Callable[[np.ndarray], np.ndarray], n: int, k: int,
+               threshold: Optional[float] = None, block_size: Optional[int] = None) -> "NeighbourIndex":
+        """
+        Create an index of a symmetric similarity over n (at least self.shape) rows, in which the similarities of the
+        changed rows (including any new rows) have been recomputed and the rest are unchanged.
+        changed_similarity(rows) must return the dense similarities of the given changed rows to every column.
+        Changed rows are rebuilt. Every other row keeps its unchanged neighbours and, by symmetry, merges in its new
+        similarities to the changed rows, so (until the next full build) a changed neighbour whose similarity fell is
+        not replaced by an unlisted row which is now more similar.
+        """
+        changed = np.asarray(changed, dtype=np.int64)
+        is_changed = np.zeros(n, dtype=bool)
+        is_changed[changed] = True
+
+        # Keep the neighbours of the unchanged rows which are themselves unchanged
+        old_rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        keep = ~is_changed[old_rows] & ~is_changed[self.indices]
+        rows, indices, similarities = [old_rows[keep]], [self.indices[keep]], [self.similarities[keep]]
+
+        # Rows already holding k neighbours can only take a changed row more similar than their last (lowest) one
+        kept_counts = np.bincount(rows[0], minlength=n)
+        lowest = np.full(n, -np.inf)
+        full = np.flatnonzero(kept_counts >= k)
+        lowest[full] = similarities[0][np.cumsum(kept_counts)[full] - 1]
+        if threshold is not None:
+            lowest = np.maximum(lowest, threshold)
+
+        step = block_rows((changed.size, n), block_size)
+        for start in range(0, changed.size, step):
+            block_rows_ = changed[start:start + step]
+            block = np.asarray(changed_similarity(block_rows_), dtype=np.float64)
+            # Exclude each row from its own neighbour list
+            block[np.arange(block_rows_.size), block_rows_] = -np.inf
+            # Rebuild the changed rows
+            block_counts, block_indices, block_similarities = top_k_rows(block, k, threshold)
+            rows.append(np.repeat(block_rows_, block_counts))
+            indices.append(block_indices)
+            similarities.append(block_similarities)
+            # Offer the changed rows as neighbours of the unchanged rows
+            offered, other = np.nonzero((block >= lowest) & ~is_changed & np.isfinite(block))
+            rows.append(other)
+            indices.append(block_rows_[offered])
+            similarities.append(block[offered, other])
+            del block
+
+        # Sort each row by similarity descending and keep its first k neighbours
+        rows, indices, similarities = np.concatenate(rows), np.concatenate(indices), np.concatenate(similarities)
+        order = np.lexsort((-similarities, rows))
+        rows, indices, similarities = rows[order], indices[order], similarities[order]
+        counts = np.bincount(rows, minlength=n)
+        rank = np.arange(rows.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank < k
+        return self.__from_counts(np.minimum(counts, k), indices[keep], similarities[keep], (n, n))
+
+    def neighbours(self, index: int, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Rows are stored sorted, so the k nearest neighbours are a slice of the row
+        start, stop = self.indptr[index], self.indptr[index + 1]
+        if k is not None:
+            stop = min(stop, start + k)
+        return self.indices[start:stop], self.similarities[start:stop]
+
+    def neighbours_batch(self, rows: np.ndarray, k: int, candidates: Optional[np.ndarray] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        # The k nearest neighbours of many rows as (len(rows), k) arrays, padded with -1 indices and NaN similarities
+        rows = np.asarray(rows)
+        if candidates is not None:
+            # Read the full neighbour lists then keep the first k among the candidates
+            width = int(np.max(self.indptr[rows + 1] - self.indptr[rows], initial=0))
+            return restrict_columns(*self.neighbours_batch(rows, max(width, k)), candidates, k)
+        starts = self.indptr[rows]
+        counts = np.minimum(self.indptr[rows + 1] - starts, k)
+        valid = np.arange(k) < counts[:, np.newaxis]
+        positions = np.where(valid, starts[:, np.newaxis] + np.arange(k), 0)
+        if self.indices.size == 0:
+            return np.full(valid.shape, -1, dtype=np.int64), np.full(valid.shape, np.nan)
+        return np.where(valid, self.indices[positions], -1), np.where(valid, self.similarities[positions], np.nan)
+
+    def to_csr(self) -> csr_matrix:
+        return csr_matrix((self.similarities, self.indices, self.indptr), shape=self.shape, copy=False)
+
+    def save(self, path: Path, name: str):
+        save_array(path, f"{name}_indptr", self.indptr)
+        save_array(path, f"{name}_indices", self.indices)
+        save_array(path, f"{name}_similarities", self.similarities)
+        save_array(path, f"{name}_shape", np.asarray(self.shape, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path: Path, name: str, mmap_mode: Optional[str] = None) -> "NeighbourIndex":
+        return cls(
+            load_array(path, f"{name}_indptr", mmap_mode),
+            load_array(path, f"{name}_indices", mmap_mode),
+            load_array(path, f"{name}_similarities", mmap_mode),
+            tuple(load_array(path, f"{name}_shape"))
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.similarities.nbytes
+
+
+# %%
+class CosineIVF:
+    """
+    Approximate cosine nearest neighbour index over the rows of a sparse matrix (an inverted file index): the
+    normalised rows are clustered into lists by spherical k-means, and a query is ranked by exact cosine similarity
+    against the members of its probes most similar lists. Query cost is roughly probes / lists of a brute-force
+    search; more probes raise recall.
+    The index refers to vectors (scaling dot products by the inverse row norms) rather than copying them, and can be
+    saved and loaded (memory-mapped) with them, so it is fitted once.
+    """
+
+    def __init__(self, vectors: csr_matrix, lists: Optional[int] = None, probes: int = 8, iterations: int = 10,
+                 sample_size: int = 1 << 14, seed: int = 0):
+        n = vectors.shape[0]
+        self.lists: int = max(1, min(n, int(np.sqrt(n)) if lists is None else lists))
+        self.probes: int = min(probes, self.lists)
+        self.vectors: csr_matrix = vectors.tocsr()
+        self.inverse_norms: np.ndarray = self.__inverse_norms(self.vectors)
+
+        # Fit the centroids on a sample of the (normalised) rows, starting from random sample rows
+        rng = np.random.default_rng(seed)
+        sample = normalize(self.vectors[np.sort(rng.choice(n, min(n, max(sample_size, self.lists)), replace=False))])
+        self.centroids: np.ndarray = sample[rng.choice(sample.shape[0], self.lists, replace=False)].toarray()
+        for _ in range(iterations):
+            assignment = self.__nearest_lists(sample, 1)[:, 0]
+            # Move each centroid to the normalised mean of its rows (keeping the centroids of empty lists)
+            members = csr_matrix((np.ones(assignment.size), (assignment, np.arange(assignment.size))),
+                                 shape=(self.lists, assignment.size))
+            sums = np.asarray((members @ sample).todense())
+            filled = np.asarray(members.sum(axis=1)).ravel() > 0
+            self.centroids[filled] = normalize(sums[filled])
+
+        # Assign every row to its nearest list (which does not depend on the row's norm), ordering the rows by list so
+        # a list is a slice of the ordered rows
+        self.assignment: np.ndarray = np.concatenate([
+            self.__nearest_lists(self.vectors[start:start + block_rows((n, self.lists))], 1)[:, 0]
+            for start in range(0, n, block_rows((n, self.lists)))
+        ]) if n else np.zeros(0, dtype=np.int64)
+        self.order: np.ndarray = np.argsort(self.assignment, kind="stable")
+        self.bounds: np.ndarray = np.searchsorted(self.assignment[self.order], np.arange(self.lists + 1))
+
+    @staticmethod
+    def __inverse_norms(vectors: csr_matrix) -> np.ndarray:
+        # The inverse norm of each row (0 for empty rows)
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        with np.errstate(divide="ignore"):
+            return np.where(norms > 0, 1.0 / norms, 0.0)
+
+    def save(self, path: Path, name: str):
+        # Save the lists (the vectors are saved by their owner)
+        save_array(path, f"{name}_centroids", self.centroids)
+        save_array(path, f"{name}_assignment", self.assignment)
+        save_array(path, f"{name}_order", self.order)
+        save_array(path, f"{name}_bounds", self.bounds)
+        save_array(path, f"{name}_inverse_norms", self.inverse_norms)
+        save_array(path, f"{name}_probes", np.asarray([self.probes], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path: Path, name: str, vectors: csr_matrix, mmap_mode: Optional[str] = None) -> "CosineIVF":
+        # Load a saved index over vectors (the rows it was fitted on) without refitting
+        index: CosineIVF = cls.__new__(cls)
+        index.vectors = vectors
+        index.centroids = load_array(path, f"{name}_centroids", mmap_mode)
+        index.lists = index.centroids.shape[0]
+        index.probes = int(load_array(path, f"{name}_probes")[0])
+        index.assignment = load_array(path, f"{name}_assignment", mmap_mode)
+        index.order = load_array(path, f"{name}_order", mmap_mode)
+        index.bounds = load_array(path, f"{name}_bounds", mmap_mode)
+        index.inverse_norms = load_array(path, f"{name}_inverse_norms", mmap_mode)
+        return index
+
+    def update(self, vectors: csr_matrix, rows: np.ndarray) -> "CosineIVF":
+        """
+        A copy of the index over vectors, the indexed rows with the given rows changed or appended (vectors has at
+        least as many rows and columns as the index), without refitting: the centroids are kept (zero in any new
+        columns) and only the given rows are assigned to their nearest lists. The lists are only re-clustered by
+        fitting a new index.
+        """
+        vectors = vectors.tocsr()
+        rows = np.asarray(rows, dtype=np.int64)
+        index: CosineIVF = CosineIVF.__new__(CosineIVF)
+        index.vectors = vectors
+        index.centroids = self.centroids if vectors.shape[1] == self.centroids.shape[1] else \
+            np.pad(self.centroids, ((0, 0), (0, vectors.shape[1] - self.centroids.shape[1])))
+        index.lists = self.lists
+        index.probes = self.probes
+
+        # Extend the row norms and assignments to the appended rows, and replace those of the given rows
+        index.inverse_norms = np.zeros(vectors.shape[0])
+        index.inverse_norms[:self.inverse_norms.size] = self.inverse_norms
+        index.assignment = np.zeros(vectors.shape[0], dtype=np.int64)
+        index.assignment[:self.assignment.size] = self.assignment
+        step = block_rows((rows.size, self.lists))
+        for start in range(0, rows.size, step):
+            block = rows[start:start + step]
+            index.inverse_norms[block] = self.__inverse_norms(vectors[block])
+            index.assignment[block] = index.__nearest_lists(vectors[block], 1)[:, 0]
+        index.order = np.argsort(index.assignment, kind="stable")
+        index.bounds = np.searchsorted(index.assignment[index.order], np.arange(index.lists + 1))
+        return index
+
+    def __nearest_lists(self, vectors: csr_matrix, count: int) -> np.ndarray:
+        # The indices of the count lists with the most similar centroids to each row, the most similar first
+        scores = np.asarray(vectors @ self.centroids.transpose())
+        nearest = np.argpartition(-scores, count - 1, axis=1)[:, :count] if count < self.lists else \
+            np.broadcast_to(np.arange(self.lists), scores.shape)
+        return np.take_along_axis(nearest, np.argsort(-np.take_along_axis(scores, nearest, axis=1), axis=1), axis=1)
+
+    def list_sizes(self) -> np.ndarray:
+        return np.diff(self.bounds)
+
+    def query(self, rows: np.ndarray, k: int, chunk_size: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The approximate k most similar rows to each of the given (indexed) rows, not including the row itself, as
+        (len(rows), k) arrays sorted by similarity descending and padded with -1 and NaN.
+        Queries are ordered by their nearest list and processed in chunks of chunk_size, each scored (with one sparse
+        product) against the members of all lists probed by the chunk; a query only keeps the members of its own
+        probed lists, so its result does not depend on the other queries. Only candidates with a non-zero similarity
+        are returned.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        indices = np.full((rows.size, k), -1, dtype=np.int64)
+        similarities = np.full((rows.size, k), np.nan)
+        if rows.size == 0 or self.vectors.shape[0] == 0:
+            return indices, similarities
+
+        probed = np.concatenate([
+            self.__nearest_lists(self.vectors[rows[start:start + block_rows((rows.size, self.lists))]], self.probes)
+            for start in range(0, rows.size, block_rows((rows.size, self.lists)))
+        ])
+        # Order the queries by nearest list, so the queries in a chunk probe many of the same lists
+        query_order = np.argsort(probed[:, 0], kind="stable")
+        for start in range(0, rows.size, chunk_size):
+            positions = query_order[start:start + chunk_size]
+            chunk = rows[positions]
+            # Mark the lists probed by each query and gather the members of all of them
+            probed_mask = np.zeros((chunk.size, self.lists), dtype=bool)
+            probed_mask[np.arange(chunk.size)[:, np.newaxis], probed[positions]] = True
+            lists = np.flatnonzero(probed_mask.any(axis=0))
+            candidates = np.concatenate([self.order[self.bounds[i]:self.bounds[i + 1]] for i in lists])
+
+            # Exact cosine similarities of the chunk's rows to the candidates of their own lists, excluding themselves
+            scores = (self.vectors[chunk] @ self.vectors[candidates].transpose()).tocoo()
+            queries, columns = scores.row, candidates[scores.col]
+            values = scores.data * self.inverse_norms[chunk[queries]] * self.inverse_norms[columns]
+            keep = (columns != chunk[queries]) & probed_mask[queries, self.assignment[columns]]
+            queries, columns, values = queries[keep], columns[keep], values[keep]
+
+            # Keep the k most similar candidates of each query
+            order = np.lexsort((-values, queries))
+            queries, columns, values = queries[order], columns[order], values[order]
+            counts = np.bincount(queries, minlength=chunk.size)
+            rank = np.arange(queries.size) - np.repeat(np.cumsum(counts) - counts, counts)
+            keep = rank < k
+            indices[positions[queries[keep]], rank[keep]] = columns[keep]
+            similarities[positions[queries[keep]], rank[keep]] = values[keep]
+        return indices, similarities
@@ -0,0 +1,129 @@
+# %%
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Dict, Deque, Any, Optional
+import numpy as np
+import pandas as pd
+
+SAMPLES = 4096  # Number of recent durations kept per span for the latency percentiles
+PERCENTILES = (50, 90, 99)  # Latency percentiles reported per span
+
+# Timing is disabled unless enabled with enable() or the RS_STATS environment variable (e.g. RS_STATS=1)
+_enabled: bool = os.environ.get("RS_STATS", "") not in ("", "0")
+_lock = threading.Lock()
+_null_span = nullcontext()
+
+
+# %%
+class SpanStats:
+    # Call count and total time of a span, with its most recent durations (seconds) for percentiles
+    __slots__ = ("count", "total", "durations")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.durations: Deque[float] = deque(maxlen=SAMPLES)
+
+
+_registry: Dict[str, SpanStats] = {}
+
+
+def enable(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _registry.clear()
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        if (stats := _registry.get(name)) is None:
+            stats = _registry[name] = SpanStats()
+        stats.count += 1
+        stats.total += seconds
+        stats.durations.append(seconds)
+
+
+class Span:
+    # Context manager recording the time spent in its block under name
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+
+
+def span(name: str):
+    # A span timing a block (with span(name): ...), or a shared no-op context manager while timing is disabled
+    return Span(name) if _enabled else _null_span
+
+
+def timed(function: Callable) -> Callable:
+    """
+    Decorate a function (or method) to record its calls as a span named by its qualified name (e.g.
+    "CollaborativeFiltering.item_item"). While timing is disabled the only overhead is checking a flag.
+    """
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+# %%
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    The statistics of every recorded span: call count, total and mean time, and the latency percentiles (see
+    PERCENTILES) and maximum over its most recent SAMPLES calls. Times are in milliseconds, except the total (seconds).
+    """
+    with _lock:
+        spans = {name: (stats.count, stats.total, np.array(stats.durations)) for name, stats in _registry.items()}
+    return {name: {
+        "count": count,
+        "total_seconds": total,
+        "mean_ms": 1000 * total / count,
+        **{f"p{p}_ms": 1000 * value for p, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES))},
+        "max_ms": 1000 * durations.max()
+    } for name, (count, total, durations) in sorted(spans.items())}
+
+
+def table() -> pd.DataFrame:
+    # The span statistics (see snapshot) as a table, by total time descending
+    stats = pd.DataFrame.from_dict(snapshot(), orient="index")
+    return stats.sort_values("total_seconds", ascending=False) if not stats.empty else stats
+
+
+def stats_json(indent: Optional[int] = None) -> str:
+    # The span statistics (see snapshot) as JSON
+    return json.dumps({"enabled": _enabled, "spans": snapshot()}, indent=indent)
+
+
+def dump(path: Path):
+    Path(path).write_text(stats_json(indent=2))
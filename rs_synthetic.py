@@ -0,0 +1,147 @@
+# %%
+from typing import Tuple
+import numpy as np
+import pandas as pd
+
+# Restaurant categories (roughly in order of popularity in the Yelp data) and cities (name, state, latitude, longitude)
+CATEGORIES = (
+    "Food", "Nightlife", "Bars", "American (Traditional)", "American (New)", "Fast Food", "Pizza", "Sandwiches",
+    "Breakfast & Brunch", "Mexican", "Burgers", "Italian", "Chinese", "Coffee & Tea", "Cafes", "Seafood",
+    "Japanese", "Chicken Wings", "Salad", "Sushi Bars", "Event Planning & Services", "Asian Fusion", "Delis",
+    "Canadian (New)", "Mediterranean", "Steakhouses", "Sports Bars", "Desserts", "Barbeque", "Specialty Food",
+    "Thai", "Vegetarian", "Indian", "Korean", "Vietnamese", "Greek", "Middle Eastern", "Bakeries", "Pubs", "Diners",
+    "Caterers", "Gluten-Free", "Juice Bars & Smoothies", "Vegan", "French", "Tex-Mex", "Ramen", "Halal", "Noodles",
+    "Tapas Bars"
+)
+CITIES = (
+    ("Las Vegas", "NV", 36.1699, -115.1398), ("Toronto", "ON", 43.6532, -79.3832),
+    ("Phoenix", "AZ", 33.4484, -112.0740), ("Charlotte", "NC", 35.2271, -80.8431),
+    ("Scottsdale", "AZ", 33.4942, -111.9261), ("Calgary", "AB", 51.0447, -114.0719),
+    ("Pittsburgh", "PA", 40.4406, -79.9959), ("Montréal", "QC", 45.5017, -73.5673),
+    ("Mesa", "AZ", 33.4152, -111.8315), ("Henderson", "NV", 36.0395, -114.9817),
+    ("Tempe", "AZ", 33.4255, -111.9400), ("Cleveland", "OH", 41.4993, -81.6944),
+    ("Madison", "WI", 43.0731, -89.4012), ("Chandler", "AZ", 33.3062, -111.8413),
+    ("Mississauga", "ON", 43.5890, -79.6441), ("Gilbert", "AZ", 33.3528, -111.7890)
+)
+ID_CHARACTERS = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_", dtype=np.uint8)
+MIN_TIMESTAMP, MAX_TIMESTAMP = 1072915200, 1577836800  # Review date range (2004-01-01 to 2020-01-01)
+
+
+# %%
+def synthetic_ids(rng: np.random.Generator, n: int) -> np.ndarray:
+    # Unique random 22 character IDs in the style of the Yelp IDs
+    ids = np.empty(0, dtype="U22")
+    while ids.size < n:
+        codes = ID_CHARACTERS[rng.integers(0, ID_CHARACTERS.size, (n - ids.size, 22))]
+        ids = np.unique(np.concatenate((ids, np.frombuffer(codes.tobytes(), dtype="S22").astype("U22"))))
+    return rng.permutation(ids)
+
+
+def power_law_weights(rng: np.random.Generator, n: int, exponent: float) -> np.ndarray:
+    # Randomly ordered Zipf weights (the weight of the rank r item is proportional to r ** -exponent), summing to 1
+    weights = rng.permutation(np.arange(1, n + 1) ** -exponent)
+    return weights / weights.sum()
+
+
+def sample_review_pairs(rng: np.random.Generator, n: int, user_weights: np.ndarray, popularity: np.ndarray,
+                        cities: np.ndarray, home_cities: np.ndarray, home_city_share: float) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    # Draw n (user, restaurant) position pairs: users by activity, restaurants by popularity within the user's home
+    # city with probability home_city_share (otherwise anywhere)
+    user_positions = rng.choice(user_weights.size, n, p=user_weights)
+    restaurant_positions = rng.choice(popularity.size, n, p=popularity)
+    local = np.flatnonzero(rng.random(n) < home_city_share)
+    for city in range(len(CITIES)):
+        city_restaurants = np.flatnonzero(cities == city)
+        city_reviews = local[home_cities[user_positions[local]] == city]
+        if city_restaurants.size and city_reviews.size:
+            restaurant_positions[city_reviews] = rng.choice(
+                city_restaurants, city_reviews.size, p=popularity[city_restaurants] / popularity[city_restaurants].sum()
+            )
+    return user_positions, restaurant_positions
+
+
+def make_synthetic_data(n_restaurants: int, n_users: int, n_reviews: int, seed: int = 0, factors: int = 8,
+                        restaurant_exponent: float = 0.8, user_exponent: float = 1.0, home_city_share: float = 0.9) \
+        -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Generate Yelp-like preprocessed restaurants, users and reviews tables (see rs_dataprep) for benchmarking.
+    Restaurants are clustered around the CITIES and have one to four CATEGORIES; restaurant and user review counts
+    follow power laws (restaurant_exponent and user_exponent), and a user reviews restaurants in their home city with
+    probability home_city_share. Stars come from a latent factor model of user taste and restaurant categories, so
+    there is structure to learn. Repeated (user, restaurant) pairs are redrawn (for a few rounds), and only reviewed
+    restaurants and users are kept, so the tables can be slightly smaller than requested.
+    The same seed gives the same data.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Restaurants: a city (weighted towards the larger ones), a location near it, categories and a quality
+    city_weights = np.arange(1, len(CITIES) + 1) ** -1.0
+    city_weights /= city_weights.sum()
+    cities = rng.choice(len(CITIES), n_restaurants, p=city_weights)
+    city_table = pd.DataFrame(CITIES, columns=["city", "state", "latitude", "longitude"])
+    category_weights = np.arange(1, len(CATEGORIES) + 1) ** -0.7
+    category_weights /= category_weights.sum()
+    category_counts = rng.integers(1, 5, n_restaurants)
+    categories = [", ".join(CATEGORIES[c] for c in rng.choice(len(CATEGORIES), count, replace=False,
+                                                               p=category_weights))
+                  for count in category_counts]
+    restaurant_ids = synthetic_ids(rng, n_restaurants)
+    restaurants = pd.DataFrame({
+        "name": [f"{CATEGORIES[c]} Place {i}" for i, c in enumerate(rng.choice(len(CATEGORIES), n_restaurants))],
+        "city": city_table["city"].to_numpy()[cities],
+        "state": city_table["state"].to_numpy()[cities],
+        "latitude": city_table["latitude"].to_numpy()[cities] + rng.normal(0.0, 0.05, n_restaurants),
+        "longitude": city_table["longitude"].to_numpy()[cities] + rng.normal(0.0, 0.05, n_restaurants),
+        "categories": categories,
+        "delivery_takeaway": rng.integers(0, 2, n_restaurants)
+    }, index=pd.Index(restaurant_ids, name="business_id"))
+
+    # Latent restaurant factors from the categories (plus noise) and user taste factors
+    category_factors = rng.normal(0.0, 1.0, (len(CATEGORIES), factors))
+    category_index = {category: i for i, category in enumerate(CATEGORIES)}
+    restaurant_factors = np.stack([category_factors[[category_index[c] for c in text.split(", ")]].mean(axis=0)
+                                   for text in categories]) + rng.normal(0.0, 0.3, (n_restaurants, factors))
+    restaurant_quality = rng.normal(0.0, 0.5, n_restaurants)
+    user_factors = rng.normal(0.0, 1.0, (n_users, factors))
+    user_bias = rng.normal(0.0, 0.4, n_users)
+    home_cities = rng.choice(len(CITIES), n_users, p=city_weights)
+
+    # Reviews: distinct (user, restaurant) pairs, topping up the pairs lost to repeats for a few rounds
+    user_weights = power_law_weights(rng, n_users, user_exponent)
+    popularity = power_law_weights(rng, n_restaurants, restaurant_exponent)
+    pairs = pd.DataFrame({"user": np.empty(0, dtype=np.int64), "restaurant": np.empty(0, dtype=np.int64)})
+    for _ in range(8):
+        if pairs.shape[0] >= n_reviews:
+            break
+        pairs = pd.concat((pairs, pd.DataFrame(dict(zip(("user", "restaurant"), sample_review_pairs(
+            rng, n_reviews - pairs.shape[0], user_weights, popularity, cities, home_cities, home_city_share
+        )))))).drop_duplicates()
+    user_positions, restaurant_positions = pairs["user"].to_numpy(), pairs["restaurant"].to_numpy()
+
+    affinity = np.einsum("ij,ij->i", user_factors[user_positions], restaurant_factors[restaurant_positions])
+    stars = np.clip(np.round(3.7 + restaurant_quality[restaurant_positions] + user_bias[user_positions] +
+                             affinity / np.sqrt(factors) + rng.normal(0.0, 0.7, user_positions.size)), 1, 5)
+    user_ids = synthetic_ids(rng, n_users)
+    reviews = pd.DataFrame({
+        "user_id": user_ids[user_positions],
+        "business_id": restaurant_ids[restaurant_positions],
+        "stars": stars,
+        "useful": rng.poisson(1.0, user_positions.size),
+        "date": pd.to_datetime(rng.integers(MIN_TIMESTAMP, MAX_TIMESTAMP, user_positions.size), unit="s")
+        .strftime("%Y-%m-%d %H:%M:%S")
+    }, index=pd.Index(synthetic_ids(rng, user_positions.size), name="review_id"))
+    reviews["rating"] = reviews["stars"] - reviews.groupby("user_id")["stars"].transform("mean")
+
+    # Keep only the reviewed restaurants and users, with their review counts and average stars
+    restaurant_reviews = reviews.groupby("business_id")["stars"]
+    restaurants = restaurants[restaurants.index.isin(reviews["business_id"].unique())].copy()
+    restaurants["review_count"] = restaurant_reviews.size()
+    restaurants["average_stars"] = restaurant_reviews.mean()
+    user_reviews = reviews.groupby("user_id")["stars"]
+    users = pd.DataFrame({"name": [f"User {i}" for i in range(user_reviews.ngroups)]},
+                         index=pd.Index(user_reviews.size().index, name="user_id"))
+    users["review_count"] = user_reviews.size()
+    users["average_stars"] = user_reviews.mean()
+    return restaurants[["name", "city", "state", "latitude", "longitude", "categories", "review_count",
+                        "average_stars", "delivery_takeaway"]], users, reviews
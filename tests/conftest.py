@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+from typing import Tuple
+import numpy as np
+import pandas as pd
+import pytest
+
+# The rs_* modules live in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rs_synthetic import make_synthetic_data  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def synthetic_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # Small synthetic restaurants, users and reviews tables (tests must not modify them)
+    return make_synthetic_data(300, 2000, 20000, seed=0)
+
+
+@pytest.fixture(scope="session")
+def incremental_data(synthetic_data) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # Split the synthetic reviews into base reviews and new reviews (all the reviews of 20 new users and 3 new
+    # restaurants, 300 others, and 50 changed ratings of base reviews), returning (base reviews, new reviews, new users,
+    # new restaurants, refit reviews) where the refit reviews are the base and new reviews with the changes applied
+    restaurants, users, reviews = synthetic_data
+    rng = np.random.default_rng(0)
+    new_users = users.iloc[rng.choice(users.shape[0], 20, replace=False)]
+    new_restaurants = restaurants.iloc[rng.choice(restaurants.shape[0], 3, replace=False)]
+    is_new = reviews["user_id"].isin(new_users.index) | reviews["business_id"].isin(new_restaurants.index)
+    is_new.iloc[rng.choice(np.flatnonzero(~is_new), 300, replace=False)] = True
+    base_reviews = reviews[~is_new]
+
+    changed_positions = rng.choice(base_reviews.shape[0], 50, replace=False)
+    changed = base_reviews.iloc[changed_positions].copy()
+    changed.index = pd.Index([f"changed{i}" for i in range(changed.shape[0])], name=reviews.index.name)
+    changed["rating"] = 0.5 - changed["rating"]
+    new_reviews = pd.concat((reviews[is_new], changed))
+
+    refit_reviews = base_reviews.copy()
+    refit_reviews.iloc[changed_positions, refit_reviews.columns.get_loc("rating")] = changed["rating"].to_numpy()
+    return base_reviews, new_reviews, new_users, new_restaurants, pd.concat((refit_reviews, reviews[is_new]))
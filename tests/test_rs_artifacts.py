@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rs_collaborative import CollaborativeFiltering
+from rs_content import ContentBasedFiltering
+from rs_hybrid import HybridRecommenderSystem
+from rs_mf import MatrixFactorization
+
+RECOMMENDERS = [
+    (CollaborativeFiltering, {}),
+    (CollaborativeFiltering, dict(item_neighbours=20, user_neighbours=10, user_ann_probes=4, user_ann_lists=16)),
+    (ContentBasedFiltering, {}),
+    (ContentBasedFiltering, dict(neighbours=20)),
+    (MatrixFactorization, dict(factors=8)),
+    (HybridRecommenderSystem, dict(factors=8)),
+]
+
+
+@pytest.mark.parametrize("recommender, parameters", RECOMMENDERS)
+@pytest.mark.parametrize("mmap_mode", [None, "r"])
+def test_save_load_round_trip(synthetic_data, tmp_path, recommender, parameters, mmap_mode):
+    restaurants, users, reviews = synthetic_data
+    rs = recommender(restaurants, users, reviews, **parameters)
+    rs.save(tmp_path)
+    loaded = recommender.load(tmp_path, restaurants, users, reviews, mmap_mode=mmap_mode)
+
+    # The loaded model makes the same predictions, with every neighbour and with a few
+    pairs = reviews.sample(300, random_state=0)
+    user_ids, restaurant_ids = pd.concat((pairs["user_id"], users.index[:100].to_series())), \
+        pd.concat((pairs["business_id"], restaurants.index[:100].to_series()))
+    for k in (None, 10):
+        np.testing.assert_array_equal(loaded.predict_stars_batch(user_ids, restaurant_ids, k),
+                                      rs.predict_stars_batch(user_ids, restaurant_ids, k))
+    restaurant_id, user_id = reviews["business_id"].iloc[0], reviews["user_id"].iloc[0]
+    if recommender is HybridRecommenderSystem:
+        pd.testing.assert_frame_equal(loaded.similar_restaurants([restaurant_id], 10)[0],
+                                      rs.similar_restaurants([restaurant_id], 10)[0])
+        pd.testing.assert_frame_equal(loaded.recommend_user(user_id, 10), rs.recommend_user(user_id, 10))
+    elif recommender is not MatrixFactorization:
+        pd.testing.assert_frame_equal(loaded.item_item(restaurant_id, 10), rs.item_item(restaurant_id, 10))
+
+
+def test_load_rejects_another_model_type(synthetic_data, tmp_path):
+    restaurants, users, reviews = synthetic_data
+    MatrixFactorization(restaurants, users, reviews, factors=4).save(tmp_path)
+    with pytest.raises(ValueError):
+        ContentBasedFiltering.load(tmp_path, restaurants, users, reviews)
+
+
+@pytest.mark.parametrize("recommender, parameters", RECOMMENDERS)
+def test_add_reviews_to_memory_mapped_model(synthetic_data, incremental_data, tmp_path, recommender, parameters):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, _ = incremental_data
+    base_users = users.drop(index=new_users.index)
+    rs = recommender(restaurants, base_users, base_reviews, **parameters)
+    rs.save(tmp_path)
+    loaded = recommender.load(tmp_path, restaurants, base_users, base_reviews, mmap_mode="r")
+
+    # Adding reviews to the read-only memory-mapped arrays copies them rather than writing to the files
+    files = {path: path.read_bytes() for path in tmp_path.rglob("*.npy")}
+    loaded.add_reviews(new_reviews, new_users, new_restaurants)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    assert {path: path.read_bytes() for path in tmp_path.rglob("*.npy")} == files
+
+    pairs = new_reviews.sample(200, random_state=0)
+    np.testing.assert_allclose(loaded.predict_stars_batch(pairs["user_id"], pairs["business_id"]),
+                               rs.predict_stars_batch(pairs["user_id"], pairs["business_id"]), atol=1e-9)
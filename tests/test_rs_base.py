@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from rs_base import ReviewIndex
+
+
+def reference_positions(reviews: pd.DataFrame, user_ids, restaurant_ids) -> np.ndarray:
+    # The position of the last review of each pair, by a dictionary lookup
+    last = {(user_id, restaurant_id): i
+            for i, (user_id, restaurant_id) in enumerate(zip(reviews["user_id"], reviews["business_id"]))}
+    return np.array([last.get(pair, -1) for pair in zip(user_ids, restaurant_ids)])
+
+
+def test_positions_many_with_repeated_pairs(synthetic_data):
+    _, _, reviews = synthetic_data
+    # Repeat some reviews (later in the table, so the repeats are the latest reviews of their pairs)
+    repeated = pd.concat((reviews, reviews.iloc[:100], reviews.iloc[50:60]))
+    index = ReviewIndex(repeated)
+    assert len(index) == reviews.shape[0]
+
+    # Reviewed pairs (some queried several times), unreviewed pairs and unknown IDs
+    user_ids = np.concatenate((repeated["user_id"], reviews["user_id"].iloc[:10],
+                               ["unknown", reviews["user_id"].iloc[0]]))
+    restaurant_ids = np.concatenate((repeated["business_id"], reviews["business_id"].iloc[10:20],
+                                     [reviews["business_id"].iloc[0], "unknown"]))
+    expected = reference_positions(repeated, user_ids, restaurant_ids)
+    np.testing.assert_array_equal(index.positions_many(user_ids, restaurant_ids), expected)
+    assert [index.position(u, r) for u, r in zip(user_ids[-20:], restaurant_ids[-20:])] == list(expected[-20:])
+
+
+def test_extended_matches_a_new_index(synthetic_data, incremental_data):
+    _, _, reviews = synthetic_data
+    base_reviews, new_reviews, _, _, _ = incremental_data
+    # The new reviews include new users and restaurants, and repeat pairs of base reviews
+    index = ReviewIndex(base_reviews).extended(new_reviews, base_reviews.shape[0])
+    all_reviews = pd.concat((base_reviews, new_reviews))
+    rebuilt = ReviewIndex(all_reviews)
+    pd.testing.assert_index_equal(index.user_index, rebuilt.user_index)
+    pd.testing.assert_index_equal(index.restaurant_index, rebuilt.restaurant_index)
+    np.testing.assert_array_equal(index.keys, rebuilt.keys)
+    np.testing.assert_array_equal(index.positions, rebuilt.positions)
+
+    pairs = pd.concat((all_reviews, reviews.sample(200, random_state=0)))
+    np.testing.assert_array_equal(index.positions_many(pairs["user_id"], pairs["business_id"]),
+                                  reference_positions(all_reviews, pairs["user_id"], pairs["business_id"]))
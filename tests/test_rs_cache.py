@@ -0,0 +1,29 @@
+import numpy as np
+from rs_cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put(("a", 1), 1)
+    cache.put(("b", 1), 2)
+    assert cache.get(("a", 1)) == 1
+    # ("b", 1) is now the least recently used entry
+    cache.put(("c", 1), 3)
+    assert ("b", 1) not in cache and cache.get(("a", 1)) == 1 and cache.get(("c", 1)) == 3
+    assert cache.get(("b", 1), "missing") == "missing"
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 1, 1)
+
+
+def test_byte_bound_and_invalidation():
+    value = np.zeros(1000)
+    cache = LRUCache(max_bytes=3 * (value.nbytes + 500))
+    for i in range(5):
+        cache.put(("user", i), value)
+    assert 0 < len(cache) < 5 and cache.nbytes <= cache.max_bytes
+    # Values larger than the bound are not cached
+    cache.put(("other", 0), np.zeros(10000))
+    assert ("other", 0) not in cache
+
+    entries = len(cache)
+    assert cache.invalidate("user") == entries and len(cache) == 0 and cache.nbytes == 0
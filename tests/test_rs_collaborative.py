@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rs_collaborative import CollaborativeFiltering
+
+
+def sample_pairs(users: pd.DataFrame, restaurants: pd.DataFrame, n: int, seed: int = 0):
+    # Random (user, restaurant) ID pairs
+    rng = np.random.default_rng(seed)
+    return users.index[rng.integers(0, users.shape[0], n)], restaurants.index[rng.integers(0, restaurants.shape[0], n)]
+
+
+@pytest.mark.parametrize("item_neighbours, user_neighbours", [(None, None), (20, 10)])
+def test_add_reviews_matches_refit(synthetic_data, incremental_data, item_neighbours, user_neighbours):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, refit_reviews = incremental_data
+    parameters = dict(item_neighbours=item_neighbours, user_neighbours=user_neighbours)
+    rs = CollaborativeFiltering(restaurants.drop(index=new_restaurants.index), users.drop(index=new_users.index),
+                                base_reviews, **parameters)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    refit = CollaborativeFiltering(restaurants, users, refit_reviews, **parameters)
+
+    # Star predictions from every neighbour (so ties in the neighbour order cannot matter)
+    user_ids, restaurant_ids = sample_pairs(users, restaurants, 2000)
+    user_ids = np.concatenate((user_ids, np.repeat(new_users.index, 10)))
+    restaurant_ids = np.concatenate((restaurant_ids, np.resize(new_restaurants.index, 200)))
+    np.testing.assert_allclose(rs.predict_stars_batch(user_ids, restaurant_ids, users.shape[0]),
+                               refit.predict_stars_batch(user_ids, restaurant_ids, users.shape[0]), atol=1e-9)
+
+    # Restaurant and user neighbour similarities
+    for restaurant_id in [*new_restaurants.index, *restaurants.index[:20]]:
+        np.testing.assert_allclose(rs.item_item(restaurant_id, 10)["similarity"],
+                                   refit.item_item(restaurant_id, 10)["similarity"], atol=1e-9)
+    for user_id in [*new_users.index[:5], *refit_reviews["user_id"].iloc[:20]]:
+        np.testing.assert_allclose(rs.user_user(user_id, 5)["similarity"],
+                                   refit.user_user(user_id, 5)["similarity"], atol=1e-9)
+
+
+def test_add_reviews_with_user_ann_matches_refit(synthetic_data, incremental_data):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, refit_reviews = incremental_data
+    # Probing every list makes the approximate index exact, however the users are assigned to the lists
+    parameters = dict(user_ann_probes=16, user_ann_lists=16)
+    rs = CollaborativeFiltering(restaurants.drop(index=new_restaurants.index), users.drop(index=new_users.index),
+                                base_reviews, **parameters)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    refit = CollaborativeFiltering(restaurants, users, refit_reviews, **parameters)
+    for user_id in [*new_users.index[:5], *new_reviews["user_id"].iloc[:20]]:
+        # (Only users with a non-zero similarity are returned, possibly none)
+        np.testing.assert_allclose(rs.user_user(user_id, 5)["similarity"].to_numpy(dtype=float),
+                                   refit.user_user(user_id, 5)["similarity"].to_numpy(dtype=float), atol=1e-9)
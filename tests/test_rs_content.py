@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rs_content import ContentBasedFiltering
+
+
+@pytest.mark.parametrize("neighbours", [None, 20])
+def test_add_reviews_matches_refit(synthetic_data, incremental_data, neighbours):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, refit_reviews = incremental_data
+    # The new restaurants are already in the catalogue (a refit would fit the TF-IDF model on other restaurants)
+    rs = ContentBasedFiltering(restaurants, users.drop(index=new_users.index), base_reviews, neighbours=neighbours)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    refit = ContentBasedFiltering(restaurants, users, refit_reviews, neighbours=neighbours)
+
+    user_ids = [*new_users.index, *refit_reviews["user_id"].unique()[:100]]
+    np.testing.assert_allclose(rs.predict_users(user_ids), refit.predict_users(user_ids), atol=1e-9)
+    pairs = refit_reviews.sample(500, random_state=0)
+    np.testing.assert_allclose(rs.predict_stars_batch(pairs["user_id"], pairs["business_id"], 10),
+                               refit.predict_stars_batch(pairs["user_id"], pairs["business_id"], 10), atol=1e-9)
+
+
+@pytest.mark.parametrize("neighbours", [None, 20])
+def test_add_restaurants_matches_existing(synthetic_data, neighbours):
+    restaurants, users, reviews = synthetic_data
+    rs = ContentBasedFiltering(restaurants, users, reviews, neighbours=neighbours)
+    # A copy of a restaurant (with a new ID) has the same similarities as the original, to every other restaurant
+    originals = restaurants.index[:3]
+    copies = restaurants.loc[originals].copy()
+    copies.index = pd.Index([f"copy{i}" for i in range(copies.shape[0])], name=restaurants.index.name)
+    rs.add_restaurants(copies)
+    for original, copy in zip(originals, copies.index):
+        candidates = restaurants.index.drop(original)
+        similar = rs.item_item(original, 10, candidates)
+        similar_copy = rs.item_item(copy, 10, candidates)
+        np.testing.assert_allclose(similar_copy["similarity"], similar["similarity"], atol=1e-9)
+
+
+@pytest.mark.parametrize("neighbours", [None, 20])
+def test_batch_predictions_match_scalar(synthetic_data, neighbours):
+    restaurants, users, reviews = synthetic_data
+    rs = ContentBasedFiltering(restaurants, users, reviews, neighbours=neighbours)
+    # The targets are reviewed restaurants, whose least similar neighbours often tie at zero similarity
+    pairs = reviews.sample(300, random_state=0)
+    scalar = [rs.predict_stars(user_id, restaurant_id) for user_id, restaurant_id in zip(pairs["user_id"],
+                                                                                         pairs["business_id"])]
+    scalar = np.array([np.nan if prediction is None else prediction for prediction in scalar])
+    np.testing.assert_allclose(rs.predict_stars_batch(pairs["user_id"], pairs["business_id"]), scalar, atol=1e-9)
+
+    user_ids = reviews["user_id"].unique()[:5]
+    scalar = [[rs.predict_stars(user_id, restaurant_id) for restaurant_id in rs.index] for user_id in user_ids]
+    scalar = np.array([[np.nan if prediction is None else prediction for prediction in row] for row in scalar])
+    np.testing.assert_allclose(rs.predict_users(user_ids), scalar, atol=1e-9)
@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import rs_data
+from rs_data import save_columnar_table, load_columnar_table, load_table
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    # Save the preprocessed tables to a temporary directory
+    monkeypatch.setattr(rs_data, "PREPROCESSED_DATA_PATH", tmp_path)
+    return tmp_path
+
+
+def test_columnar_table_round_trip(synthetic_data, data_path):
+    restaurants, _, reviews = synthetic_data
+    reviews = reviews.copy()
+    reviews.iloc[0, reviews.columns.get_loc("business_id")] = np.nan
+    save_columnar_table("reviews", reviews)
+    save_columnar_table("restaurants", restaurants)
+
+    # Numeric columns have the COLUMN_DTYPES, and text columns (and the index) are decoded, with missing values kept
+    loaded = load_columnar_table("reviews")
+    assert loaded.dtypes.to_dict() == {"user_id": object, "business_id": object, "stars": np.int8,
+                                       "useful": np.int32, "date": np.dtype("datetime64[s]"), "rating": np.float32}
+    pd.testing.assert_index_equal(loaded.index, reviews.index)
+    pd.testing.assert_series_equal(loaded["user_id"], reviews["user_id"])
+    assert np.isnan(loaded["business_id"].iloc[0])
+    pd.testing.assert_series_equal(loaded["business_id"].iloc[1:], reviews["business_id"].iloc[1:])
+    np.testing.assert_array_equal(loaded["stars"], reviews["stars"])
+    np.testing.assert_array_equal(loaded["date"], pd.to_datetime(reviews["date"]).to_numpy())
+    np.testing.assert_allclose(loaded["rating"], reviews["rating"], rtol=1e-6)
+
+    # Only the requested columns are read, optionally as categoricals of the sorted values
+    loaded = load_columnar_table("restaurants", ["city", "latitude"], categorical=True)
+    assert list(loaded.columns) == ["city", "latitude"] and loaded.index.name == "business_id"
+    assert list(loaded["city"].cat.categories) == sorted(restaurants["city"].unique())
+    np.testing.assert_array_equal(loaded["city"].astype(object), restaurants["city"])
+    assert loaded["latitude"].dtype == np.float64
+
+
+def test_load_table_backends(synthetic_data, data_path):
+    _, users, _ = synthetic_data
+    users.to_csv(data_path.joinpath("users.csv"), escapechar="\\")
+    # Without a columnar table the CSV file is read
+    assert load_table("users", "user_id")["review_count"].dtype == np.int64
+    save_columnar_table("users", users)
+    assert load_table("users", "user_id")["review_count"].dtype == np.int32
+    pd.testing.assert_frame_equal(load_table("users", "user_id", backend="csv"), users)
+    with pytest.raises(ValueError):
+        load_table("users", "user_id", backend="parquet")
+    with pytest.raises(ValueError):
+        load_table("users", "user_id", backend="columnar", nrows=10)
+
+
+def is_open(record: dict) -> bool:
+    # A (picklable) filter for the parallel reader
+    return record["is_open"] == 1
+
+
+def test_parallel_reader_matches_serial(tmp_path):
+    # Records with non-ASCII text, including a line separator other than a new line (U+2028)
+    records = [{"business_id": f"b{i}", "name": f"Café {i}\u2028line" if i % 7 == 0 else f"Restaurant {i}",
+                "is_open": i % 3 % 2, "attributes": {"stars": i % 5}} for i in range(1000)]
+    data_file_path = tmp_path.joinpath("business.json")
+    data_file_path.write_text("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records),
+                              encoding="utf8")
+    serial = list(rs_data.read_raw_data_file(data_file_path))
+    assert serial == records
+
+    # Small chunks (split mid-line and realigned to the line starts), in file order
+    assert list(rs_data.read_raw_data_file_parallel(data_file_path, processes=2, chunk_size=1000)) == serial
+    assert list(rs_data.read_raw_data_file_parallel(data_file_path, is_open, ["business_id", "name"], processes=2,
+                                                    chunk_size=777)) == \
+        [{"business_id": record["business_id"], "name": record["name"]} for record in serial if is_open(record)]
+    # Chunks cover the whole file, each starting at a line
+    chunks = rs_data.raw_data_chunks(data_file_path, 1000)
+    assert chunks[0][0] == 0 and chunks[-1][1] == data_file_path.stat().st_size
+    assert all(stop == start for (_, stop), (start, _) in zip(chunks, chunks[1:]))
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rs_dataprep import k_core_reviews, preprocess_reviews
+
+
+def reference_k_core(reviews: pd.DataFrame, min_restaurant_ratings: int, min_user_ratings: int) -> pd.DataFrame:
+    # Repeatedly drop the reviews of restaurants and users below the thresholds, one table at a time
+    while True:
+        restaurant_counts = reviews.groupby("business_id")["user_id"].transform("size")
+        reviews = reviews[restaurant_counts >= min_restaurant_ratings]
+        user_counts = reviews.groupby("user_id")["business_id"].transform("size")
+        if (user_counts >= min_user_ratings).all():
+            return reviews
+        reviews = reviews[user_counts >= min_user_ratings]
+
+
+@pytest.mark.parametrize("min_restaurant_ratings, min_user_ratings", [(1, 1), (40, 4), (60, 6), (10 ** 6, 1)])
+def test_k_core_thresholds(synthetic_data, min_restaurant_ratings, min_user_ratings):
+    _, _, reviews = synthetic_data
+    core = k_core_reviews(reviews, min_restaurant_ratings, min_user_ratings)
+    assert (core["business_id"].value_counts() >= min_restaurant_ratings).all()
+    assert (core["user_id"].value_counts() >= min_user_ratings).all()
+    # The (unique) largest such subset, in the original order
+    pd.testing.assert_frame_equal(core, reference_k_core(reviews, min_restaurant_ratings, min_user_ratings))
+
+
+def test_preprocess_reviews(synthetic_data):
+    restaurants, _, reviews = synthetic_data
+    # Repeat a review with an earlier date, which replaces it as the first review of the pair
+    repeat = reviews.iloc[[0]].copy()
+    repeat.index = pd.Index(["repeat"], name=reviews.index.name)
+    repeat["date"], repeat["stars"] = "2000-01-01 00:00:00", 5.0
+    sampled = pd.concat((reviews, repeat)).drop(columns="rating")
+
+    preprocessed = preprocess_reviews(sampled, restaurants.index[1:])
+    assert "repeat" in preprocessed.index and reviews.index[0] not in preprocessed.index
+    assert not preprocessed.duplicated(["user_id", "business_id"]).any()
+    assert not preprocessed["business_id"].isin(restaurants.index[:1]).any()
+    # Ratings are the stars less the user's mean stars (over the kept reviews)
+    means = preprocessed.groupby("user_id")["stars"].mean()
+    np.testing.assert_allclose(preprocessed["rating"],
+                               preprocessed["stars"] - means.reindex(preprocessed["user_id"]).to_numpy())
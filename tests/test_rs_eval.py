@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from rs_collaborative import CollaborativeFiltering
+from rs_content import ContentBasedFiltering
+from rs_eval import evaluate, sample_reviews
+from rs_hybrid import HybridRecommenderSystem
+
+
+@pytest.mark.parametrize("recommender", [ContentBasedFiltering, CollaborativeFiltering, HybridRecommenderSystem])
+def test_evaluate_matches_scalar_predictions(synthetic_data, recommender):
+    restaurants, users, reviews = synthetic_data
+    rs = recommender(restaurants, users, reviews)
+    results = evaluate(rs, reviews, max_samples=200, processes=1, shard_size=50)
+
+    # The error metrics of the same sample, predicted one review at a time with predict_stars
+    sample = sample_reviews(reviews, 200)
+    errors = np.array([np.nan if (prediction := rs.predict_stars(user_id, restaurant_id)) is None else
+                       prediction - stars
+                       for user_id, restaurant_id, stars in zip(sample["user_id"], sample["business_id"],
+                                                                sample["stars"])])
+    errors = errors[~np.isnan(errors)]
+    assert results.loc["all", "predicted"] == errors.size
+    assert results.loc["all", "rmse"] == pytest.approx(np.sqrt(np.mean(errors ** 2)))
+    assert results.loc["all", "mae"] == pytest.approx(np.mean(np.abs(errors)))
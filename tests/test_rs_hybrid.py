@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rs_geo import RestaurantLocator
+from rs_hybrid import HybridRecommenderSystem, MAX_CACHED_BATCH
+
+
+def test_add_restaurants(synthetic_data):
+    restaurants, users, reviews = synthetic_data
+    rs = HybridRecommenderSystem(restaurants, users, reviews)
+    # New (unreviewed) copies of two restaurants
+    new = restaurants.iloc[:2].copy()
+    new.index = pd.Index(["newr1", "newr2"], name="business_id")
+    rs.add_restaurants(new)
+    user_id = reviews["user_id"].iloc[0]
+
+    # The scalar and batch star predictions agree on the new restaurants (computed separately, not cached)
+    scalar_predictions = [rs.predict_stars(user_id, restaurant_id) for restaurant_id in new.index]
+    rs.invalidate()
+    predictions = rs.predict_stars_batch([user_id] * 2, new.index)
+    for prediction, batch_prediction in zip(scalar_predictions, predictions):
+        assert np.isnan(batch_prediction) if prediction is None else prediction == pytest.approx(batch_prediction)
+
+    # Recommendations near a new restaurant are within the radius
+    location = (new["latitude"].iloc[0], new["longitude"].iloc[0])
+    nearby = RestaurantLocator(pd.concat((restaurants, new))).within_radius(*location, 20.0).index
+    recommendations = rs.recommend_user(user_id, 10, location, 20.0)
+    assert recommendations.index.isin(nearby).all()
+
+    # A new restaurant has (content-based) similar restaurants, ranked by score
+    similar = rs.similar_restaurants(["newr1"], 5)[0]
+    assert similar.shape[0] == 5 and "newr1" not in similar.index
+    assert (np.diff(similar["score"].to_numpy()) <= 0).all()
+
+
+def test_reviews_of_unknown_restaurants_are_ignored(synthetic_data):
+    restaurants, users, reviews = synthetic_data
+    # Drop a reviewed restaurant from the restaurants table (but not its reviews)
+    missing = reviews["business_id"].iloc[0]
+    rs = HybridRecommenderSystem(restaurants.drop(index=missing), users, reviews)
+    user_id = reviews.loc[reviews["business_id"] == missing, "user_id"].iloc[0]
+    recommendations = rs.recommend_user(user_id, 5)
+    assert recommendations.shape == (5, 3) and missing not in recommendations.index
+
+
+def test_add_reviews_matches_refit(synthetic_data, incremental_data):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, refit_reviews = incremental_data
+    # The new restaurants are already in the catalogue (a refit would fit the CBF TF-IDF model on other restaurants)
+    rs = HybridRecommenderSystem(restaurants, users.drop(index=new_users.index), base_reviews)
+    user_ids = [*new_users.index[:5], *refit_reviews["user_id"].unique()[:20]]
+    rs.recommend_users(user_ids, 10)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    refit = HybridRecommenderSystem(restaurants, users, refit_reviews)
+
+    # No recommendations cached before the reviews were added are returned. (Their star predictions use the nearest
+    # users only, whose order can differ between tied similarities, so predictions are compared using every user.)
+    for recommendations, refit_recommendations in zip(rs.recommend_users(user_ids, 10),
+                                                      refit.recommend_users(user_ids, 10)):
+        np.testing.assert_allclose(recommendations["score"], refit_recommendations["score"], atol=1e-9)
+        assert set(recommendations.index) == set(refit_recommendations.index)
+    pairs = refit_reviews.sample(500, random_state=0)
+    np.testing.assert_allclose(rs.predict_stars_batch(pairs["user_id"], pairs["business_id"], users.shape[0]),
+                               refit.predict_stars_batch(pairs["user_id"], pairs["business_id"], users.shape[0]),
+                               atol=1e-9)
+
+
+@pytest.mark.parametrize("k", [None, 10])
+def test_scalar_and_batch_predictions_agree_in_either_order(synthetic_data, k):
+    restaurants, users, reviews = synthetic_data
+    rs = HybridRecommenderSystem(restaurants, users, reviews)
+    pairs = reviews.sample(300, random_state=1)
+
+    def scalar_predictions():
+        return np.array([np.nan if (prediction := rs.predict_stars(user_id, restaurant_id, k)) is None else prediction
+                         for user_id, restaurant_id in zip(pairs["user_id"], pairs["business_id"])])
+
+    # Whichever method fills the cache first, both return the same predictions
+    scalar_first = scalar_predictions()
+    np.testing.assert_array_equal(rs.predict_stars_batch(pairs["user_id"], pairs["business_id"], k), scalar_first)
+    rs.invalidate()
+    batch_first = rs.predict_stars_batch(pairs["user_id"], pairs["business_id"], k)
+    np.testing.assert_array_equal(scalar_predictions(), batch_first)
+    np.testing.assert_allclose(batch_first, scalar_first, atol=1e-9)
+
+
+def test_large_batches_bypass_the_prediction_cache(synthetic_data):
+    restaurants, users, reviews = synthetic_data
+    rs = HybridRecommenderSystem(restaurants, users, reviews)
+    pairs = reviews.sample(MAX_CACHED_BATCH + 1, random_state=0)
+    predictions = rs.predict_stars_batch(pairs["user_id"], pairs["business_id"])
+    assert rs.cache_stats().loc["predictions", "entries"] == 0
+
+    # Small batches are cached, with the same predictions
+    small = rs.predict_stars_batch(pairs["user_id"][:10], pairs["business_id"][:10])
+    assert rs.cache_stats().loc["predictions", "entries"] == 10
+    np.testing.assert_array_equal(small, predictions[:10])
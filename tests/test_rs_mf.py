@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from rs_mf import MatrixFactorization
+
+
+def rmse(rs: MatrixFactorization, users: pd.DataFrame, reviews: pd.DataFrame) -> float:
+    # Root mean squared error of the star predictions of the reviews (of their normalised ratings)
+    predictions = rs.predict_stars_batch(reviews["user_id"], reviews["business_id"]) - \
+        users["average_stars"].reindex(reviews["user_id"]).to_numpy()
+    return float(np.sqrt(np.mean((predictions - reviews["rating"].to_numpy()) ** 2)))
+
+
+def test_als_fits_the_ratings(synthetic_data):
+    restaurants, users, reviews = synthetic_data
+    rs = MatrixFactorization(restaurants, users, reviews, factors=8)
+    # Better than predicting each user's average stars, and the recommendations are unreviewed restaurants
+    baseline = np.sqrt(np.mean(reviews["rating"].to_numpy() ** 2))
+    assert rmse(rs, users, reviews) < 0.8 * baseline
+    user_id = reviews["user_id"].iloc[0]
+    recommendations = rs.recommend_user(user_id, 10)
+    assert recommendations.shape[0] == 10
+    assert not recommendations.index.isin(reviews.loc[reviews["user_id"] == user_id, "business_id"]).any()
+
+
+def test_add_reviews_matches_refit(synthetic_data, incremental_data):
+    restaurants, users, _ = synthetic_data
+    base_reviews, new_reviews, new_users, new_restaurants, refit_reviews = incremental_data
+    rs = MatrixFactorization(restaurants.drop(index=new_restaurants.index), users.drop(index=new_users.index),
+                             base_reviews, factors=8)
+    rs.add_reviews(new_reviews, new_users, new_restaurants)
+    refit = MatrixFactorization(restaurants, users, refit_reviews, factors=8)
+
+    # ALS is warm-started rather than exactly updated, so the fits are compared (including the changed ratings)
+    assert rmse(rs, users, refit_reviews) < 1.05 * rmse(refit, users, refit_reviews)
+    pairs = pd.MultiIndex.from_frame(new_reviews[["user_id", "business_id"]])
+    new = refit_reviews[pd.MultiIndex.from_frame(refit_reviews[["user_id", "business_id"]]).isin(pairs)]
+    assert new.shape[0] == new_reviews.shape[0]
+    assert rmse(rs, users, new) < 1.05 * rmse(refit, users, new)
@@ -0,0 +1,21 @@
+import json
+import pytest
+from rs_hybrid import HybridRecommenderSystem
+from rs_offline import recommend_all
+
+
+def test_resume_only_the_same_run(synthetic_data, tmp_path):
+    restaurants, users, reviews = synthetic_data
+    rs = HybridRecommenderSystem(restaurants, users, reviews)
+    user_ids = users.index[:40].tolist()
+    assert recommend_all(rs, user_ids, 5, tmp_path, processes=1, shard_size=10, model_id="model-a") == 40
+    lines = [json.loads(line) for path in sorted(tmp_path.glob("shard_*.jsonl")) for line in path.open()]
+    assert [line["user_id"] for line in lines] == sorted(user_ids)
+
+    # The same run has nothing left to do
+    assert recommend_all(rs, user_ids, 5, tmp_path, processes=1, shard_size=10, model_id="model-a") == 0
+    # A different model, or different users (of the same number), cannot resume it
+    with pytest.raises(ValueError):
+        recommend_all(rs, user_ids, 5, tmp_path, processes=1, shard_size=10, model_id="model-b")
+    with pytest.raises(ValueError):
+        recommend_all(rs, users.index[40:80].tolist(), 5, tmp_path, processes=1, shard_size=10, model_id="model-a")
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import pytest
+from rs_hybrid import HybridRecommenderSystem
+from rs_server import RecommenderServer, fetch, score_groups, MAX_COUNT
+
+
+@pytest.fixture(scope="module")
+def recommender(synthetic_data):
+    return HybridRecommenderSystem(*synthetic_data)
+
+
+def request_concurrently(rs, targets):
+    # Send each target on its own connection at the same time (so they are batched together)
+    async def run():
+        server = RecommenderServer(rs, window=0.05)
+        port = await server.start("127.0.0.1", 0)
+
+        async def send(target):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                status, body = await fetch(reader, writer, "127.0.0.1", target)
+                return status, json.loads(body)
+            finally:
+                writer.close()
+        try:
+            return await asyncio.gather(*(send(target) for target in targets))
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+
+def test_score_groups_fails_only_the_failing_request():
+    def score(key, requests):
+        if "bad" in requests:
+            raise ValueError("bad request")
+        return [f"{key}:{request}" for request in requests]
+
+    results = score_groups(["a", "bad", "c", "d"], [1, 1, 1, 2], score)
+    assert results[0] == "1:a" and results[2] == "1:c" and results[3] == "2:d"
+    assert isinstance(results[1], ValueError)
+
+
+def test_invalid_parameters_do_not_fail_batched_requests(recommender, synthetic_data):
+    restaurants, users, _ = synthetic_data
+    user_id, restaurant_id = users.index[0], restaurants.index[0]
+    responses = request_concurrently(recommender, [
+        f"/predict?user_id={user_id}&business_id={restaurant_id}",
+        f"/predict?user_id={user_id}&business_id={restaurant_id}&k=0",
+        f"/recommendations?user_id={user_id}&count=5",
+        f"/recommendations?user_id={user_id}&count=-1",
+        f"/similar?business_id={restaurant_id}&count=-1",
+        "/recommendations?user_id=unknown"
+    ])
+    assert [status for status, _ in responses] == [200, 400, 200, 400, 400, 404]
+    assert responses[0][1]["star_prediction"] == pytest.approx(recommender.predict_stars(user_id, restaurant_id))
+    assert [r["business_id"] for r in responses[2][1]["recommendations"]] == \
+        list(recommender.recommend_user(user_id, 5).index)
+
+
+def test_out_of_range_counts_are_bad_requests(recommender, synthetic_data):
+    restaurants, users, _ = synthetic_data
+    user_id, restaurant_id = users.index[0], restaurants.index[0]
+    responses = request_concurrently(recommender, [
+        f"/similar?business_id={restaurant_id}&count={MAX_COUNT + 1}",
+        f"/similar?business_id={restaurant_id}&count=1000000000",
+        f"/similar?business_id={restaurant_id}&count=0",
+        f"/recommendations?user_id={user_id}&count={MAX_COUNT + 1}",
+        f"/recommendations?user_id={user_id}&count=0",
+        f"/similar?business_id={restaurant_id}&count={MAX_COUNT}"
+    ])
+    assert [status for status, _ in responses] == [400, 400, 400, 400, 400, 200]
+    assert len(responses[-1][1]["similar"]) <= MAX_COUNT
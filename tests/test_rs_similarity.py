@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix, vstack
+from rs_similarity import CosineIVF
+
+
+def random_vectors(n: int, columns: int = 50, seed: int = 0) -> csr_matrix:
+    # Sparse random rows with about five non-zero entries each
+    rng = np.random.default_rng(seed)
+    rows, cols = np.repeat(np.arange(n), 5), rng.integers(0, columns, 5 * n)
+    return csr_matrix((rng.normal(size=5 * n), (rows, cols)), shape=(n, columns))
+
+
+def test_ivf_update_keeps_the_centroids():
+    vectors = random_vectors(500)
+    index = CosineIVF(vectors, lists=10, probes=10)
+    # Change the first 20 rows and append 30 more
+    changed = vstack((random_vectors(20, seed=1), vectors[20:], random_vectors(30, seed=2)), format="csr")
+    updated = index.update(changed, np.concatenate((np.arange(20), np.arange(500, 530))))
+
+    # The centroids are kept and every row is in the list of its nearest centroid
+    np.testing.assert_array_equal(updated.centroids, index.centroids)
+    np.testing.assert_array_equal(updated.assignment, np.asarray(changed @ index.centroids.transpose()).argmax(axis=1))
+    assert updated.list_sizes().sum() == 530
+    np.testing.assert_array_equal(index.assignment[20:], updated.assignment[20:500])
+
+    # Probing every list, queries are exact
+    indices, similarities = updated.query(np.arange(0, 530, 10), 5)
+    dense = changed.toarray()
+    dense /= np.linalg.norm(dense, axis=1, keepdims=True)
+    exact = dense @ dense.transpose()
+    np.fill_diagonal(exact, -np.inf)
+    np.testing.assert_allclose(similarities, -np.sort(-exact[::10], axis=1)[:, :5], atol=1e-9)
+
+
+@pytest.mark.parametrize("mmap_mode", [None, "r"])
+def test_ivf_save_load_round_trip(tmp_path, mmap_mode):
+    vectors = random_vectors(500)
+    index = CosineIVF(vectors, lists=20, probes=3)
+    index.save(tmp_path, "ivf")
+    loaded = CosineIVF.load(tmp_path, "ivf", vectors, mmap_mode)
+    assert (loaded.lists, loaded.probes) == (index.lists, index.probes)
+    np.testing.assert_array_equal(loaded.list_sizes(), index.list_sizes())
+
+    # The loaded index gives the same (approximate) neighbours, and can be updated
+    rows = np.arange(0, 500, 7)
+    for result, loaded_result in zip(index.query(rows, 10), loaded.query(rows, 10)):
+        np.testing.assert_array_equal(loaded_result, result)
+    changed = vstack((vectors, random_vectors(10, seed=3)), format="csr")
+    for result, loaded_result in zip(index.update(changed, np.arange(500, 510)).query(rows, 10),
+                                     loaded.update(changed, np.arange(500, 510)).query(rows, 10)):
+        np.testing.assert_array_equal(loaded_result, result)